@@ -0,0 +1,189 @@
+"""
+Asynchronous file I/O helpers. Blocking reads, writes and copies are run in a
+bounded thread pool so that they overlap with parsing and processing done in
+the main thread. The amount of data read ahead or waiting to be written is
+limited to keep memory usage bounded.
+"""
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from shutil import copy
+
+# =============================================================================
+
+
+def _read_file(file_name):
+    with open(file_name, "r") as fp:
+        return fp.read()
+
+
+def _write_file(file_name, data):
+    with open(file_name, "w") as fp:
+        fp.write(data)
+
+# =============================================================================
+
+
+class AsyncIO(object):
+    """
+    An I/O pipeline. Holds a thread pool executor and accounts for the number
+    of outstanding bytes, ie. data read but not yet consumed or data passed
+    for writing but not yet written.
+    """
+
+    def __init__(self, max_workers=8, max_pending_bytes=32 * 1024 * 1024):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.max_workers = max_workers
+        self.max_pending_bytes = max_pending_bytes
+
+        self.pending_bytes = 0
+        self.pending_tasks = set()
+
+    def close(self):
+        """
+        Shuts down the executor.
+        """
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # .........................................................................
+
+    def map(self, func, items):
+        """
+        Calls a function for all items in the thread pool. Blocks until all
+        calls are done, returns a list of results.
+        """
+        return list(self.executor.map(func, items))
+
+    def run(self, coro):
+        """
+        Runs a coroutine to completion. Makes sure that all scheduled writes
+        are finished before returning.
+        """
+
+        async def wrapper():
+            try:
+                return await coro
+            finally:
+                await self.flush()
+
+        return asyncio.run(wrapper())
+
+    def _run_in_executor(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self.executor, func, *args)
+
+    async def _reserve(self, size):
+        """
+        Waits until there is room for the given number of bytes. A single
+        item larger than the limit is let through when nothing else is
+        pending.
+        """
+        while self.pending_bytes > 0 and \
+              self.pending_bytes + size > self.max_pending_bytes:
+            await asyncio.wait(self.pending_tasks,
+                               return_when=asyncio.FIRST_COMPLETED)
+
+        self.pending_bytes += size
+
+    # .........................................................................
+
+    async def read_files(self, file_names):
+        """
+        An asynchronous generator which yields (file_name, data) tuples in the
+        order of the given file names. Files are read ahead in the background
+        as long as the amount of data read but not yet consumed is within
+        the limit.
+        """
+
+        file_names = deque(file_names)
+        reads = deque()
+        ready_bytes = 0
+
+        while file_names or reads:
+
+            # Schedule reads ahead
+            while file_names and len(reads) < self.max_workers and \
+                  ready_bytes < self.max_pending_bytes:
+                file_name = file_names.popleft()
+                reads.append((file_name, self._run_in_executor(_read_file, file_name)))
+
+            # Wait for the oldest one
+            file_name, future = reads.popleft()
+            data = await future
+
+            # Account for data of reads that completed in the meantime
+            ready_bytes = sum(len(f.result()) for n, f in reads
+                              if f.done() and f.exception() is None)
+
+            yield file_name, data
+
+    async def read_file(self, file_name):
+        """
+        Reads a single file.
+        """
+        return await self._run_in_executor(_read_file, file_name)
+
+    async def write_file(self, file_name, data):
+        """
+        Schedules writing of a file. Returns as soon as the data is accepted
+        by the pipeline, waits only if there is too much data pending.
+        """
+        size = len(data)
+        await self._reserve(size)
+
+        task = asyncio.ensure_future(self._run_in_executor(_write_file, file_name, data))
+        self._track(task, size)
+
+    async def copy_file(self, src_file, dst_file):
+        """
+        Schedules copying of a file. Copies do not buffer data in memory so
+        only the number of them in flight is limited.
+        """
+        await self.run_in_background(copy, src_file, dst_file)
+
+    async def run_in_background(self, func, *args):
+        """
+        Schedules a function call that does not buffer data in memory, eg.
+        a file copy. Only the number of them in flight is limited.
+        """
+        while len(self.pending_tasks) >= self.max_workers:
+            await asyncio.wait(self.pending_tasks,
+                               return_when=asyncio.FIRST_COMPLETED)
+
+        task = asyncio.ensure_future(self._run_in_executor(func, *args))
+        self._track(task, 0)
+
+    def _track(self, task, size):
+
+        def done(task):
+            self.pending_tasks.discard(task)
+            self.pending_bytes -= size
+
+        self.pending_tasks.add(task)
+        task.add_done_callback(done)
+
+    async def flush(self):
+        """
+        Waits for all scheduled writes and copies to finish. Raises the first
+        error encountered, if any. Everything scheduled is waited for even
+        when some of it fails, so that nothing is left pending once the
+        event loop is closed.
+        """
+        if not self.pending_tasks:
+            return
+
+        tasks = list(self.pending_tasks)
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        self.pending_tasks.clear()
+        self.pending_bytes = 0
+
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
@@ -3,7 +3,13 @@ Reader and writer module for so called "bracket tree" file. Can read, parse
 and write KiCad files such as .kicad_pcb, .kicad_mod, fp-lib-table and
 sym-lib-table.
 """
+import gc
+import os
+import re
+import struct
+from array import array
 from collections import namedtuple
+from functools import lru_cache
 from io import StringIO
 
 # =============================================================================
@@ -14,8 +20,25 @@ class Node(object):
     Represents a single tree node. Holds reference to its parent and children.
     The children order is important! Children objects are either another Node
     instances or strings (attributes).
+
+    Nodes parsed with keep_source=True also remember the source text and
+    their location in it (see parse()). Nodes created otherwise have the
+    span set to None.
     """
 
+    # Concrete syntax information, set only for nodes parsed from a source
+    source      = None
+    span        = None
+    head_end    = None
+    tail_start  = None
+    child_spans = None
+    orig_child  = None
+
+    # Text before and after the root node in the source. Set only when
+    # a whole source was parsed.
+    leading     = None
+    trailing    = None
+
     def __init__(self, parent, keyword, children = None):
         self.parent  = parent
         self.keyword = keyword
@@ -92,9 +115,11 @@ Token = namedtuple("Token", "type data")
 # =============================================================================
 
 
-def tokenize(data):
+def tokenize(data, escapes=False):
     """
-    Tokenize a string representing the "bracket tree".
+    Tokenize a string representing the "bracket tree". With escapes=True
+    backslash escape sequences inside quoted strings are recognized and
+    kept as they are in words.
     """
 
     ios = StringIO(data)
@@ -131,6 +156,10 @@ def tokenize(data):
         if quote:
             word += c
 
+            # Keep an escaped character, it does not end the quote
+            if escapes and c == "\\":
+                word += ios.read(1)
+
         # Outside a quote
         else:
 
@@ -166,13 +195,23 @@ def tokenize(data):
     return tokens
 
 
-def parse(data):
+def parse(data, keep_source=False, escapes=False):
     """
     Parse a string representing the "bracket tree".
+
+    With keep_source=True each node remembers its span in the source text
+    along with whitespace around its children. Dumping such a tree copies
+    unmodified parts verbatim from the source, see dump().
+
+    With escapes=True backslash escaped quotes inside quoted strings are
+    recognized, as used by KiCad 6+ files.
     """
 
+    if keep_source:
+        return parse_concrete(data, escapes=escapes)
+
     # Tokenize
-    tokens = tokenize(data)
+    tokens = tokenize(data, escapes)
 
     # Build the tree
     root  = None
@@ -214,22 +253,347 @@ def parse(data):
     return root
 
 
-def load(file_name):
+def load(file_name, keep_source=False, escapes=False):
     """
     Loads and parses a file with the "bracket tree" definition.
     """
     
     with open(file_name, "r") as fp:
-        return parse(fp.read())
+        return parse(fp.read(), keep_source, escapes)
+
+
+CONCRETE_TOKEN_RE = re.compile(r"(\()|(\))|\"([^\"]*)\"|([^\s()\"]+)")
+
+# KiCad 6+ files escape quotes inside quoted strings with a backslash.
+# Escape sequences are kept as they are in words.
+ESCAPED_TOKEN_RE = re.compile(r"(\()|(\))|\"((?:[^\"\\]|\\.)*)\"|([^\s()\"]+)", re.S)
+
+
+def parse_concrete(data, start=0, end=None, escapes=False):
+    """
+    Parses a string representing the "bracket tree" keeping the concrete
+    syntax information. For each node its span in the source is stored as
+    well as spans of all its children, each one including the whitespace
+    preceeding it. A copy of the children list is kept to detect changes.
+
+    Optionally only a part of the source, from start to end, is parsed.
+    The part must contain a single complete node. It is dumped as any
+    other subtree.
+
+    With escapes=True backslash escaped quotes inside quoted strings are
+    recognized, as used by KiCad 6+ files.
+    """
+
+    whole = start == 0 and end is None
+    if end is None:
+        end = len(data)
+
+    token_re = ESCAPED_TOKEN_RE if escapes else CONCRETE_TOKEN_RE
+
+    root  = None
+    node  = None
+    stack = []
+
+    open_pos = None
+    prev_end = start
+
+    for match in token_re.finditer(data, start, end):
+        tok_start, tok_end = match.span()
+
+        # "(", the keyword follows
+        if match.group(1) is not None:
+            open_pos = tok_start
+            continue
+
+        # ")", close the current node
+        if match.group(2) is not None:
+            node.tail_start = prev_end
+            node.span = (node.span[0], tok_end)
+            node.orig_child = list(node.child)
+
+            node = stack.pop()
+            prev_end = tok_end
+            continue
+
+        word = match.group(3) if match.group(3) is not None else match.group(4)
+
+        # Keyword, add a new node
+        if open_pos is not None:
+            stack.append(node)
+
+            parent = node
+            node = Node(parent, word)
+            node.source = data
+            node.span = (open_pos, None)
+            node.head_end = tok_end
+            node.child_spans = []
+
+            if parent:
+                parent.child.append(node)
+                parent.child_spans.append((prev_end, open_pos, None))
+            else:
+                assert root is None
+                root = node
+
+            open_pos = None
+
+        # Append attributes to the current node
+        else:
+            node.child.append(word)
+            node.child_spans.append((prev_end, tok_start, tok_end))
+
+        prev_end = tok_end
+
+    # Check
+    assert len(stack) == 0
+
+    # Keep text around the root
+    if root is not None and whole:
+        root.leading  = data[:root.span[0]]
+        root.trailing = data[root.span[1]:]
+
+    # Return the root
+    return root
+
+# =============================================================================
+
+STRUCTURE_RE = re.compile(r"[()]|\"[^\"]*\"")
+ESCAPED_STRUCTURE_RE = re.compile(r"[()]|\"(?:[^\"\\]|\\.)*\"", re.S)
+
+# The keyword of a node, following its "("
+KEYWORD_RE = re.compile(r"\(\s*(?:\"([^\"]*)\"|([^\s()\"]+))")
+ESCAPED_KEYWORD_RE = re.compile(r"\(\s*(?:\"((?:[^\"\\]|\\.)*)\"|([^\s()\"]+))", re.S)
+
+
+def node_head(data, start, escapes=False):
+    """
+    Returns the keyword and the leading attributes of a node which begins
+    at the given position in the source, ie. all its words up to its first
+    child node.
+    """
+
+    token_re = ESCAPED_TOKEN_RE if escapes else CONCRETE_TOKEN_RE
+    words = []
+
+    for match in token_re.finditer(data, start):
+
+        # "(", either the node itself or its first child
+        if match.group(1) is not None:
+            if match.start() != start:
+                break
+            continue
+
+        # ")", the end of the node
+        if match.group(2) is not None:
+            break
+
+        words.append(match.group(3) if match.group(3) is not None else match.group(4))
+
+    return words
+
+
+def iter_children(data, start=0, end=None, escapes=False):
+    """
+    Yields (keyword, start, end) tuples of child nodes of a node which
+    begins at the given position in the source, by default of the root.
+    Only brackets and quoted strings are matched, nothing is parsed, so
+    large files can be scanned without building a tree. Children of
+    interest may then be parsed with parse_concrete() or scanned the same
+    way.
+    """
+
+    structure_re = ESCAPED_STRUCTURE_RE if escapes else STRUCTURE_RE
+    keyword_re = ESCAPED_KEYWORD_RE if escapes else KEYWORD_RE
+    if end is None:
+        end = len(data)
+
+    depth = 0
+    child_start = None
+
+    for match in structure_re.finditer(data, start, end):
+        token = match.group()
+
+        if token == "(":
+            depth += 1
+            if depth == 2:
+                child_start = match.start()
+
+        elif token == ")":
+            depth -= 1
+            if depth == 1:
+                keyword = keyword_re.match(data, child_start)
+                if keyword is not None:
+                    keyword = keyword.group(1) if keyword.group(1) is not None else keyword.group(2)
+                yield keyword, child_start, match.end()
+            elif depth == 0:
+                return
+
+
+def line_span(data, start, end):
+    """
+    Extends a node span to the beginning of its line if there is only white
+    space before the node. The text of such a span keeps the indentation.
+    """
+
+    line_start = data.rfind("\n", 0, start) + 1
+    if data[line_start:start].isspace():
+        return line_start, end
+    return start, end
+
+# =============================================================================
+
+
+def is_modified(node, memo=None):
+    """
+    Returns True if a node parsed with keep_source=True or any of its
+    descendants has been modified since parsing. Nodes not parsed from
+    a source are always considered modified.
+    """
+
+    if memo is None:
+        memo = {}
+
+    key = id(node)
+    if key in memo:
+        return memo[key]
+
+    if node.span is None or len(node.child) != len(node.orig_child):
+        modified = True
+
+    else:
+        modified = False
+        for child, orig in zip(node.child, node.orig_child):
+
+            if isinstance(child, Node):
+                if child is not orig or is_modified(child, memo):
+                    modified = True
+                    break
+
+            elif child != orig:
+                modified = True
+                break
+
+    memo[key] = modified
+    return modified
+
+
+def _quote(word):
+    """
+    Quotes a word if needed: when it is empty or contains brackets, quotes
+    (escaped ones, from KiCad 6+ files) or any white space.
+    """
+    if len(word) == 0 or "(" in word or ")" in word or "\"" in word or \
+       any(c.isspace() for c in word):
+        return "\"" + word + "\""
+    return word
+
+
+def dump_concrete(tree):
+    """
+    Converts a "bracket tree" to a string representation. Unmodified nodes
+    which were parsed with keep_source=True are copied verbatim from the
+    source. Modified ones keep whitespace around their unmodified children,
+    only the new or changed children are formatted. Nodes without source
+    are written in a single line. A subtree, ie. anything but a whole
+    parsed source, is dedented by the indentation of its first line.
+    """
+
+    memo  = {}
+    parts = []
+
+    def dump_new(node):
+        parts.append("(" + _quote(node.keyword))
+        for child in node.child:
+            parts.append(" ")
+            if isinstance(child, Node):
+                dump_node(child)
+            else:
+                parts.append(_quote(child))
+        parts.append(")")
+
+    def dump_node(node):
+
+        # A new node
+        if node.span is None:
+            dump_new(node)
+            return
+
+        source = node.source
+
+        # Not modified, copy
+        if not is_modified(node, memo):
+            parts.append(source[node.span[0]:node.span[1]])
+            return
+
+        # Modified, look for original children
+        orig_nodes = {id(c): i for i, c in enumerate(node.orig_child)
+                      if isinstance(c, Node)}
+
+        parts.append(source[node.span[0]:node.head_end])
+
+        for i, child in enumerate(node.child):
+
+            # A child node. Keep its original preceeding whitespace.
+            if isinstance(child, Node):
+                idx = orig_nodes.get(id(child))
+                if idx is not None:
+                    gap_start, start, end = node.child_spans[idx]
+                    parts.append(source[gap_start:start])
+                else:
+                    parts.append(" ")
+
+                dump_node(child)
+                continue
+
+            # An attribute at its original position
+            if i < len(node.orig_child) and isinstance(node.orig_child[i], str):
+                gap_start, start, end = node.child_spans[i]
+                if child == node.orig_child[i]:
+                    parts.append(source[gap_start:end])
+                    continue
+
+                # Changed, keep its quoting
+                parts.append(source[gap_start:start])
+                if source[start] == "\"":
+                    parts.append("\"" + child + "\"")
+                else:
+                    parts.append(_quote(child))
+                continue
+
+            # A new attribute
+            parts.append(" " + _quote(child))
+
+        parts.append(source[node.tail_start:node.span[1]])
+
+    dump_node(tree)
+
+    # Keep text around a whole source
+    if tree.leading is not None:
+        return tree.leading + "".join(parts) + tree.trailing
+
+    string = "".join(parts)
+
+    # Dedent a subtree
+    start  = tree.span[0]
+    indent = tree.source[tree.source.rfind("\n", 0, start) + 1:start]
+    if indent and indent.isspace():
+        string = string.replace("\n" + indent, "\n")
+
+    return string
 
 # =============================================================================
 
 
 def dump(tree):
     """
-    Converts a "bracket tree" to a string representation.
+    Converts a "bracket tree" to a string representation. Trees parsed with
+    keep_source=True are dumped preserving the original formatting, see
+    dump_concrete().
     """
 
+    if tree.span is not None:
+        return dump_concrete(tree)
+
     # Convert the tree to tokens
     def node_to_tokens(node, tokens):
         tokens.append(Token(TOKEN_OPEN, "("))
@@ -259,17 +623,11 @@ def dump(tree):
             newline = False
 
         elif token.type == TOKEN_KEYWORD:
-            word = token.data
-            if "(" in word or ")" in word or " " in word or len(word) == 0:
-                word = "\"" + word + "\""
-            string += word
+            string += _quote(token.data)
             indent += 2
 
         elif token.type == TOKEN_WORD:
-            word = token.data
-            if "(" in word or ")" in word or " " in word or len(word) == 0:
-                word = "\"" + word + "\""
-            string += " " + word
+            string += " " + _quote(token.data)
 
         elif token.type == TOKEN_CLOSE:
             indent -= 2
@@ -282,6 +640,794 @@ def dump(tree):
     return string
 
 
+# =============================================================================
+
+QueryStep = namedtuple("QueryStep", "descendant keyword predicates")
+
+
+class Query(object):
+    """
+    A compiled query over a "bracket tree". The query language is a small
+    subset of XPath. Steps are separated by "/" which selects children or
+    "//" which selects all descendants. A step is a keyword or "*" for any
+    keyword, optionally followed by predicates in brackets:
+
+      [attr]        - the node has the attribute
+      [N=attr]      - the N-th attribute of the node equals to attr
+
+    For example "module/model", "//at" or "fp_text[0=reference]". Queries
+    are relative to the node they are run on, which itself is never
+    selected. Results are produced lazily in the document order. Queries
+    work both on Node trees and on FlatTree views.
+    """
+
+    STEP_RE = re.compile(r"(//|/)?([^/\[\]]+)((?:\[[^\]]*\])*)")
+    PRED_RE = re.compile(r"\[([^\]]*)\]")
+
+    def __init__(self, path):
+        self.path  = path
+        self.steps = []
+
+        pos = 0
+        while pos < len(path):
+            match = self.STEP_RE.match(path, pos)
+            if match is None or (pos > 0 and match.group(1) is None):
+                raise ValueError("Invalid query '{}'".format(path))
+
+            predicates = []
+            for pred in self.PRED_RE.findall(match.group(3)):
+                idx, sep, attr = pred.partition("=")
+                if sep:
+                    predicates.append((int(idx), attr))
+                else:
+                    predicates.append((None, pred))
+
+            self.steps.append(QueryStep(
+                descendant = match.group(1) == "//",
+                keyword    = match.group(2).strip(),
+                predicates = tuple(predicates)
+                ))
+
+            pos = match.end()
+
+        if not self.steps:
+            raise ValueError("Empty query")
+
+        # Nested descendant steps may reach the same node more than once
+        self.unique = sum(1 for s in self.steps if s.descendant) > 1
+
+    def __repr__(self):
+        return "Query('{}')".format(self.path)
+
+    @staticmethod
+    def _match(step, node):
+        if step.keyword != "*" and node.keyword != step.keyword:
+            return False
+
+        for idx, attr in step.predicates:
+            if idx is None:
+                if not node.has(attr):
+                    return False
+            else:
+                attributes = node.attributes
+                if idx >= len(attributes) or attributes[idx] != attr:
+                    return False
+
+        return True
+
+    def _apply(self, step, nodes):
+        """
+        Applies a single step to a stream of nodes.
+        """
+
+        for node in nodes:
+
+            # Children
+            if not step.descendant:
+                for child in node.child:
+                    if not isinstance(child, str) and self._match(step, child):
+                        yield child
+                continue
+
+            # Descendants, in pre-order
+            stack = [iter(node.child)]
+            while stack:
+                for child in stack[-1]:
+                    if not isinstance(child, str):
+                        if self._match(step, child):
+                            yield child
+                        stack.append(iter(child.child))
+                        break
+                else:
+                    stack.pop()
+
+    def iter(self, node, index=None):
+        """
+        Runs the query on a node, returns an iterator over matching nodes.
+        A single "//keyword" step query is served from the keyword index
+        when one is given, see index_keywords().
+        """
+
+        if index is not None and len(self.steps) == 1:
+            step = self.steps[0]
+            if step.descendant and step.keyword != "*":
+                return (n for n in index.get(step.keyword, ())
+                        if self._match(step, n))
+
+        nodes = iter((node,))
+        for step in self.steps:
+            nodes = self._apply(step, nodes)
+
+        if self.unique:
+            nodes = self._unique(nodes)
+
+        return nodes
+
+    @staticmethod
+    def _unique(nodes):
+        seen = set()
+        for node in nodes:
+            if node not in seen:
+                seen.add(node)
+                yield node
+
+    def findall(self, node, index=None):
+        """
+        Runs the query on a node, returns a list of matching nodes.
+        """
+        return list(self.iter(node, index))
+
+    def find(self, node, index=None):
+        """
+        Runs the query on a node, returns the first matching node or None.
+        """
+        return next(self.iter(node, index), None)
+
+
+@lru_cache(maxsize=256)
+def compile_query(path):
+    """
+    Compiles a query, see Query. Compiled queries are cached.
+    """
+    return Query(path)
+
+
+def select(node, path):
+    """
+    Runs a query given as a string on a node. Returns an iterator over
+    matching nodes.
+    """
+    return compile_query(path).iter(node)
+
+
+def index_keywords(root):
+    """
+    Builds a keyword index of a tree: a dict of keywords and lists of all
+    descendant nodes of the root with that keyword, in the document order.
+    The index has to be rebuilt if the tree is modified.
+    """
+
+    index = {}
+    for node in compile_query("//*").iter(root):
+        index.setdefault(node.keyword, []).append(node)
+
+    return index
+
+# =============================================================================
+
+
+class FlatTree(object):
+    """
+    A compact, read-only representation of a "bracket tree". Instead of an
+    object per node, nodes are stored as indices into parallel arrays:
+
+      keyword       - string table index of the keyword
+      parent        - parent node index, -1 for the root
+      first_child   - first child node index, -1 if none
+      next_sibling  - next sibling node index, -1 if none
+      item_start    - offset of the node children in the "items" array
+      item_count    - number of the node children
+
+    The "items" array holds children of all nodes in order. Attributes are
+    stored as string table indices, child nodes as -(index + 1). Trees
+    parsed from a source also keep node spans in it, and whether the source
+    uses escapes (see parse_concrete()). Node 0 is the root. Nodes are
+    accessed through FlatNode views.
+    """
+
+    def __init__(self, source=None, escapes=False):
+        self.source  = source
+        self.escapes = escapes
+
+        self.strings    = []
+        self.string_ids = {}
+
+        self.keyword      = array("i")
+        self.parent       = array("i")
+        self.first_child  = array("i")
+        self.next_sibling = array("i")
+        self.item_start   = array("i")
+        self.item_count   = array("i")
+        self.items        = array("i")
+
+        self.span_start = array("i")
+        self.span_end   = array("i")
+
+    def __len__(self):
+        return len(self.keyword)
+
+    @property
+    def root(self):
+        """
+        Returns a view of the root node or None for an empty tree.
+        """
+        return FlatNode(self, 0) if len(self) else None
+
+    def _intern(self, string):
+        idx = self.string_ids.get(string)
+        if idx is None:
+            idx = len(self.strings)
+            self.strings.append(string)
+            self.string_ids[string] = idx
+        return idx
+
+    def _add_node(self, keyword, parent):
+        idx = len(self.keyword)
+
+        self.keyword.append(self._intern(keyword))
+        self.parent.append(parent)
+        self.first_child.append(-1)
+        self.next_sibling.append(-1)
+        self.item_start.append(0)
+        self.item_count.append(0)
+
+        return idx
+
+    def _set_items(self, idx, items):
+        self.item_start[idx] = len(self.items)
+        self.item_count[idx] = len(items)
+        self.items.extend(items)
+
+        # Link child nodes
+        prev = -1
+        for item in items:
+            if item < 0:
+                child = -item - 1
+                if prev < 0:
+                    self.first_child[idx] = child
+                else:
+                    self.next_sibling[prev] = child
+                prev = child
+
+    @classmethod
+    def from_node(cls, root):
+        """
+        Converts a Node tree to a FlatTree.
+        """
+
+        tree = cls()
+
+        def add(node, parent):
+            idx = tree._add_node(node.keyword, parent)
+
+            items = []
+            for child in node.child:
+                if isinstance(child, str):
+                    items.append(tree._intern(child))
+                else:
+                    items.append(-add(child, idx) - 1)
+
+            tree._set_items(idx, items)
+            return idx
+
+        add(root, -1)
+        return tree
+
+
+class FlatNode(object):
+    """
+    A view of a single FlatTree node. Provides the read-only part of the
+    Node API. Views are created on demand, two views of the same node
+    compare equal.
+    """
+
+    __slots__ = ("tree", "index")
+
+    def __init__(self, tree, index):
+        self.tree  = tree
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, FlatNode) and \
+               self.tree is other.tree and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    def __repr__(self):
+        return "FlatNode({}, '{}')".format(self.index, self.keyword)
+
+    @property
+    def keyword(self):
+        return self.tree.strings[self.tree.keyword[self.index]]
+
+    @property
+    def parent(self):
+        parent = self.tree.parent[self.index]
+        return FlatNode(self.tree, parent) if parent >= 0 else None
+
+    @property
+    def span(self):
+        """
+        Returns the node span in the source or None if there is no source.
+        """
+        if self.tree.source is None:
+            return None
+        return (self.tree.span_start[self.index], self.tree.span_end[self.index])
+
+    def _items(self):
+        start = self.tree.item_start[self.index]
+        return self.tree.items[start:start + self.tree.item_count[self.index]]
+
+    @property
+    def child(self):
+        """
+        Returns all children, attributes as strings and nodes as views.
+        """
+        tree = self.tree
+        return [tree.strings[i] if i >= 0 else FlatNode(tree, -i - 1)
+                for i in self._items()]
+
+    @property
+    def children(self):
+        """
+        Returns all children nodes.
+        """
+        tree  = self.tree
+        nodes = []
+
+        idx = tree.first_child[self.index]
+        while idx >= 0:
+            nodes.append(FlatNode(tree, idx))
+            idx = tree.next_sibling[idx]
+
+        return nodes
+
+    @property
+    def attributes(self):
+        """
+        Returns all attributes.
+        """
+        strings = self.tree.strings
+        return [strings[i] for i in self._items() if i >= 0]
+
+    def findall(self, keyword):
+        """
+        Finds all child nodes with given keyword. Returns a list of them.
+        """
+        keyword_id = self.tree.string_ids.get(keyword)
+        return [c for c in self.children
+                if self.tree.keyword[c.index] == keyword_id]
+
+    def find(self, keyword):
+        """
+        Finds a first child node with given keyword. Returns None if not found.
+        """
+        res = self.findall(keyword)
+
+        if len(res) > 0:
+            return res[0]
+
+        return None
+
+    def has(self, attr):
+        """
+        Returns True if the node has the given attribute
+        """
+        return attr in self.attributes
+
+    def to_node(self, keep_source=False):
+        """
+        Converts the subtree to a Node tree. With keep_source=True the
+        subtree is parsed again from its span in the source, keeping the
+        concrete syntax information (see parse()).
+        """
+
+        if keep_source and self.tree.source is not None:
+            start, end = self.span
+            return parse_concrete(self.tree.source, start, end, self.tree.escapes)
+
+        def convert(view, parent):
+            node = Node(parent, view.keyword)
+            for child in view.child:
+                if isinstance(child, str):
+                    node.child.append(child)
+                else:
+                    node.child.append(convert(child, node))
+            return node
+
+        return convert(self, None)
+
+
+def parse_flat(data, escapes=False):
+    """
+    Parses a string representing the "bracket tree" into a FlatTree. No
+    Node objects are created. The tree keeps the source and node spans.
+    Escapes are recognized as by parse_concrete().
+    """
+
+    tree  = FlatTree(data, escapes)
+    stack = []
+
+    open_pos = None
+    token_re = ESCAPED_TOKEN_RE if escapes else CONCRETE_TOKEN_RE
+
+    for match in token_re.finditer(data):
+
+        # "(", the keyword follows
+        if match.group(1) is not None:
+            open_pos = match.start()
+            continue
+
+        # ")", close the current node
+        if match.group(2) is not None:
+            idx, items = stack.pop()
+            tree._set_items(idx, items)
+            tree.span_end[idx] = match.end()
+            continue
+
+        word = match.group(3) if match.group(3) is not None else match.group(4)
+
+        # Keyword, add a new node
+        if open_pos is not None:
+            if stack:
+                parent = stack[-1][0]
+            else:
+                assert len(tree) == 0
+                parent = -1
+
+            idx = tree._add_node(word, parent)
+            tree.span_start.append(open_pos)
+            tree.span_end.append(-1)
+
+            if stack:
+                stack[-1][1].append(-idx - 1)
+
+            stack.append((idx, []))
+            open_pos = None
+
+        # Append attributes to the current node
+        else:
+            stack[-1][1].append(tree._intern(word))
+
+    # Check
+    assert len(stack) == 0
+
+    return tree
+
+# =============================================================================
+
+# Header of a packed buffer: magic, number of trees, number of strings and
+# length of the node stream.
+PACK_HEADER = struct.Struct("<4sIII")
+PACK_MAGIC  = b"BTP1"
+
+# A placeholder for original children of a concrete node which were removed
+# from the tree. It only keeps the original children list positions.
+_REMOVED = Node(None, None)
+
+# Maps -1 to None when unpacking spans, other values to themselves
+_NEGATIVE_TO_NONE = {-1: None}
+
+
+def _pack_parts(roots):
+    """
+    Packs trees, see pack(). Returns a list of buffers to be concatenated.
+    """
+
+    strings    = []
+    string_ids = {}
+    stream     = array("i")
+
+    def intern(string):
+        idx = string_ids.get(string)
+        if idx is None:
+            idx = len(strings)
+            strings.append(string)
+            string_ids[string] = idx
+        return idx
+
+    for root in roots:
+
+        # Only the part of the source spanned by the tree is kept, from the
+        # beginning of its first line so that the tree is dedented the same
+        # way. Positions are relative to it.
+        source = root.source if root.span is not None else None
+        whole  = root.leading is not None
+        if source is None or whole:
+            base = 0
+        else:
+            base = source.rfind("\n", 0, root.span[0]) + 1
+
+        header = len(stream)
+        stream.extend((-1, int(whole)))
+
+        def add_node(node):
+            nonlocal source
+            stream.extend((intern(node.keyword), len(node.child),
+                           sum(1 for c in node.child if isinstance(c, Node))))
+
+            # A new node
+            if node.span is None:
+                stream.append(-1)
+                return
+
+            # A concrete root may hold new nodes only, their descendants
+            # refer to the whole source then.
+            if source is None:
+                source = node.source
+            elif node.source is not source:
+                raise ValueError("Can not pack a tree made of multiple sources")
+
+            stream.extend((node.span[0] - base, node.span[1] - base,
+                           node.head_end - base, node.tail_start - base,
+                           len(node.orig_child)))
+
+            # Original children refer to current ones by their position
+            positions = {id(c): i for i, c in enumerate(node.child) if isinstance(c, Node)}
+            for orig, (gap_start, start, end) in zip(node.orig_child, node.child_spans):
+                if isinstance(orig, str):
+                    ref = intern(orig)
+                else:
+                    pos = positions.get(id(orig))
+                    ref = -2 - pos if pos is not None else -1
+
+                stream.extend((ref, gap_start - base, start - base,
+                               end - base if end is not None else -1))
+
+        # Nodes in preorder, a child node is marked with -1 among the items
+        add_node(root)
+        stack = [iter(root.child)]
+        while stack:
+            for child in stack[-1]:
+                if isinstance(child, str):
+                    stream.append(intern(child))
+                else:
+                    stream.append(-1)
+                    add_node(child)
+                    stack.append(iter(child.child))
+                    break
+            else:
+                stack.pop()
+
+        if source is not None:
+            end = len(source) if whole or root.span is None else root.span[1]
+            stream[header] = intern(source[base:end])
+
+    # String table, offsets are in characters of the decoded text
+    offsets = array("I", [0])
+    total = 0
+    for string in strings:
+        total += len(string)
+        offsets.append(total)
+
+    text = "".join(strings).encode("utf-8")
+
+    if stream.itemsize != 4 or offsets.itemsize != 4:
+        raise RuntimeError("Unsupported platform integer size")
+
+    header = PACK_HEADER.pack(PACK_MAGIC, len(roots), len(strings), len(stream))
+    return [header, offsets, stream, text]
+
+
+def pack(roots):
+    """
+    Packs a list of trees into a compact binary form, see unpack(). Unlike
+    pickling it does not recurse so trees of any depth can be packed.
+
+    The buffer holds a string table of all keywords and attributes and a
+    stream of integers: for each node in preorder its keyword string index,
+    the number of its children and of its child nodes and then its
+    children, attributes as string indices and nodes as -1 followed by
+    their own records. Trees parsed
+    with keep_source=True keep the concrete syntax information, including
+    changes made since parsing, and the spanned part of their source. The
+    integers are in the machine byte order, the buffer is meant to be
+    passed between processes rather than stored.
+    """
+    return b"".join(_pack_parts(roots))
+
+
+def unpack(buffer):
+    """
+    Unpacks a list of trees from a buffer written by pack(). Any object
+    supporting the buffer protocol is accepted, eg. a shared memory block.
+    No references to the buffer are kept.
+    """
+
+    with memoryview(buffer) as view:
+        magic, count, num_strings, length = PACK_HEADER.unpack_from(view)
+        if magic != PACK_MAGIC:
+            raise ValueError("Not a packed tree")
+
+        pos = PACK_HEADER.size
+        with view[pos:pos + 4 * (num_strings + 1)].cast("I") as items:
+            offsets = items.tolist()
+        pos += 4 * (num_strings + 1)
+
+        with view[pos:pos + 4 * length].cast("i") as items:
+            stream = items.tolist()
+        pos += 4 * length
+
+        text = str(view[pos:], "utf-8")
+
+    strings = [text[offsets[i]:offsets[i + 1]] for i in range(num_strings)]
+
+    # Garbage collections triggered by the many new objects would only slow
+    # unpacking down, nothing is released meanwhile.
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _unpack_trees(stream, strings, count)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def _unpack_trees(stream, strings, count):
+    """
+    Builds trees from an unpacked stream, see pack().
+    """
+
+    string = strings.__getitem__
+    roots  = []
+    pos    = 0
+
+    for i in range(count):
+        source_id, whole = stream[pos], stream[pos + 1]
+        pos += 2
+
+        source = strings[source_id] if source_id >= 0 else None
+
+        root  = None
+        node  = None
+        stack = []
+
+        remaining  = 0
+        nodes_left = 0
+        node_refs  = None
+
+        # Nodes in preorder
+        while True:
+
+            # Read a node
+            child = Node(node, strings[stream[pos]])
+            num_children, num_nodes = stream[pos + 1], stream[pos + 2]
+            pos += 3
+
+            if stream[pos] < 0:
+                pos += 1
+                refs = None
+
+            else:
+                end   = pos + 5 + 4 * stream[pos + 4]
+                items = stream[pos + 5:end]
+                ends  = items[3::4]
+
+                child.source = source
+                child.span = (stream[pos], stream[pos + 1])
+                child.head_end = stream[pos + 2]
+                child.tail_start = stream[pos + 3]
+                child.child_spans = list(zip(items[1::4], items[2::4],
+                                             map(_NEGATIVE_TO_NONE.get, ends, ends)))
+
+                refs = items[::4]
+                pos  = end
+
+            if node is None:
+                root = child
+            else:
+                node.child.append(child)
+                stack.append((node, remaining, nodes_left, node_refs))
+
+            node, remaining, nodes_left, node_refs = child, num_children, num_nodes, refs
+
+            # Read attributes up to the next child node, marked with -1.
+            # Finish nodes whose children have all been read.
+            while True:
+                if nodes_left:
+                    stop = stream.index(-1, pos)
+                    node.child.extend(map(string, stream[pos:stop]))
+
+                    remaining  -= stop - pos + 1
+                    nodes_left -= 1
+                    pos = stop + 1
+                    break
+
+                end = pos + remaining
+                node.child.extend(map(string, stream[pos:end]))
+                pos = end
+
+                if node_refs is not None:
+                    node.orig_child = [strings[r] if r >= 0 else
+                                       node.child[-2 - r] if r < -1 else _REMOVED
+                                       for r in node_refs]
+
+                if not stack:
+                    node = None
+                    break
+
+                node, remaining, nodes_left, node_refs = stack.pop()
+
+            if node is None:
+                break
+
+        if whole:
+            root.leading  = source[:root.span[0]]
+            root.trailing = source[root.span[1]:]
+
+        roots.append(root)
+
+    return roots
+
+# .............................................................................
+
+
+def pack_shared(roots):
+    """
+    Packs a list of trees into a new shared memory block, see pack(). The
+    block is closed, it is left to the receiver to unpack it with
+    unpack_shared() which also removes it. Returns the block name and size.
+    """
+    from multiprocessing import shared_memory
+
+    parts = _pack_parts(roots)
+    size  = sum(len(memoryview(p).cast("B")) for p in parts)
+
+    block = shared_memory.SharedMemory(create=True, size=size)
+    try:
+        pos = 0
+        for part in parts:
+            with memoryview(part).cast("B") as data:
+                block.buf[pos:pos + len(data)] = data
+                pos += len(data)
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+
+    block.close()
+    return block.name, size
+
+
+def unpack_shared(name, size):
+    """
+    Unpacks trees from a shared memory block written by pack_shared(). The
+    block is removed afterwards.
+    """
+    from multiprocessing import shared_memory
+
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        with block.buf[:size] as data:
+            return unpack(data)
+    finally:
+        block.close()
+        block.unlink()
+
+
+def shared_memory_supported():
+    """
+    Returns True if packed trees can be passed in shared memory, ie. the
+    block outlives the sending process until it is removed. That is not the
+    case on Windows where a block is released when its last handle is
+    closed.
+    """
+    return os.name == "posix"
+
+# =============================================================================
+
+
 def save(file_name, tree):
     """
     Dumps a "bracket tree" tree representation to a file.
@@ -0,0 +1,598 @@
+#!/usr/bin/env python3
+"""
+Conformance, fuzz and performance checks for the bracket_tree module.
+
+Round-trips a built-in corpus of representative KiCad files, and optionally
+any files given on the command line, through all parsers and writers and
+the binary packing. Then
+fuzzes them with randomly generated trees. With --bench measures throughput
+of tokenize, parse and dump and compares it to the checked-in baseline.
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+import bracket_tree
+
+# =============================================================================
+
+CORPUS = {
+
+"board.kicad_pcb": """(kicad_pcb (version 20171130) (host pcbnew 5.1.5)
+
+  (general
+    (thickness 1.6)
+    (drawings 4)
+    (tracks 2)
+    (modules 1)
+    (nets 3)
+  )
+
+  (page A4)
+  (layers
+    (0 F.Cu signal)
+    (31 B.Cu signal)
+    (36 B.SilkS user)
+  )
+
+  (net 0 "")
+  (net 1 GND)
+  (net 2 "Net-(R1-Pad2)")
+
+  (module Resistor_SMD:R_0603_1608Metric (layer F.Cu) (tedit 5B301BBD) (tstamp 5C000001)
+    (at 100 50 90)
+    (descr "Resistor SMD 0603 (1608 Metric), square (rectangular) end terminal")
+    (fp_text reference R1 (at 0 -1.43 90) (layer F.SilkS)
+      (effects (font (size 1 1) (thickness 0.15)))
+    )
+    (fp_text value 10k (at 0 1.43 90) (layer F.Fab)
+      (effects (font (size 1 1) (thickness 0.15)))
+    )
+    (pad 1 smd roundrect (at -0.7875 0 90) (size 0.875 0.95) (layers F.Cu F.Paste F.Mask) (roundrect_rratio 0.25)
+      (net 1 GND))
+    (pad 2 smd roundrect (at 0.7875 0 90) (size 0.875 0.95) (layers F.Cu F.Paste F.Mask) (roundrect_rratio 0.25)
+      (net 2 "Net-(R1-Pad2)"))
+    (model ${KISYS3DMOD}/Resistor_SMD.3dshapes/R_0603_1608Metric.wrl
+      (at (xyz 0 0 0))
+      (scale (xyz 1 1 1))
+      (rotate (xyz 0 0 0))
+    )
+  )
+
+  (gr_text "Rev (A)" (at 120 60) (layer F.SilkS)
+    (effects (font (size 1.5 1.5) (thickness 0.3)))
+  )
+  (segment (start 100 49.2125) (end 100 45) (width 0.25) (layer F.Cu) (net 1))
+  (segment (start 100 50.7875) (end 100 55) (width 0.25) (layer F.Cu) (net 2) (tstamp 5C000003))
+
+)
+""",
+
+"footprint.kicad_mod": """(module R_0603_1608Metric (layer F.Cu) (tedit 5B301BBD)
+  (descr "Resistor SMD 0603 (1608 Metric), square (rectangular) end terminal, IPC_7351 nominal, (Body size source: http://www.tortai-tech.com/upload/download/2011102023233369053.pdf), generated with kicad-footprint-generator")
+  (tags resistor)
+  (attr smd)
+  (fp_text reference REF** (at 0 -1.43) (layer F.SilkS)
+    (effects (font (size 1 1) (thickness 0.15)))
+  )
+  (fp_text value R_0603_1608Metric (at 0 1.43) (layer F.Fab)
+    (effects (font (size 1 1) (thickness 0.15)))
+  )
+  (fp_text user %R (at 0 0) (layer F.Fab)
+    (effects (font (size 0.4 0.4) (thickness 0.06)))
+  )
+  (fp_line (start -0.8 0.4) (end -0.8 -0.4) (layer F.Fab) (width 0.1))
+  (fp_line (start -0.162779 -0.51) (end 0.162779 -0.51) (layer F.SilkS) (width 0.12))
+  (pad 1 smd roundrect (at -0.7875 0) (size 0.875 0.95) (layers F.Cu F.Paste F.Mask) (roundrect_rratio 0.25))
+  (pad 2 smd roundrect (at 0.7875 0) (size 0.875 0.95) (layers F.Cu F.Paste F.Mask) (roundrect_rratio 0.25))
+  (model ${KISYS3DMOD}/Resistor_SMD.3dshapes/R_0603_1608Metric.wrl
+    (at (xyz 0 0 0))
+    (scale (xyz 1 1 1))
+    (rotate (xyz 0 0 0))
+  )
+)
+""",
+
+"fp-lib-table": """(fp_lib_table
+  (lib (name Resistor_SMD)(type KiCad)(uri ${KISYSMOD}/Resistor_SMD.pretty)(options "")(descr "Resistor SMD"))
+  (lib (name "My Lib")(type KiCad)(uri "${HOME}/kicad libs/My Lib.pretty")(options "")(descr "A (local) library"))
+  (lib (name Legacy)(type Legacy)(uri $(KIPRJMOD)/legacy.mod)(options "")(descr ""))
+)
+""",
+
+"sym-lib-table": """(sym_lib_table
+  (lib (name Device)(type Legacy)(uri ${KICAD_SYMBOL_DIR}/Device.lib)(options "")(descr "Generic symbols"))
+  (lib (name power)(type Legacy)(uri ${KICAD_SYMBOL_DIR}/power.lib)(options "")(descr "Power symbols"))
+)
+""",
+
+"quoting.kicad_mod": """(module "Name (with) parens" (layer F.Cu)
+  (descr "")
+  (fp_text value "a b  c" (at 0 0) (layer F.Fab))
+  (fp_text user "(" (at 0 0) (layer F.Fab))
+  (fp_text user ")" (at 0 0) (layer F.Fab))
+  (fp_text user "µF Ω °C" (at 0 0) (layer F.Fab))
+  (tags "tab\tinside" "" "x")
+  ("quoted keyword" 1 2)
+)
+""",
+
+}
+
+# KiCad 6+ files, with backslash escaped quotes inside quoted strings
+ESCAPED_CORPUS = {
+
+"escapes.kicad_mod": r"""(footprint "R" (version 20211014) (generator pcbnew)
+  (layer "F.Cu")
+  (descr "Resistor, 0.1\" (2.54 mm) pitch")
+  (property "Note" "a \"quoted\" \\ word")
+  (fp_text value "10\"" (at 0 1.43) (layer "F.Fab"))
+  (fp_text user "\\" (at 0 0) (layer "F.Fab"))
+)
+""",
+
+}
+
+# =============================================================================
+
+
+def to_tuple(node):
+    """
+    Converts a tree to nested tuples for structural comparison.
+    """
+    return (node.keyword,) + tuple(
+        c if isinstance(c, str) else to_tuple(c) for c in node.child
+    )
+
+
+def check_data(name, data, errors):
+    """
+    Runs all round-trip checks on a single input. Appends error messages
+    to the list.
+    """
+
+    def fail(message):
+        errors.append("{}: {}".format(name, message))
+
+    try:
+        tree = bracket_tree.parse(data)
+    except Exception as ex:
+        fail("parse() failed: {!r}".format(ex))
+        return
+
+    expected = to_tuple(tree)
+
+    # The concrete syntax parser must give the same tree and reproduce the
+    # input exactly.
+    concrete = bracket_tree.parse(data, keep_source=True)
+    if to_tuple(concrete) != expected:
+        fail("parse(keep_source=True) gives a different tree")
+    if bracket_tree.dump(concrete) != data:
+        fail("dump() of an unmodified concrete tree differs from the input")
+
+    # The formatted output must parse back to the same tree
+    if to_tuple(bracket_tree.parse(bracket_tree.dump(tree))) != expected:
+        fail("parse(dump()) gives a different tree")
+
+    # Flat trees
+    flat = bracket_tree.parse_flat(data)
+    if to_tuple(flat.root) != expected:
+        fail("parse_flat() gives a different tree")
+    if to_tuple(flat.root.to_node()) != expected:
+        fail("FlatNode.to_node() gives a different tree")
+    if to_tuple(bracket_tree.FlatTree.from_node(tree).root) != expected:
+        fail("FlatTree.from_node() gives a different tree")
+
+    # Every subtree parsed from its span must be the same
+    for node in bracket_tree.select(flat.root, "//*"):
+        if to_tuple(node.to_node(keep_source=True)) != to_tuple(node):
+            fail("FlatNode.to_node(keep_source=True) of '{}' differs".format(
+                node.keyword))
+            break
+
+    # Packed trees, including concrete subtrees
+    check_pack(name, [tree, concrete], errors)
+
+    subtrees = [n.to_node(keep_source=True) for n in bracket_tree.select(flat.root, "*")]
+    check_pack(name, subtrees, errors)
+
+
+def check_pack(name, trees, errors):
+    """
+    Checks that trees are the same and dumped the same way after packing
+    and unpacking.
+    """
+
+    unpacked = bracket_tree.unpack(bracket_tree.pack(trees))
+    if len(unpacked) != len(trees):
+        errors.append("{}: unpack() gives {} trees instead of {}".format(
+            name, len(unpacked), len(trees)))
+        return
+
+    for tree, other in zip(trees, unpacked):
+        if to_tuple(other) != to_tuple(tree):
+            errors.append("{}: unpack(pack()) gives a different tree".format(name))
+            break
+        if bracket_tree.dump(other) != bracket_tree.dump(tree):
+            errors.append("{}: dump() of an unpacked tree differs".format(name))
+            break
+
+
+def check_escaped_data(name, data, errors):
+    """
+    Runs round-trip checks on a single input which uses escapes.
+    """
+
+    def fail(message):
+        errors.append("{}: {}".format(name, message))
+
+    try:
+        tree = bracket_tree.parse(data, escapes=True)
+    except Exception as ex:
+        fail("parse(escapes=True) failed: {!r}".format(ex))
+        return
+
+    expected = to_tuple(tree)
+
+    concrete = bracket_tree.parse(data, keep_source=True, escapes=True)
+    if to_tuple(concrete) != expected:
+        fail("parse(keep_source=True, escapes=True) gives a different tree")
+    if bracket_tree.dump(concrete) != data:
+        fail("dump() of an unmodified escaped tree differs from the input")
+
+    if to_tuple(bracket_tree.parse(bracket_tree.dump(tree), escapes=True)) != expected:
+        fail("parse(dump(), escapes=True) gives a different tree")
+
+    flat = bracket_tree.parse_flat(data, escapes=True)
+    if to_tuple(flat.root) != expected:
+        fail("parse_flat(escapes=True) gives a different tree")
+
+    for node in bracket_tree.select(flat.root, "*"):
+        if to_tuple(node.to_node(keep_source=True)) != to_tuple(node):
+            fail("FlatNode.to_node(keep_source=True) of '{}' differs".format(node.keyword))
+            break
+
+    # Modified words are dumped so that they parse back the same
+    for node in bracket_tree.select(concrete, "*"):
+        if node.attributes:
+            node.child[0] = node.attributes[0] + "x"
+    modified = to_tuple(concrete)
+    if to_tuple(bracket_tree.parse(bracket_tree.dump(concrete), escapes=True)) != modified:
+        fail("a modified escaped tree does not parse back the same")
+
+    check_pack(name, [tree, concrete], errors)
+
+# =============================================================================
+
+FUZZ_WORDS = [
+    "", " ", "(", ")", "()", "a b", "x", "0", "-1.5", "REF**", "%R",
+    "${KISYSMOD}/R.pretty", "$(HOME)", "µF", "tab\there", "new\nline",
+    "a(b", "c)d", "  ", "\\", "'",
+]
+
+
+def random_word(rng):
+    if rng.random() < 0.5:
+        return rng.choice(FUZZ_WORDS)
+
+    alphabet = "abcXYZ019_-.:/*%$~\\'"
+    if rng.random() < 0.3:
+        alphabet += " ()\t"
+
+    return "".join(rng.choice(alphabet) for i in range(rng.randint(0, 8)))
+
+
+def random_tree(rng, parent=None, depth=0):
+    """
+    Generates a random tree. Words never contain double quotes as those can
+    not be represented.
+    """
+
+    keyword = rng.choice(["module", "at", "xyz", "fp_text", "a", "b_c"])
+    if rng.random() < 0.05:
+        keyword = random_word(rng)
+
+    node = bracket_tree.Node(parent, keyword)
+
+    for i in range(rng.randint(0, 6)):
+        if depth < 6 and rng.random() < 0.4:
+            node.child.append(random_tree(rng, node, depth + 1))
+        else:
+            node.child.append(random_word(rng))
+
+    return node
+
+
+def random_formatting(rng, node):
+    """
+    Writes a tree with random whitespace and quoting.
+    """
+
+    def space():
+        return rng.choice(["", " ", "  ", "\n", "\n  ", "\t"])
+
+    def word(w):
+        if w == "" or any(c.isspace() or c in "()" for c in w) or \
+           rng.random() < 0.2:
+            return "\"" + w + "\""
+        return w
+
+    parts = ["(", space(), word(node.keyword)]
+    for child in node.child:
+        if isinstance(child, str):
+            parts.append(rng.choice([" ", "\n ", "\t"]) + word(child))
+        else:
+            parts.append(space() + random_formatting(rng, child))
+    parts.append(space() + ")")
+
+    return "".join(parts)
+
+
+def random_edit(rng, root):
+    """
+    Randomly modifies a tree in place: changes, removes or adds children.
+    """
+
+    nodes = [root] + list(bracket_tree.select(root, "//*"))
+    for i in range(rng.randint(1, 4)):
+        node = rng.choice(nodes)
+        action = rng.randint(0, 2)
+
+        if action == 0 and node.attributes:
+            node.replace(rng.choice(node.attributes), random_word(rng))
+        elif action == 1 and node.child:
+            node.child.pop(rng.randrange(len(node.child)))
+        else:
+            node.child.insert(rng.randint(0, len(node.child)),
+                              random_tree(rng, node, 5))
+
+
+def fuzz(count, seed, errors):
+    """
+    Checks randomly generated trees: their formatted and randomly
+    formatted forms as well as randomly edited concrete trees.
+    """
+
+    rng = random.Random(seed)
+
+    for i in range(count):
+        name = "fuzz #{} (seed {})".format(i, seed)
+        tree = random_tree(rng)
+
+        # Formatted by dump()
+        data = bracket_tree.dump(tree)
+        if to_tuple(bracket_tree.parse(data)) != to_tuple(tree):
+            errors.append("{}: parse(dump()) gives a different tree".format(name))
+            continue
+
+        # Randomly formatted
+        data = random_formatting(rng, tree)
+        check_data(name, data, errors)
+
+        # Edited concrete tree
+        concrete = bracket_tree.parse(data, keep_source=True)
+        random_edit(rng, concrete)
+        if to_tuple(bracket_tree.parse(bracket_tree.dump(concrete))) != \
+           to_tuple(concrete):
+            errors.append("{}: dump() of an edited concrete tree is wrong".format(name))
+
+        check_pack(name, [concrete], errors)
+
+# =============================================================================
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "bracket_tree_baseline.json")
+
+
+def make_board(modules):
+    """
+    Generates a synthetic board with the given number of modules and
+    tracks.
+    """
+
+    modules = [CORPUS["board.kicad_pcb"].split("\n  (module")[1].split("\n  (gr_text")[0]] * modules
+    tracks  = ["  (segment (start {0} 1.5) (end 2.5 {0}) (width 0.25) (layer F.Cu) (net 1) (tstamp 5C{0:06X}))\n".format(i)
+               for i in range(len(modules) * 20)]
+
+    return "(kicad_pcb (version 20171130)\n" + \
+           "".join("  (module" + m + "\n" for m in modules) + \
+           "".join(tracks) + ")\n"
+
+
+def calibrate():
+    """
+    A fixed pure Python workload. Its speed is used to normalize throughput
+    so that the baseline can be compared across machines.
+    """
+
+    tokens = []
+    for i in range(200000):
+        word = str(i)
+        if word[-1] in "05":
+            tokens.append(word)
+    return "".join(tokens)
+
+
+def run_time(func):
+    """
+    Returns the time of a single run. The garbage collector is disabled
+    meanwhile as it makes timings of the parser noisy.
+    """
+
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        func()
+        return time.perf_counter() - start
+    finally:
+        gc.enable()
+
+
+def benchmark(repeat=7):
+    """
+    Measures throughput of the parser and the writers. Returns a dict of
+    throughputs in MB/s and normalized scores. Each run of a case is paired
+    with a run of the calibration workload, the score is the median ratio
+    of their speeds. This compensates for changes of the machine speed
+    during the run.
+    """
+
+    data = make_board(200)
+    size = len(data) / 1e6
+
+    tree     = bracket_tree.parse(data)
+    concrete = bracket_tree.parse(data, keep_source=True)
+    concrete.find("module").child[0] = "Changed"
+    packed   = bracket_tree.pack([concrete])
+
+    cases = [
+        ("tokenize",            lambda: bracket_tree.tokenize(data)),
+        ("parse",               lambda: bracket_tree.parse(data)),
+        ("parse_keep_source",   lambda: bracket_tree.parse(data, keep_source=True)),
+        ("parse_flat",          lambda: bracket_tree.parse_flat(data)),
+        ("dump",                lambda: bracket_tree.dump(tree)),
+        ("dump_concrete",       lambda: bracket_tree.dump(concrete)),
+        ("pack",                lambda: bracket_tree.pack([concrete])),
+        ("unpack",              lambda: bracket_tree.unpack(packed)),
+    ]
+
+    results = {}
+    for name, func in cases:
+        times  = []
+        ratios = []
+        for i in range(repeat):
+            reference = run_time(calibrate)
+            elapsed   = run_time(func)
+
+            times.append(elapsed)
+            ratios.append(reference / elapsed)
+
+        results[name] = {
+            "mb_per_s": round(size / min(times), 3),
+            "score":    round(statistics.median(ratios), 4),
+        }
+
+    return results
+
+
+def check_benchmark(results, baseline, threshold, errors):
+    """
+    Compares normalized scores to the baseline. Scores lower by more than
+    the threshold (a fraction) are reported as regressions.
+    """
+
+    for name, result in results.items():
+        base = baseline.get(name)
+        line = "  {:<20} {:>8.2f} MB/s".format(name, result["mb_per_s"])
+
+        if base is not None:
+            change = result["score"] / base["score"] - 1.0
+            line += "  {:+.0%} vs. baseline".format(change)
+            if change < -threshold:
+                errors.append("Performance regression in {}: {:+.0%}".format(name, change))
+
+        print(line)
+
+# =============================================================================
+
+
+def main():
+
+    # Parse arguments
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument(
+        "files",
+        nargs="*",
+        help="Additional files to round-trip (.kicad_pcb, .kicad_mod, lib tables)"
+    )
+    parser.add_argument(
+        "--fuzz",
+        type=int,
+        default=500,
+        help="Number of random trees to check (def. 500)"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Fuzzer random seed (def. random)"
+    )
+    parser.add_argument(
+        "--bench",
+        action="store_true",
+        help="Run the benchmark and compare it to the baseline"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.3,
+        help="Allowed throughput regression as a fraction (def. 0.3)"
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="Run the benchmark and store the results as the new baseline"
+    )
+
+    args = parser.parse_args()
+
+    errors = []
+
+    # Corpus
+    print("Checking the corpus...")
+    for name, data in CORPUS.items():
+        check_data(name, data, errors)
+
+    for name, data in ESCAPED_CORPUS.items():
+        check_escaped_data(name, data, errors)
+
+    for file_name in args.files:
+        with open(file_name, "r") as fp:
+            check_data(file_name, fp.read(), errors)
+
+    # Fuzzing
+    seed = args.seed if args.seed is not None else random.randrange(1 << 32)
+    print("Fuzzing {} trees, seed {}...".format(args.fuzz, seed))
+    fuzz(args.fuzz, seed, errors)
+
+    # Benchmark
+    if args.bench or args.update_baseline:
+        print("Benchmarking...")
+        results = benchmark()
+
+        baseline = {}
+        if os.path.isfile(BASELINE_FILE) and not args.update_baseline:
+            with open(BASELINE_FILE, "r") as fp:
+                baseline = json.load(fp)
+
+        check_benchmark(results, baseline, args.threshold, errors)
+
+        if args.update_baseline:
+            with open(BASELINE_FILE, "w") as fp:
+                json.dump(results, fp, indent=2, sort_keys=True)
+                fp.write("\n")
+            print("Baseline written to '{}'".format(BASELINE_FILE))
+
+    # Report
+    for error in errors:
+        print(" ERROR: {}".format(error))
+
+    if errors:
+        print("{} check(s) failed.".format(len(errors)))
+        sys.exit(1)
+
+    print("All checks passed.")
+
+# =============================================================================
+
+
+if __name__ == "__main__":
+    main()
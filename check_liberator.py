@@ -0,0 +1,1176 @@
+#!/usr/bin/env python3
+"""
+Behavioural checks for the KiCad liberator.
+
+Runs small scenarios against the liberator modules in temporary directories
+and reports every expectation which does not hold.
+"""
+import io
+import json
+import os
+import pickle
+import signal
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+
+import kicad_liberator
+import symbol_lib
+from async_io import AsyncIO
+from kicad_liberator import Footprint, KiCadConfig, Library, Liberator, Symbol
+from model_store import ModelStore
+from reporting import Reporter, set_reporter
+from spill_store import SpillStore
+
+# =============================================================================
+
+FOOTPRINT = """(module {name} (layer F.Cu) (tedit {tedit})
+  (fp_text reference REF** (at 0 -1.43) (layer F.SilkS))
+  (pad 1 smd rect (at -0.8 0) (size 0.9 0.9) (layers F.Cu))
+  (model ${{LIBS}}/models/{model}
+    (at (xyz 0 0 0))
+  )
+)
+"""
+
+SYMBOL_LIB = """EESchema-LIBRARY Version 2.4
+#encoding utf-8
+#
+# R
+#
+DEF R R 0 0 N Y 1 F N
+F0 "R" 80 0 50 V V C CNN
+DRAW
+S -40 -100 40 100 0 1 10 N
+ENDDRAW
+ENDDEF
+#
+#End Library
+"""
+
+SHEET = """EESchema Schematic File Version 4
+{components}$EndSCHEMATC
+"""
+
+COMPONENT = """$Comp
+L Device:R R{n}
+F 0 "R{n}" H 1070 1046 50  0000 L CNN
+F 2 "{footprint}" V 930 1000 50  0001 C CNN
+$EndComp
+"""
+
+BOARD = """(kicad_pcb (version 20171130) (host pcbnew 5.1.5)
+{modules})
+"""
+
+MODULE = """  (module {footprint} (layer F.Cu) (tedit 5B301BBD) (tstamp 5C00000{n})
+    (at 100 100)
+    (fp_text reference R{n} (at 0 -1.43) (layer F.SilkS))
+    (model ${{LIBS}}/models/{model} (at (xyz 0 0 0)))
+  )
+"""
+
+
+def write_files(path, files):
+    """
+    Writes a dict of relative file names and their contents.
+    """
+    for name, data in files.items():
+        file_name = os.path.join(path, name)
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        with open(file_name, "w") as fp:
+            fp.write(data)
+
+
+def make_libraries(path):
+    """
+    Writes global libraries: the "Device" symbol library, the "A" footprint
+    library with "R" using "R.step", the "B" one with "R" using "B.step"
+    and the "C" one with "R" the same as in "A" but for its edit time.
+    Returns a KiCad configuration using them.
+    """
+
+    write_files(path, {
+        "device.lib":           SYMBOL_LIB,
+        "a.pretty/R.kicad_mod": FOOTPRINT.format(name="R", model="R.step", tedit="5B301BBD"),
+        "b.pretty/R.kicad_mod": FOOTPRINT.format(name="R", model="B.step", tedit="5B301BBD"),
+        "c.pretty/R.kicad_mod": FOOTPRINT.format(name="R", model="R.step", tedit="5C000000"),
+        "models/R.step":        "R" * 1000,
+        "models/B.step":        "B" * 1000,
+    })
+
+    return library_config(path)
+
+
+def library_config(path):
+    """
+    Returns a KiCad configuration using libraries written by
+    make_libraries().
+    """
+
+    return KiCadConfig(
+        env_vars       = {"LIBS": path},
+        symbol_libs    = {"Device": Library("Device", "${LIBS}/device.lib", "Legacy")},
+        footprint_libs = {"A": Library("A", "${LIBS}/a.pretty", "KiCad"),
+                          "B": Library("B", "${LIBS}/b.pretty", "KiCad"),
+                          "C": Library("C", "${LIBS}/c.pretty", "KiCad")}
+        )
+
+
+def board_data(parts):
+    """
+    Returns a legacy board with a resistor for each (footprint, model)
+    tuple.
+    """
+    return BOARD.format(modules="".join(
+        MODULE.format(n=n, footprint=f, model=m) for n, (f, m) in enumerate(parts, 1)))
+
+
+def make_project(path, parts=(("A:R", "R.step"),)):
+    """
+    Writes a legacy project with a resistor for each (footprint, model)
+    tuple.
+    """
+
+    name = os.path.basename(path)
+    write_files(path, {
+        name + ".pro":       "",
+        name + ".sch":       SHEET.format(components="".join(
+                             COMPONENT.format(n=n, footprint=f) for n, (f, m) in enumerate(parts, 1))),
+        name + ".kicad_pcb": board_data(parts),
+    })
+
+
+def quiet_reporter():
+    """
+    Sets up a process-wide reporter which prints to a string buffer.
+    """
+    reporter = Reporter(quiet=True, stream=io.StringIO())
+    set_reporter(reporter)
+    return reporter
+
+KICAD6_BOARD = """(kicad_pcb (version 20211014) (generator pcbnew)
+  (footprint "A:R" (layer "F.Cu") (tstamp 5c000001)
+    (at 100 100)
+    (fp_text value "10\\" (long)" (at 0 1.43) (layer "F.Fab"))
+    (property "Note" "a \\"quoted\\" \\\\ note")
+    (model "${LIBS}/models/R.step" (at (xyz 0 0 0)))
+  )
+)
+"""
+
+KICAD6_FOOTPRINT = """(footprint "R" (version 20211014) (generator pcbnew)
+  (layer "F.Cu")
+  (descr "Resistor, 0.1\\" (2.54 mm) pitch")
+  (fp_text reference "REF**" (at 0 -1.43) (layer "F.SilkS"))
+  (model "${LIBS}/models/R.step"
+    (at (xyz 0 0 0))
+  )
+)
+"""
+
+# =============================================================================
+
+
+def check_async_io_failure(tmp_dir, errors):
+    """
+    A failing background copy must be reported and must not leave the
+    pipeline unusable for later runs.
+    """
+
+    def slow_copy(src_file, dst_file):
+        time.sleep(0.05)
+        with open(dst_file, "w") as fp:
+            fp.write("slow")
+
+    async def copy_all():
+        await aio.run_in_background(slow_copy, None, os.path.join(tmp_dir, "a"))
+        await aio.copy_file(os.path.join(tmp_dir, "missing"),
+                            os.path.join(tmp_dir, "b"))
+        await aio.run_in_background(slow_copy, None, os.path.join(tmp_dir, "c"))
+
+    with AsyncIO(max_workers=4) as aio:
+
+        try:
+            aio.run(copy_all())
+            errors.append("async_io: a failing copy was not reported")
+        except OSError:
+            pass
+
+        if aio.pending_tasks or aio.pending_bytes:
+            errors.append("async_io: tasks left pending after a failed run")
+
+        for name in ("a", "c"):
+            if not os.path.isfile(os.path.join(tmp_dir, name)):
+                errors.append("async_io: copy '{}' not finished after a failed run".format(name))
+
+        file_name = os.path.join(tmp_dir, "d")
+        try:
+            aio.run(aio.write_file(file_name, "data"))
+        except Exception as ex:
+            errors.append("async_io: run() after a failed run raised {!r}".format(ex))
+            return
+
+        with open(file_name, "r") as fp:
+            if fp.read() != "data":
+                errors.append("async_io: write after a failed run gives wrong data")
+
+
+def check_shared_footprint_files(tmp_dir, errors):
+    """
+    Footprints of different libraries which resolve to the same file must
+    all be collected.
+    """
+
+    write_files(tmp_dir, {"R.pretty/R.kicad_mod": "(module R (layer F.Cu))\n"})
+    lib_path = os.path.join(tmp_dir, "R.pretty")
+    libs = [Library("A", lib_path), Library("B", lib_path)]
+
+    footprints = [Footprint("R", "A"), Footprint("R", "B")]
+    defs = kicad_liberator.collect_footprints_from_libraries(footprints, libs)
+
+    for footprint in footprints:
+        if defs.get(footprint) is None:
+            errors.append("collect: footprint '{}:{}' dropped".format(
+                footprint.lib, footprint.name))
+
+    if len(defs) == 2 and defs[footprints[0]] is defs[footprints[1]]:
+        errors.append("collect: footprints sharing a file share one tree")
+
+
+def check_batch_failure(tmp_dir, errors):
+    """
+    A failing project of a batch must be reported and must not affect the
+    projects liberated after it, whatever the error.
+    """
+
+    config = make_libraries(os.path.join(tmp_dir, "libs"))
+    make_project(os.path.join(tmp_dir, "p1"), [("B:R", "B.step")])
+    make_project(os.path.join(tmp_dir, "p2"))
+    make_project(os.path.join(tmp_dir, "p3"))
+
+    projects = [(os.path.join(tmp_dir, p), os.path.join(tmp_dir, "out", p))
+                for p in ("p1", "p2", "p3")]
+
+    class FailingLiberator(Liberator):
+        def scan(self, inp_path, contents=None):
+            if inp_path.endswith("p2"):
+                raise ValueError("unexpected")
+            return super().scan(inp_path, contents)
+
+    with FailingLiberator(config, reporter=quiet_reporter()) as liberator:
+
+        # The model of the first project disappears after it was indexed,
+        # so its copy fails in the background
+        model = os.path.join(tmp_dir, "libs", "models", "B.step")
+        liberator.cache.file_index.find_file(model)
+        os.remove(model)
+
+        results = [kicad_liberator.liberate_one(p, liberator) for p in projects]
+
+    if results[0] is None:
+        errors.append("batch: failing model copy not reported")
+    if results[1] is None or "ValueError" not in results[1]:
+        errors.append("batch: unexpected error not reported, got {!r}".format(results[1]))
+    if results[2] is not None:
+        errors.append("batch: project after failed ones failed: {}".format(results[2]))
+
+    out_path = projects[2][1]
+    for name in ("p3.pro", "p3.sch", "p3.kicad_pcb", "p3.lib",
+                 "footprints.pretty/R.kicad_mod", "models/R.step"):
+        if not os.path.isfile(os.path.join(out_path, name)):
+            errors.append("batch: '{}' missing after failed projects".format(name))
+
+
+def check_archives(tmp_dir, errors):
+    """
+    Projects written as archives must contain all project files. A failed
+    liberation must not leave a partial archive behind.
+    """
+
+    config = make_libraries(os.path.join(tmp_dir, "libs"))
+    make_project(os.path.join(tmp_dir, "p"))
+
+    expected = {"p.pro", "p.sch", "p.kicad_pcb", "p.lib", "sym-lib-table",
+                "fp-lib-table", "footprints.pretty/R.kicad_mod", "models/R.step"}
+
+    class FailingLiberator(Liberator):
+        def write_boards(self, project, plan, output, files=None):
+            raise ValueError("unexpected")
+
+    with Liberator(config, reporter=quiet_reporter()) as liberator:
+        for ext in (".zip", ".tar", ".tar.gz"):
+            file_name = os.path.join(tmp_dir, "p" + ext)
+            liberator.liberate(os.path.join(tmp_dir, "p"), file_name)
+
+            if ext == ".zip":
+                with zipfile.ZipFile(file_name) as archive:
+                    names = set(archive.namelist())
+                    data = archive.read("models/R.step")
+            else:
+                with tarfile.open(file_name) as archive:
+                    names = set(archive.getnames())
+                    data = archive.extractfile("models/R.step").read()
+
+            missing = expected - names
+            if missing:
+                errors.append("archive: '{}' misses {}".format(ext, sorted(missing)))
+            if data != b"R" * 1000:
+                errors.append("archive: '{}' has a wrong model".format(ext))
+
+    with FailingLiberator(config, reporter=quiet_reporter()) as liberator:
+        for ext in (".zip", ".tar.gz"):
+            file_name = os.path.join(tmp_dir, "failed" + ext)
+            try:
+                liberator.liberate(os.path.join(tmp_dir, "p"), file_name)
+                errors.append("archive: failure not raised")
+            except ValueError:
+                pass
+
+            if os.path.exists(file_name):
+                errors.append("archive: partial '{}' left behind".format(ext))
+
+
+def check_model_store(tmp_dir, errors):
+    """
+    Models of the same content must be stored once and hardlinked into all
+    projects. Stores sharing a folder must not lose each other's index
+    entries.
+    """
+
+    config = make_libraries(os.path.join(tmp_dir, "libs"))
+    with open(os.path.join(tmp_dir, "libs", "models", "B.step"), "w") as fp:
+        fp.write("R" * 1000)
+
+    make_project(os.path.join(tmp_dir, "p1"))
+    make_project(os.path.join(tmp_dir, "p2"), [("B:R", "B.step")])
+
+    store_path = os.path.join(tmp_dir, "store")
+    with Liberator(config, model_store=store_path, reporter=quiet_reporter()) as liberator:
+        for name in ("p1", "p2"):
+            liberator.liberate(os.path.join(tmp_dir, name),
+                               os.path.join(tmp_dir, "out", name))
+
+    stored = [os.path.join(d, f) for d, _, files in os.walk(store_path)
+              for f in files if f.endswith(".step")]
+    if len(stored) != 1:
+        errors.append("model store: {} stored files instead of 1".format(len(stored)))
+        return
+
+    for name, model in (("p1", "R.step"), ("p2", "B.step")):
+        file_name = os.path.join(tmp_dir, "out", name, "models", model)
+        if not os.path.isfile(file_name) or not os.path.samefile(file_name, stored[0]):
+            errors.append("model store: '{}' of '{}' is not hardlinked".format(model, name))
+
+    # Two stores saving in turn, as parallel batch workers do
+    stores = [ModelStore(store_path), ModelStore(store_path)]
+    for i, store in enumerate(stores):
+        file_name = os.path.join(tmp_dir, "model{}.step".format(i))
+        with open(file_name, "w") as fp:
+            fp.write(str(i))
+        store.add(file_name)
+
+    for store in stores:
+        store.save()
+
+    index = ModelStore(store_path).index
+    for i in range(2):
+        if os.path.abspath(os.path.join(tmp_dir, "model{}.step".format(i))) not in index:
+            errors.append("model store: index entry {} lost".format(i))
+    if len(index) != 4:
+        errors.append("model store: {} index entries instead of 4".format(len(index)))
+
+
+def check_env_var_substitution(tmp_dir, errors):
+    """
+    Substitution must follow the variables given and reuse one substituter
+    for the same variables.
+    """
+
+    env_vars = {"A": "/a", "B": "${A}/b"}
+    if kicad_liberator.substitute_env_vars("${B}/c", env_vars) != "/a/b/c":
+        errors.append("substitution: nested variable not resolved")
+
+    first = kicad_liberator._env_var_substituter(frozenset(env_vars.items()))
+    kicad_liberator.substitute_env_vars("$(A)", dict(env_vars))
+    if kicad_liberator._env_var_substituter(frozenset(env_vars.items())) is not first:
+        errors.append("substitution: substituter not reused")
+
+    env_vars["A"] = "/x"
+    if kicad_liberator.substitute_env_vars("${B}/c", env_vars) != "/x/b/c":
+        errors.append("substitution: changed variables not followed")
+
+
+def check_kicad6_escapes(tmp_dir, errors):
+    """
+    KiCad 6+ boards and footprints with escaped quotes inside strings must
+    be scanned, remapped and written back correctly.
+    """
+
+    if not kicad_liberator.uses_escapes(KICAD6_BOARD) or \
+       not kicad_liberator.uses_escapes(KICAD6_FOOTPRINT) or \
+       kicad_liberator.uses_escapes(FOOTPRINT.format(name="R", model="R.step", tedit="0")) or \
+       kicad_liberator.uses_escapes(board_data([("A:R", "R.step")])):
+        errors.append("escapes: KiCad 6+ format not told apart")
+
+    # Board scan
+    footprints, models = kicad_liberator.scan_board(KICAD6_BOARD)
+    if set(footprints) != {Footprint("R", "A")} or models != {"${LIBS}/models/R.step"}:
+        errors.append("escapes: board scan gives {} {}".format(sorted(footprints), models))
+
+    # Board remap, only the references may change
+    data = kicad_liberator.remap_board(
+        KICAD6_BOARD, {Footprint("R", "A"): Footprint("R", "new")},
+        {"${LIBS}/models/R.step": "${KIPRJMOD}/models/R.step"})
+
+    expected = KICAD6_BOARD.replace("A:R", "new:R").replace(
+        "${LIBS}/models/R.step", "${KIPRJMOD}/models/R.step")
+    if data != expected:
+        errors.append("escapes: remapped board differs:\n" + data)
+
+    # Footprint files, renamed ones are written with the escapes kept
+    write_files(tmp_dir, {"R.kicad_mod": KICAD6_FOOTPRINT})
+    trees, info = kicad_liberator.parse_footprint_file(os.path.join(tmp_dir, "R.kicad_mod"))
+    root = trees[0]
+
+    if root.find("descr").attributes[0] != 'Resistor, 0.1\\" (2.54 mm) pitch':
+        errors.append("escapes: footprint parsed wrong")
+
+    root.child[0] = "R_new"
+    root.find("descr").child[0] = 'A\\"B'
+    data = kicad_liberator.dump_footprint(root)
+    other = kicad_liberator.load_footprint(data.encode("utf-8"))
+    if other.child[0] != "R_new" or other.find("descr").attributes[0] != 'A\\"B':
+        errors.append("escapes: written footprint reads back wrong:\n" + data)
+
+
+def check_verify(tmp_dir, errors):
+    """
+    A liberated project must verify clean. Missing footprints and models
+    and references to files outside of the project must be reported.
+    """
+
+    config = make_libraries(os.path.join(tmp_dir, "libs"))
+    make_project(os.path.join(tmp_dir, "p"))
+
+    out_path = os.path.join(tmp_dir, "out")
+    reporter = quiet_reporter()
+    with Liberator(config, reporter=reporter) as liberator:
+        liberator.liberate(os.path.join(tmp_dir, "p"), out_path)
+
+    problems = kicad_liberator.verify_project(out_path, reporter)
+    if problems:
+        errors.append("verify: liberated project has problems: {}".format(problems))
+
+    def expect(what, text):
+        problems = kicad_liberator.verify_project(out_path, reporter)
+        if not any(text in p for p in problems):
+            errors.append("verify: {} not reported, got {}".format(what, problems))
+
+    # Missing footprint
+    os.rename(os.path.join(out_path, "footprints.pretty", "R.kicad_mod"),
+              os.path.join(tmp_dir, "R.kicad_mod"))
+    expect("missing footprint", "Footprint 'p:R' not found in 'footprints.pretty'")
+    os.rename(os.path.join(tmp_dir, "R.kicad_mod"),
+              os.path.join(out_path, "footprints.pretty", "R.kicad_mod"))
+
+    # Missing model
+    os.remove(os.path.join(out_path, "models", "R.step"))
+    expect("missing model", "Model '${KIPRJMOD}/models/R.step' not found")
+
+    # Model outside of the project
+    board_file = os.path.join(out_path, "p.kicad_pcb")
+    with open(board_file, "r") as fp:
+        data = fp.read()
+    with open(board_file, "w") as fp:
+        fp.write(data.replace("${KIPRJMOD}/models/R.step", "${LIBS}/models/R.step"))
+    expect("model outside", "refers to a file outside of the project")
+
+
+def check_footprint_dedup(tmp_dir, errors):
+    """
+    Footprints of different libraries which only differ in their edit time
+    must be written once, footprints with other models must not.
+    """
+
+    config = make_libraries(os.path.join(tmp_dir, "libs"))
+    make_project(os.path.join(tmp_dir, "p"), [("A:R", "R.step"), ("C:R", "R.step"),
+                                             ("B:R", "B.step")])
+
+    with Liberator(config, reporter=quiet_reporter()) as liberator:
+        files = liberator.liberate(os.path.join(tmp_dir, "p")).files
+
+    footprints = sorted(f for f in files if f.startswith("footprints.pretty/"))
+    if len(footprints) != 2:
+        errors.append("dedup: footprints written: {}".format(footprints))
+
+    board = files.get("p.kicad_pcb", "")
+    if board.count("(module p:R ") != 2 or board.count("(module p:R_01 ") != 1:
+        errors.append("dedup: board not remapped to the merged footprints")
+
+
+def liberate_in_memory(config, inp_path, **kwargs):
+    """
+    Liberates a project with the given Liberator options, returns the
+    files written and the Liberator, which is closed.
+    """
+
+    with Liberator(config, reporter=quiet_reporter(), **kwargs) as liberator:
+        files = liberator.liberate(inp_path).files
+
+    return files, liberator
+
+
+def check_spill(tmp_dir, errors):
+    """
+    A project liberated with footprints spilled to disk must be the same as
+    one liberated in memory. The store file must be removed afterwards.
+    """
+
+    config = make_libraries(os.path.join(tmp_dir, "libs"))
+    make_project(os.path.join(tmp_dir, "p"), [("A:R", "R.step"), ("B:R", "B.step")])
+    inp_path = os.path.join(tmp_dir, "p")
+
+    expected, _ = liberate_in_memory(config, inp_path)
+
+    # Keep the store file where it can be looked for
+    spill_path = os.path.join(tmp_dir, "spill")
+    os.makedirs(spill_path)
+    tempfile.tempdir = spill_path
+    try:
+        files, liberator = liberate_in_memory(config, inp_path, memory_budget=0)
+    finally:
+        tempfile.tempdir = None
+
+    if files != expected:
+        errors.append("spill: output differs from an in-memory run")
+
+    store = liberator.spill_store
+    if not store.spilled_items or not store.loaded_items:
+        errors.append("spill: {} items spilled, {} loaded back".format(
+            store.spilled_items, store.loaded_items))
+
+    if store.db is not None or os.listdir(spill_path):
+        errors.append("spill: store not closed or its file left behind")
+
+    # Cached footprints are copied for modification, unless they are
+    # spilled and each access loads a new tree
+    data = FOOTPRINT.format(name="R", model="R.step", tedit="0").encode("utf-8")
+    root = kicad_liberator.load_footprint(data)
+
+    deepcopy = kicad_liberator.deepcopy
+    copies = []
+    kicad_liberator.deepcopy = lambda value: copies.append(value) or deepcopy(value)
+    try:
+        with SpillStore(0) as store:
+            cache = kicad_liberator.LibraryCache(store)
+            cache.footprints["R"] = root
+            if cache.footprint_copy("R") is root or copies:
+                errors.append("spill: spilled footprint not loaded or copied again")
+
+        cache = kicad_liberator.LibraryCache()
+        cache.footprints["R"] = root
+        if cache.footprint_copy("R") is root or len(copies) != 1:
+            errors.append("spill: in-memory footprint not copied")
+    finally:
+        kicad_liberator.deepcopy = deepcopy
+
+
+def shared_memory_blocks():
+    """
+    Returns names of the shared memory blocks of the system, an empty set
+    where they can not be listed.
+    """
+    if not os.path.isdir("/dev/shm"):
+        return set()
+    return {f for f in os.listdir("/dev/shm") if f.startswith("psm_")}
+
+
+def check_parse_pool(tmp_dir, errors):
+    """
+    A project liberated with a parse pool must be the same as one liberated
+    sequentially. Shared memory blocks of results, received or not, must be
+    removed.
+    """
+
+    config = make_libraries(os.path.join(tmp_dir, "libs"))
+    make_project(os.path.join(tmp_dir, "p"), [("A:R", "R.step"), ("B:R", "B.step")])
+    inp_path = os.path.join(tmp_dir, "p")
+
+    blocks = shared_memory_blocks()
+
+    expected, _ = liberate_in_memory(config, inp_path)
+    files, _ = liberate_in_memory(config, inp_path, parse_jobs=2)
+
+    if files != expected:
+        errors.append("parse pool: output differs from a sequential run")
+
+    # Results left when the caller stops early
+    from parse_pool import ParsePool
+    data = board_data([("A:R", "R.step")])
+    with ParsePool(2) as pool:
+        results = pool.map(kicad_liberator.scan_board_spans, [data] * 4)
+        next(results)
+        results.close()
+
+    leaked = shared_memory_blocks() - blocks
+    if leaked:
+        errors.append("parse pool: shared memory blocks left: {}".format(sorted(leaked)))
+
+
+def check_watch(tmp_dir, errors):
+    """
+    A footprint added to a library while watching must be found by the
+    next pass after it was reported missing.
+    """
+
+    libs_path = os.path.join(tmp_dir, "libs")
+    inp_path  = os.path.join(tmp_dir, "p")
+    out_path  = os.path.join(tmp_dir, "out")
+
+    make_libraries(libs_path)
+    make_project(inp_path, [("A:R", "R.step"), ("A:X", "R.step")])
+
+    script = "import sys, check_liberator, kicad_liberator\n" \
+             "kicad_liberator.watch_project(sys.argv[1], sys.argv[2], " \
+             "check_liberator.library_config(sys.argv[3]), interval=0.05)\n"
+
+    def wait_for(file_name, text, timeout=20.0):
+        end = time.monotonic() + timeout
+        while time.monotonic() < end:
+            try:
+                with open(file_name, "r") as fp:
+                    if text in fp.read():
+                        return True
+            except OSError:
+                pass
+            time.sleep(0.05)
+        return False
+
+    proc = subprocess.Popen([sys.executable, "-c", script, inp_path, out_path, libs_path],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        # Taken from the PCB first
+        fp_file = os.path.join(out_path, "footprints.pretty", "X.kicad_mod")
+        if not wait_for(fp_file, "(module X "):
+            errors.append("watch: project not liberated")
+            return
+
+        write_files(libs_path, {"a.pretty/X.kicad_mod":
+                                FOOTPRINT.format(name="X", model="B.step", tedit="5D000000")})
+        make_project(inp_path, [("A:R", "R.step"), ("A:X", "R.step")])
+
+        if not wait_for(fp_file, "5D000000"):
+            errors.append("watch: footprint added to a library not found")
+
+    finally:
+        proc.send_signal(signal.SIGINT)
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+def check_update(tmp_dir, errors):
+    """
+    A project updated incrementally after its sheet and board changed must
+    be the same as one liberated from scratch, including footprints and
+    models no longer used being removed.
+    """
+
+    from outputs import MemoryOutput
+
+    config = make_libraries(os.path.join(tmp_dir, "libs"))
+    inp_path = os.path.join(tmp_dir, "p")
+    make_project(inp_path)
+
+    output = MemoryOutput()
+    with Liberator(config, reporter=quiet_reporter()) as liberator:
+        project = liberator.scan(inp_path)
+        plan = liberator.plan(project)
+        liberator.write(project, plan, output)
+
+        # A part added, then the first one removed which renames the other
+        for parts in ([("A:R", "R.step"), ("B:R", "B.step")], [("B:R", "B.step")]):
+            make_project(inp_path, parts)
+            plan = liberator.update(project, plan, output, ["p.sch", "p.kicad_pcb"])
+
+            expected, _ = liberate_in_memory(config, inp_path)
+            if output.files != expected:
+                errors.append("update: output differs from a full run for {}: {}".format(
+                    parts, sorted(f for f in set(output.files) | set(expected)
+                                  if output.files.get(f) != expected.get(f))))
+
+
+def check_name_allocator(tmp_dir, errors):
+    """
+    Names taken get "_NN" suffixes in the order of allocation, skipping
+    those taken already. Maps assign them in the order of libraries and
+    names, whatever the order of the items.
+    """
+
+    allocator = kicad_liberator.NameAllocator()
+    names = [allocator.allocate(n) for n in ("R", "R_02", "R", "R", "R")]
+    names += [allocator.allocate("m", ".step") for i in range(2)]
+
+    expected = ["R", "R_02", "R_01", "R_03", "R_04", "m.step", "m_01.step"]
+    if names != expected:
+        errors.append("names: allocated {}".format(names))
+
+    symbols = [kicad_liberator.Symbol("R", lib) for lib in ("B", "C", "A")]
+    for order in (symbols, symbols[::-1]):
+        symbol_map = kicad_liberator.build_symbol_map(order, "p")
+        names = [symbol_map[kicad_liberator.Symbol("R", lib)].name for lib in "ABC"]
+        if names != ["R", "R_01", "R_02"]:
+            errors.append("names: symbols of A, B and C named {}".format(names))
+
+    models = ["/x/R.step", "/a/R.step"]
+    for order in (models, models[::-1]):
+        model_map = kicad_liberator.build_model_map(order, "${KIPRJMOD}/models")
+        if model_map != {"/a/R.step": "${KIPRJMOD}/models/R.step",
+                         "/x/R.step": "${KIPRJMOD}/models/R_01.step"}:
+            errors.append("names: models mapped {}".format(model_map))
+
+
+def check_file_index(tmp_dir, errors):
+    """
+    Files are found by their exact names, then case insensitively, with
+    their sizes. Directories are listed once, files added later are seen
+    only after the index is refreshed.
+    """
+
+    write_files(tmp_dir, {"lib.pretty/Res.kicad_mod": "R" * 10})
+    lib_path  = os.path.join(tmp_dir, "lib.pretty")
+    file_name = os.path.join(lib_path, "Res.kicad_mod")
+
+    cache = kicad_liberator.LibraryCache()
+    index = cache.file_index
+
+    for name in ("Res.kicad_mod", "res.KICAD_MOD"):
+        if index.find(lib_path, name) != file_name:
+            errors.append("file index: '{}' not found".format(name))
+
+    if index.find_file(os.path.join(tmp_dir, "none", "R.kicad_mod")) is not None or \
+       index.find(lib_path, "C.kicad_mod") is not None:
+        errors.append("file index: missing file found")
+
+    if index.size(file_name) != 10:
+        errors.append("file index: size {} instead of 10".format(index.size(file_name)))
+
+    # Added after the directory was listed
+    write_files(lib_path, {"C.kicad_mod": ""})
+    if index.find(lib_path, "C.kicad_mod") is not None:
+        errors.append("file index: directory listed again")
+
+    cache.refresh_files()
+    if cache.file_index.find(lib_path, "C.kicad_mod") is None:
+        errors.append("file index: added file not found after a refresh")
+
+
+def check_plan(tmp_dir, errors):
+    """
+    The --plan JSON must tell apart items found in libraries, taken from
+    the project and missing, with their sources, sizes and new names,
+    without writing anything.
+    """
+
+    config = make_libraries(os.path.join(tmp_dir, "libs"))
+    inp_path = os.path.join(tmp_dir, "p")
+    make_project(inp_path, [("A:R", "R.step"), ("B:R", "B.step"), ("A:X", "X.step")])
+
+    sch_file = os.path.join(inp_path, "p.sch")
+    with open(sch_file, "r") as fp:
+        data = fp.read()
+    with open(sch_file, "w") as fp:
+        fp.write(data.replace("L Device:R R2", "L Device:Missing R2")
+                     .replace("L Device:R R3", "L Nope:R R3"))
+
+    with Liberator(config, reporter=quiet_reporter()) as liberator:
+        project = liberator.scan(inp_path)
+        plan = json.loads(json.dumps(liberator.resolve(project, liberator.plan(project))))
+
+    libs_path = os.path.join(tmp_dir, "libs")
+
+    def check(key, expected):
+        entries = [(e.get("lib"), e["name"], e["new_name"], e["status"],
+                    e["source"] and os.path.relpath(e["source"], libs_path), e["size"])
+                   for e in plan[key]]
+        if sorted(entries, key=str) != sorted(expected, key=str):
+            errors.append("plan: {} are {}".format(key, entries))
+
+    check("symbols", [
+        ("Device", "Missing", "Missing", "missing", None, None),
+        ("Device", "R", "R", "library", "device.lib", len(SYMBOL_LIB)),
+        ("Nope", "R", "R_01", "missing_library", None, None),
+    ])
+
+    fp_size = os.path.getsize(os.path.join(libs_path, "a.pretty", "R.kicad_mod"))
+    check("footprints", [
+        ("A", "R", "R", "library", os.path.join("a.pretty", "R.kicad_mod"), fp_size),
+        ("A", "X", "X", "pcb", None, None),
+        ("B", "R", "R_01", "library", os.path.join("b.pretty", "R.kicad_mod"), fp_size),
+    ])
+
+    check("models", [
+        (None, "${LIBS}/models/B.step", "${KIPRJMOD}/models/B.step", "library",
+         os.path.join("models", "B.step"), 1000),
+        (None, "${LIBS}/models/R.step", "${KIPRJMOD}/models/R.step", "library",
+         os.path.join("models", "R.step"), 1000),
+        (None, "${LIBS}/models/X.step", "${KIPRJMOD}/models/X.step", "missing", None, None),
+    ])
+
+    summary = plan["summary"]
+    expected = {"symbols": 3, "unresolved_symbols": 2, "symbols_size": len(SYMBOL_LIB),
+                "footprints": 3, "unresolved_footprints": 0, "footprints_size": 2 * fp_size,
+                "models": 3, "unresolved_models": 1, "models_size": 2000}
+    if summary != expected:
+        errors.append("plan: summary is {}".format(summary))
+
+    if sorted(os.listdir(tmp_dir)) != ["libs", "p"]:
+        errors.append("plan: files written: {}".format(os.listdir(tmp_dir)))
+
+
+def check_lib_tables(tmp_dir, errors):
+    """
+    Library tables must be read in order with all fields, by the fast reader
+    and by the generic parser it falls back to. Project libraries must
+    override global ones of the same name.
+    """
+
+    table = """(fp_lib_table
+  (lib (name A)(type KiCad)(uri ${LIBS}/a.pretty)(options "")(descr "Lib (a)"))
+  (lib (name "B B")(type Legacy)(uri "/b b.mod")(options "x=1")(descr ""))
+  (lib (name C)(type Github)(uri https://c)(options "")(descr ""))
+)
+"""
+    expected = {
+        "A":   Library("A", "${LIBS}/a.pretty", "KiCad", "", "Lib (a)"),
+        "B B": Library("B B", "/b b.mod", "Legacy", "x=1", ""),
+    }
+
+    quiet_reporter()
+    for name, libs in (("fast", kicad_liberator.parse_lib_table(table)),
+                       ("tree", kicad_liberator._parse_lib_table_tree(table))):
+        if libs != expected or list(libs) != list(expected):
+            errors.append("lib tables: {} reader gives {}".format(name, libs))
+
+    # Not a flat entry, read by the generic parser
+    nested = table.replace("(descr \"\"))\n  (lib (name C)",
+                           "(descr \"\") (extra (a b)))\n  (lib (name C)")
+    if kicad_liberator.parse_lib_table(nested) != expected:
+        errors.append("lib tables: no fallback for a nested entry")
+
+    # Project libraries
+    config = make_libraries(os.path.join(tmp_dir, "libs"))
+    inp_path = os.path.join(tmp_dir, "p")
+    make_project(inp_path, [("A:R", "R.step"), ("B:R", "B.step")])
+    write_files(inp_path, {
+        "fp-lib-table": "(fp_lib_table\n"
+                        "  (lib (name A)(type KiCad)(uri ${KIPRJMOD}/a.pretty))\n"
+                        ")\n",
+        "a.pretty/R.kicad_mod": FOOTPRINT.format(name="R", model="B.step", tedit="0"),
+    })
+
+    with Liberator(config, reporter=quiet_reporter()) as liberator:
+        project = liberator.scan(inp_path)
+
+    libs = project.footprint_libs
+    if libs.filename("A") != os.path.join(inp_path, "a.pretty") or \
+       libs.filename("B") != os.path.join(tmp_dir, "libs", "b.pretty"):
+        errors.append("lib tables: project libraries resolved to {} and {}".format(
+            libs.filename("A"), libs.filename("B")))
+
+
+def check_referenced_libraries(tmp_dir, errors):
+    """
+    Only libraries referenced by a project may be resolved and listed, no
+    matter how many the global tables hold.
+    """
+
+    config = make_libraries(os.path.join(tmp_dir, "libs"))
+    for i in range(200):
+        name = "Unused{}".format(i)
+        config.symbol_libs[name] = Library(name, "${NONE}/unused.lib", "Legacy")
+        config.footprint_libs[name] = Library(name, "${NONE}/unused.pretty", "KiCad")
+
+    inp_path = os.path.join(tmp_dir, "p")
+    make_project(inp_path)
+
+    with Liberator(config, reporter=quiet_reporter()) as liberator:
+        project = liberator.scan(inp_path)
+        liberator.plan(project)
+
+    resolved = set(project.symbol_libs.resolved) | set(project.footprint_libs.resolved)
+    if resolved != {"Device", "A"}:
+        errors.append("libraries: resolved {}".format(sorted(resolved)))
+
+    listed = {os.path.relpath(d, tmp_dir) for d in liberator.cache.file_index.dirs}
+    if listed != {os.path.join("libs", "a.pretty")}:
+        errors.append("libraries: listed {}".format(sorted(listed)))
+
+
+def check_reporter_log(tmp_dir, errors):
+    """
+    Every event must be logged as one JSON line with its level, context,
+    phase and item fields. In quiet mode only warnings and errors are
+    printed. A log given by its file name is appended to.
+    """
+
+    log_file = os.path.join(tmp_dir, "log.jsonl")
+
+    for run in range(2):
+        stream = io.StringIO()
+        with Reporter(log_file, quiet=True, stream=stream) as reporter:
+            reporter.context["project"] = "p"
+            reporter.info("Hello")
+            reporter.begin("load", "Loading...", total=2)
+            reporter.item("a", 10, duration=0.5, message=" a")
+            reporter.item("b", 5)
+            reporter.timing("lib", "a.lib", 0.25, 100)
+            reporter.warning("Careful", "b")
+            reporter.error("Failed", "c")
+            reporter.end()
+
+    if stream.getvalue() != "WARNING: Careful\n ERROR: Failed\n":
+        errors.append("reporter: printed {!r}".format(stream.getvalue()))
+
+    with open(log_file, "r") as fp:
+        lines = fp.read().splitlines()
+
+    records = [json.loads(line) for line in lines]
+    if len(records) != 18:
+        errors.append("reporter: {} log lines instead of 18".format(len(records)))
+        return
+
+    fields = [{k: v for k, v in r.items() if k not in ("time", "pid")} for r in records[:9]]
+    expected = [
+        {"level": "info", "event": "message", "project": "p", "message": "Hello"},
+        {"level": "info", "event": "message", "project": "p", "message": "Loading..."},
+        {"level": "info", "event": "begin", "project": "p", "phase": "load", "total": 2},
+        {"level": "info", "event": "item", "project": "p", "phase": "load", "item": "a",
+         "duration": 0.5, "bytes": 10},
+        None,
+        {"level": "info", "event": "lib", "project": "p", "phase": "load", "item": "a.lib",
+         "duration": 0.25, "bytes": 100},
+        {"level": "warning", "event": "message", "project": "p", "phase": "load",
+         "item": "b", "message": "Careful"},
+        {"level": "error", "event": "message", "project": "p", "phase": "load",
+         "item": "c", "message": "Failed"},
+        None,
+    ]
+
+    for record, exp in zip(fields, expected):
+        if exp is not None and record != exp:
+            errors.append("reporter: logged {}".format(record))
+
+    item, end = fields[4], fields[8]
+    if item.get("item") != "b" or item.get("bytes") != 5 or "duration" not in item:
+        errors.append("reporter: logged {}".format(item))
+    if end.get("event") != "end" or end.get("items") != 2 or end.get("bytes") != 15:
+        errors.append("reporter: logged {}".format(end))
+
+    if any(r.get("pid") != os.getpid() for r in records) or reporter.errors != 1:
+        errors.append("reporter: wrong pid or error count")
+
+
+def check_symbol_lib(tmp_dir, errors):
+    """
+    Legacy symbol libraries must be parsed into records indexed by names
+    and aliases, with bodies read by their spans. Formatting a record must
+    give back its definition, renamed where asked.
+    """
+
+    from outputs import MemoryOutput
+
+    definition = [
+        "DEF R R 0 0 N Y 1 F N",
+        "F0 \"R\" 80 0 50 V V C CNN",
+        "F1 \"R\" 0 0 50 V V C CNN",
+        "ALIAS R_Small R_US",
+        "$FPLIST",
+        " R_*",
+        "$ENDFPLIST",
+        "DRAW",
+        "S -40 -100 40 100 0 1 10 N",
+        "ENDDRAW",
+        "ENDDEF",
+    ]
+    data = "EESchema-LIBRARY Version 2.4\n#encoding utf-8\n#\n# R\n#\n" + \
+           "\n".join(definition) + "\n#\n#End Library\n"
+    write_files(tmp_dir, {"device.lib": data})
+    lib_file = os.path.join(tmp_dir, "device.lib")
+
+    index = symbol_lib.load(lib_file)
+    if sorted(index) != ["R", "R_Small", "R_US"] or \
+       index["R_Small"] is not index["R"] or index["R_US"] is not index["R"]:
+        errors.append("symbol lib: indexed {}".format(sorted(index)))
+        return
+
+    record = index["R"]
+    if record.aliases != ("R_Small", "R_US") or record.alias_lines != (("R_Small", "R_US"),) or \
+       record.def_fields != ("R", "0", "0", "N", "Y", "1", "F", "N") or \
+       record.fields != tuple(definition[1:3]):
+        errors.append("symbol lib: parsed {}".format(record))
+
+    if pickle.loads(pickle.dumps(record)) != record:
+        errors.append("symbol lib: record does not pickle")
+
+    with open(lib_file, "rb") as fp:
+        body = symbol_lib.read_body(fp, record)
+    if body.splitlines() != definition[4:]:
+        errors.append("symbol lib: body read {!r}".format(body))
+
+    # Formatting, as it is and renamed by the name or an alias. Lines are
+    # written stripped.
+    for name, new_name, changes in (
+        ("R",       None,    {}),
+        ("R",       "R_01",  {0: "DEF R_01 R 0 0 N Y 1 F N"}),
+        ("R_Small", "Small", {3: "ALIAS Small R_US"})):
+
+        expected = [l.strip() for l in definition]
+        for i, line in changes.items():
+            expected[i] = line
+        expected = ["#", "# {}".format(new_name or name), "#"] + expected
+
+        lines = symbol_lib.format_symbol(record, body, name, new_name)
+        if lines != expected:
+            errors.append("symbol lib: {} formatted as {}".format(name, lines))
+
+    # Written libraries read back the same
+    output = MemoryOutput()
+    kicad_liberator.write_symbol_lib(
+        output, "p.lib", {Symbol("R", "Device"): Symbol("R_01", "p")},
+        [Library("Device", lib_file, "Legacy")], reporter=quiet_reporter())
+
+    fp = io.BytesIO(output.files["p.lib"].encode("utf-8"))
+    written = symbol_lib.parse(fp)
+    if [s._replace(body=None) for s in written] != \
+       [record._replace(name="R_01", body=None)] or \
+       symbol_lib.read_body(fp, written[0]).splitlines() != [l.strip() for l in definition[4:]]:
+        errors.append("symbol lib: written library reads back {}".format(written))
+
+
+def check_config_snapshot(tmp_dir, errors):
+    """
+    The global configuration must be taken from its snapshot while the
+    configuration files are unchanged, and loaded again after any of them
+    changes.
+    """
+
+    kicad_dir = os.path.join(tmp_dir, "kicad")
+    write_files(kicad_dir, {
+        "kicad_common":  "[EnvironmentVariables]\nLIBS=/libs\n",
+        "sym-lib-table": "(sym_lib_table\n"
+                         "  (lib (name Device)(type Legacy)(uri ${LIBS}/device.lib))\n)\n",
+        "fp-lib-table":  "(fp_lib_table\n"
+                         "  (lib (name A)(type KiCad)(uri ${LIBS}/a.pretty))\n)\n",
+    })
+
+    loads = []
+    functions = {}
+    for name in ("load_kicad_env_vars", "load_lib_table"):
+        function = functions[name] = getattr(kicad_liberator, name)
+        setattr(kicad_liberator, name,
+                lambda file_name, function=function: loads.append(file_name) or function(file_name))
+
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    os.environ["XDG_CACHE_HOME"] = os.path.join(tmp_dir, "cache")
+    try:
+        config = kicad_liberator.load_kicad_config(kicad_dir)
+        expected = KiCadConfig(
+            env_vars       = {"LIBS": "/libs"},
+            symbol_libs    = {"Device": Library("Device", "${LIBS}/device.lib", "Legacy")},
+            footprint_libs = {"A": Library("A", "${LIBS}/a.pretty", "KiCad")})
+
+        if config != expected or len(loads) != 3:
+            errors.append("config: loaded {} from {} files".format(config, len(loads)))
+
+        del loads[:]
+        if kicad_liberator.load_kicad_config(kicad_dir) != expected or loads:
+            errors.append("config: snapshot not used")
+
+        # Each file invalidates the snapshot
+        for file_name in kicad_liberator.KICAD_CONFIG_FILES:
+            file_name = os.path.join(kicad_dir, file_name)
+            st = os.stat(file_name)
+            os.utime(file_name, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+
+            del loads[:]
+            if kicad_liberator.load_kicad_config(kicad_dir) != expected or len(loads) != 3:
+                errors.append("config: snapshot used after '{}' changed".format(
+                    os.path.basename(file_name)))
+
+        # A changed table is seen
+        write_files(kicad_dir, {"fp-lib-table": "(fp_lib_table\n)\n"})
+        if kicad_liberator.load_kicad_config(kicad_dir).footprint_libs != {}:
+            errors.append("config: changed table not loaded")
+
+    finally:
+        if cache_home is None:
+            del os.environ["XDG_CACHE_HOME"]
+        else:
+            os.environ["XDG_CACHE_HOME"] = cache_home
+
+        for name, function in functions.items():
+            setattr(kicad_liberator, name, function)
+
+
+CHECKS = [
+    check_env_var_substitution,
+    check_async_io_failure,
+    check_kicad6_escapes,
+    check_shared_footprint_files,
+    check_batch_failure,
+    check_archives,
+    check_model_store,
+    check_verify,
+    check_footprint_dedup,
+    check_spill,
+    check_parse_pool,
+    check_update,
+    check_watch,
+    check_name_allocator,
+    check_file_index,
+    check_plan,
+    check_lib_tables,
+    check_referenced_libraries,
+    check_reporter_log,
+    check_symbol_lib,
+    check_config_snapshot,
+]
+
+# =============================================================================
+
+
+def main():
+
+    errors = []
+
+    for check in CHECKS:
+        print("Running {}...".format(check.__name__))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            try:
+                check(tmp_dir, errors)
+            except Exception as ex:
+                errors.append("{}: raised {!r}".format(check.__name__, ex))
+
+    # Report
+    for error in errors:
+        print(" ERROR: {}".format(error))
+
+    if errors:
+        print("{} check(s) failed.".format(len(errors)))
+        sys.exit(1)
+
+    print("All checks passed.")
+
+# =============================================================================
+
+
+if __name__ == "__main__":
+    main()
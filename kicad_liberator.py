@@ -6,31 +6,148 @@ A python script that allows to "liberate" a KiCad project making it
 independed from any locally installed libraries. Such a project can
 then be opened on any system.
 """
-import argparse
-import configparser
+import functools
+import json
 import os
-from shutil import copy
+import re
+import sys
+import time
+from copy import deepcopy
 import shlex
 
-from collections import namedtuple, defaultdict
+# Modules which are slow to import and needed only on some code paths
+# (argparse, asyncio through async_io, hashlib, configparser,
+# multiprocessing, zipfile, sqlite3, ...) are imported where they are used,
+# so that importing this module as a library stays cheap.
+
+from collections import namedtuple, defaultdict, ChainMap
+from collections.abc import Mapping
 
 import bracket_tree
+import symbol_lib
+from reporting import Reporter, get_reporter, set_reporter
 
 # =============================================================================
 
 Symbol = namedtuple("Symbol", "name lib")
 Footprint = namedtuple("Footprint", "name lib")
-Library = namedtuple("Library", "name filename")
+Library = namedtuple("Library", "name filename type options descr",
+                     defaults=(None, "", ""))
+KiCadConfig = namedtuple("KiCadConfig", "env_vars symbol_libs footprint_libs")
+
+# Footprint node keywords, KiCad 6+ uses "footprint" instead of "module"
+FOOTPRINT_KEYWORDS = ("module", "footprint")
+
+# Boards and footprints of at least this version are in the KiCad 6+ format,
+# which escapes quotes inside quoted strings. KiCad 5 boards are older and
+# KiCad 5 footprints have no version.
+ESCAPES_VERSION = 20200000
 
 # =============================================================================
 
 
-class CaseConfigParser(configparser.ConfigParser):
+class NameAllocator(object):
+    """
+    Allocates unique names. When a name is already taken a "_NN" suffix is
+    appended to it. Keeps a per-base-name counter so that allocating many
+    identical names does not require probing all the previous suffixes.
+    """
+
+    def __init__(self):
+        self.used_names = set()
+        self.counters   = {}
+
+    def allocate(self, name, ext=""):
+        """
+        Returns a unique name derived from the given one. The optional
+        extension is kept at the end of the name, after the suffix.
+        """
+
+        new_name  = name + ext
+        suffix_id = self.counters.get(name, 0)
+
+        while new_name in self.used_names:
+            suffix_id += 1
+            new_name = name + "_{:02d}".format(suffix_id) + ext
+
+        self.counters[name] = suffix_id
+        self.used_names.add(new_name)
+
+        return new_name
+
+
+def sort_key(item):
+    """
+    A sort key for Symbol and Footprint tuples which tolerates missing
+    library names. Used to make name allocation deterministic.
+    """
+    return (item.lib or "", item.name)
+
+
+def build_symbol_map(symbols, lib_name):
+    """
+    Builds a map of symbols to their new names in the given library.
+    """
+
+    symbol_map = {}
+    allocator  = NameAllocator()
+
+    # FIXME: This will fail if there are two symbols with the same name in
+    # different libraries but one of them has an ALIAS.
+    for symbol in sorted(symbols, key=sort_key):
+        symbol_map[symbol] = Symbol(
+            name=allocator.allocate(symbol.name),
+            lib=lib_name
+            )
+
+    return symbol_map
+
+
+def build_footprint_map(footprints, lib_name, digests=None):
+    """
+    Builds a map of footprints to their new names in the given library.
+    Footprints with the same digest, if given (see footprint_digest()), are
+    identical and get the same new name, the one of the first of them.
+    """
+
+    footprint_map = {}
+    allocator     = NameAllocator()
+    by_digest     = {}
+
+    if digests is None:
+        digests = {}
+
+    for footprint in sorted(footprints, key=sort_key):
+        digest = digests.get(footprint)
+        if digest is not None and digest in by_digest:
+            footprint_map[footprint] = by_digest[digest]
+            continue
+
+        footprint_map[footprint] = Footprint(
+            name=allocator.allocate(footprint.name),
+            lib=lib_name
+            )
+
+        if digest is not None:
+            by_digest[digest] = footprint_map[footprint]
+
+    return footprint_map
+
+
+def build_model_map(models, model_lib):
     """
-    A Python's config parser that preserves option case.
+    Builds a map of 3D model file names to their new locations in the given
+    model folder.
     """
-    def optionxform(self, optionstr):
-        return optionstr
+
+    model_map = {}
+    allocator = NameAllocator()
+
+    for model in sorted(models):
+        name, ext = os.path.splitext(os.path.basename(model))
+        model_map[model] = os.path.join(model_lib, allocator.allocate(name, ext))
+
+    return model_map
 
 # =============================================================================
 
@@ -49,8 +166,10 @@ def load_kicad_env_vars(file_name):
     config = ["[General]"] + config
     config = "\n".join(config)
 
-    # Parse the config
-    parser = CaseConfigParser()
+    # Parse the config, preserve option case
+    import configparser
+    parser = configparser.ConfigParser()
+    parser.optionxform = str
     parser.read_string(config)
 
     # Look for "EnvironmentVariables"
@@ -66,49 +185,126 @@ def load_lib_table(file_name):
 
     # Load the file
     with open(file_name, "r") as fp:
-        root = bracket_tree.parse(fp.read())
+        return parse_lib_table(fp.read())
+
+
+LIB_TABLE_RE = re.compile(r"\s*\(\s*(sym_lib_table|fp_lib_table)[\s()]")
+LIB_TABLE_LIB_RE = re.compile(r"\(\s*lib\s*((?:\([^()\"]*(?:\"[^\"]*\"[^()\"]*)*\)\s*)*)\)")
+LIB_TABLE_FIELD_RE = re.compile(r"\(\s*(\w+)(?:\s+(\"[^\"]*\"|[^\s()\"]+))?\s*\)")
+
+
+def parse_lib_table(data):
+    """
+    Parses fp-lib-table or sym-lib-table content. Returns a dict of libraries
+    indexed by their names, in the order of the table.
+
+    Library tables have a simple flat structure so they are read with regular
+    expressions. Should that fail the generic bracket tree parser is used.
+    """
+
+    # The root node should be "sym_lib_table" or "fp_lib_table"
+    assert LIB_TABLE_RE.match(data) is not None
+
+    # Look for "lib" entries. If not all of them match, fall back to the
+    # generic parser.
+    entries = LIB_TABLE_LIB_RE.findall(data)
+    if len(entries) != len(re.findall(r"\(\s*lib[\s()]", data)):
+        return _parse_lib_table_tree(data)
+
+    libs = {}
+    for entry in entries:
+        fields = {k: v[1:-1] if v.startswith("\"") else v
+                  for k, v in LIB_TABLE_FIELD_RE.findall(entry)}
+
+        if "name" not in fields or "uri" not in fields:
+            return _parse_lib_table_tree(data)
+
+        _add_lib(libs, Library(
+            name=fields["name"],
+            filename=fields["uri"],
+            type=fields.get("type"),
+            options=fields.get("options", ""),
+            descr=fields.get("descr", "")
+            ))
+
+    return libs
+
+
+def _parse_lib_table_tree(data):
+    """
+    Parses library table content using the generic bracket tree parser.
+    """
+
+    root = bracket_tree.parse(data)
 
     # The root node should be "sym_lib_table" or "fp_lib_table"
     assert root.keyword == "sym_lib_table" or root.keyword == "fp_lib_table"
 
     # Process all "lib" children
-    libs = set()
+    libs = {}
     for node in root.findall("lib"):
-        name = node.find("name").attributes[0]
-        type = node.find("type").attributes[0]
-        uri  = node.find("uri" ).attributes[0]
 
-        if type not in ["Legacy", "KiCad"]:
-            print("WARNING: Library type '{}' not supported!".format(type))
-            continue
+        def field(keyword, default=None):
+            child = node.find(keyword)
+            if child is None or not child.attributes:
+                return default
+            return child.attributes[0]
 
-        libs.add(Library(name, uri))
+        _add_lib(libs, Library(
+            name=field("name"),
+            filename=field("uri"),
+            type=field("type"),
+            options=field("options", ""),
+            descr=field("descr", "")
+            ))
 
     return libs
 
+
+def _add_lib(libs, lib):
+    """
+    Adds a library to a dict of libraries if its type is supported.
+    """
+
+    if lib.type not in ["Legacy", "KiCad"]:
+        get_reporter().warning("Library type '{}' not supported!".format(lib.type))
+        return
+
+    libs[lib.name] = lib
+
 # =============================================================================
 
 
-def find_project_files(path):
+def find_project_files(path, files=None):
     """
-    Finds KiCad project files in the given path.
+    Finds KiCad project files in the given path. Optionally a list of file
+    names can be given instead of listing the path. A KiCad 6+ project
+    (.kicad_pro) takes precedence over a legacy one (.pro), its sheets are
+    .kicad_sch files instead of .sch ones.
     """
 
     project = {}
 
-    files = os.listdir(path)
+    if files is None:
+        files = os.listdir(path)
+
+    # Find the .kicad_pro or .pro file
+    pro = [f for f in files if f.lower().endswith(".kicad_pro")]
+    legacy = len(pro) == 0
+    if legacy:
+        pro = [f for f in files if f.lower().endswith(".pro")]
 
-    # Find the .pro file
-    pro = [f for f in files if f.lower().endswith(".pro")]
     if len(pro) == 0:
         raise RuntimeError("No KiCad project file found!")
     if len(pro) > 1:
         raise RuntimeError("Multiple KiCad project files found!")
     
     project["pro"] = pro[0]    
+    project["legacy"] = legacy
     
     # Schematic and board files
-    project["sch"] = [f for f in files if f.lower().endswith(".sch")]
+    sch_ext = ".sch" if legacy else ".kicad_sch"
+    project["sch"] = [f for f in files if f.lower().endswith(sch_ext)]
     project["brd"] = [f for f in files if f.lower().endswith(".kicad_pcb")]
 
     return project
@@ -119,68 +315,162 @@ def identify_used_symbols_and_footprints(sch_file):
     Returns a set of used symbols and footprints in a schematic sheet.
     """
 
+    with open(sch_file, "r") as fp:
+        if sch_file.lower().endswith(".kicad_sch"):
+            return scan_kicad_schematic(fp.read())[:2]
+        return scan_schematic(fp)
+
+
+def scan_schematic(lines):
+    """
+    Returns a set of used symbols and footprints given lines of a schematic
+    sheet.
+    """
+
     symbols = set()
     footprints = set()    
 
-    with open(sch_file, "r") as fp:
-        section = None
+    section = None
 
-        for l in fp:
-            l = l.strip()
+    for l in lines:
+        l = l.strip()
 
-            # Identify section
-            if section is None:
-                if l == "$Comp":
-                    section = l
-                    continue
+        # Identify section
+        if section is None:
+            if l == "$Comp":
+                section = l
+                continue
 
-            elif section == "$Comp":
-                if l == "$EndComp":
-                    section = None
-                    continue
+        elif section == "$Comp":
+            if l == "$EndComp":
+                section = None
+                continue
 
-            # "Comp" section
-            if section == "$Comp":
-                fields = shlex.split(l)
+        # "Comp" section
+        if section == "$Comp":
+            fields = shlex.split(l)
 
-                # Got a symbol library reference field
-                if len(fields) >= 2 and fields[0] == "L":
-                    field = fields[1]
+            # Got a symbol library reference field
+            if len(fields) >= 2 and fields[0] == "L":
+                field = fields[1]
+
+                # Separate library and symbol name
+                if ":" in field:
+                    lib, symbol = field.split(":")
+                else:
+                    lib = None
+                    symbol = field
+
+                # Add to the set
+                symbols.add(Symbol(
+                    name = symbol,
+                    lib = lib
+                    ))
+
+            # Got a footprint reference field
+            if len(fields) >= 3 and fields[0] == "F" and fields[1] == "2":
+                field = fields[2]
+                if field != "":
 
                     # Separate library and symbol name
                     if ":" in field:
-                        lib, symbol = field.split(":")
+                        lib, footprint = field.split(":")
                     else:
                         lib = None
-                        symbol = field
+                        footprint = field
 
                     # Add to the set
-                    symbols.add(Symbol(
-                        name = symbol,
+                    footprints.add(Footprint(
+                        name = footprint,
                         lib = lib
-                        ))
-
-                # Got a footprint reference field
-                if len(fields) >= 3 and fields[0] == "F" and fields[1] == "2":
-                    field = fields[2]
-                    if field != "":
-
-                        # Separate library and symbol name
-                        if ":" in field:
-                            lib, footprint = field.split(":")
-                        else:
-                            lib = None
-                            footprint = field
-
-                        # Add to the set
-                        footprints.add(Footprint(
-                            name = footprint,
-                            lib = lib
-                        ))
+                    ))
 
     return symbols, footprints
 
 
+def split_lib_id(lib_id):
+    """
+    Splits a "library:name" reference. The library is None if missing.
+    """
+
+    if ":" in lib_id:
+        lib, name = lib_id.split(":", maxsplit=1)
+        return lib, name
+
+    return None, lib_id
+
+
+def scan_kicad_schematic(data):
+    """
+    Returns sets of used symbols and footprints given content of a KiCad 6+
+    schematic sheet, and a dict of symbol definitions cached in the sheet
+    (its "lib_symbols") as text. The sheet is streamed, only the cached
+    definitions and "symbol" nodes are looked into, no tree of the whole
+    sheet is built.
+    """
+
+    symbols = set()
+    footprints = set()
+    cached_symbols = {}
+
+    # The root should be "kicad_sch"
+    start = data.find("(")
+    assert start >= 0 and bracket_tree.node_head(data, start, escapes=True)[0] == "kicad_sch"
+
+    for keyword, start, end in bracket_tree.iter_children(data, escapes=True):
+
+        # Cached symbol definitions, named by their library references
+        if keyword == "lib_symbols":
+            for child, child_start, child_end in bracket_tree.iter_children(
+                    data, start, end, escapes=True):
+                if child != "symbol":
+                    continue
+
+                lib_id = bracket_tree.node_head(data, child_start, escapes=True)[1]
+                lib, name = split_lib_id(lib_id)
+                span = bracket_tree.line_span(data, child_start, child_end)
+                cached_symbols[Symbol(name = name, lib = lib)] = data[span[0]:span[1]]
+
+        # A symbol, parse only its node
+        elif keyword == "symbol":
+            node = bracket_tree.parse_concrete(data, start, end, escapes=True)
+
+            # Got a symbol library reference
+            lib_id = node.find("lib_id")
+            if lib_id is not None and lib_id.attributes:
+                lib, name = split_lib_id(lib_id.attributes[0])
+                symbols.add(Symbol(name = name, lib = lib))
+
+            # Got a footprint reference
+            for prop in bracket_tree.select(node, "property[0=Footprint]"):
+                if len(prop.attributes) >= 2 and prop.attributes[1] != "":
+                    lib, name = split_lib_id(prop.attributes[1])
+                    footprints.add(Footprint(name = name, lib = lib))
+
+    return symbols, footprints, cached_symbols
+
+
+def uses_escapes(data):
+    """
+    Tells whether a board or footprint file uses backslash escaped quotes,
+    ie. whether it is in the KiCad 6+ format. The version, when there is
+    one, is the first child node.
+    """
+
+    start = data.find("(")
+    if start < 0:
+        return False
+
+    for keyword, child_start, child_end in bracket_tree.iter_children(data, start):
+        if keyword != "version":
+            return False
+
+        words = bracket_tree.node_head(data, child_start)
+        return len(words) > 1 and words[1].isdigit() and int(words[1]) >= ESCAPES_VERSION
+
+    return False
+
+
 def gather_footprints_and_identify_models(brd_file):
     """
     Gathers footprint definitions from the PCB file and identifies 3D models
@@ -189,428 +479,935 @@ def gather_footprints_and_identify_models(brd_file):
 
     # Load the PCB
     with open(brd_file, "r") as fp:
-        root = bracket_tree.parse(fp.read())
+        return scan_board(fp.read())
+
+
+def scan_board(data):
+    """
+    Same as gather_footprints_and_identify_models() but accepts the PCB file
+    content. The board is scanned using the compact flat representation,
+    footprints are returned as BoardFootprints which keeps only their spans.
+    """
+
+    escapes = uses_escapes(data)
+    root = bracket_tree.parse_flat(data, escapes).root
 
     # The root should be "kicad_pcb"
     assert root.keyword == "kicad_pcb"
 
-    # Look for modules and models
-    footprints = {}
+    # Look for modules
+    spans  = {}
     models = set()
 
-    for node in root.children:
-        if node.keyword != "module":
-            continue
+    for keyword in FOOTPRINT_KEYWORDS:
+        for node in bracket_tree.select(root, keyword):
+            footprint = node.attributes[0]
 
-        footprint = node.attributes[0]
+            # Get footprint library and its name
+            if ":" in footprint:
+                lib, name = footprint.split(":")
+            else:
+                lib = None
+                name = footprint
 
-        # Get footprint library and its name
-        if ":" in footprint:
-            lib, name = footprint.split(":")
-        else:
-            lib = None
-            name = footprint
+            # Store
+            footprint = Footprint(name = name, lib = lib)
+            spans[footprint] = node.span
 
-        # Store
-        footprint = Footprint(name = name, lib = lib)
-        footprints[footprint] = node
+        # Look for models
+        models |= set(n.attributes[0] for n in bracket_tree.select(root, keyword + "/model"))
 
-        # Look for "model"
-        for item in node.children:
-            if item.keyword != "model":
-                continue
+    return BoardFootprints(data, spans, escapes), models
 
-            model = item.attributes[0]
-            models.add(model)
 
-    return footprints, models
+class BoardFootprints(Mapping):
+    """
+    Footprints of a board by their Footprint keys, see scan_board(). Only
+    the board source and spans of the footprints in it are kept, which is
+    much smaller than their trees. A footprint is parsed from its span and
+    preprocessed (see preprocess_pcb_footprints()) each time it is looked
+    up, so the tree returned may be modified. It keeps its source so that
+    it is written with its original formatting.
+    """
+
+    def __init__(self, data, spans, escapes=False):
+        self.source  = {"data": data}
+        self.spans   = spans
+        self.escapes = escapes
+
+    def keep_in(self, store):
+        """
+        Moves the board source to a spill store, see SpillStore.dict().
+        """
+        source = store.dict()
+        source.update(self.source)
+        self.source = source
+
+    def __getitem__(self, footprint):
+        start, end = self.spans[footprint]
+        root = bracket_tree.parse_concrete(self.source["data"], start, end, self.escapes)
+        return preprocess_pcb_footprints({footprint: root})[footprint]
+
+    def __iter__(self):
+        return iter(self.spans)
+
+    def __len__(self):
+        return len(self.spans)
 
+    def __contains__(self, footprint):
+        return footprint in self.spans
 
-def identify_used_models(footprints, footprint_libs):
+
+def scan_board_spans(data):
+    """
+    Scans a board in a ParsePool worker, see scan_board(). Returns an empty
+    list of trees and a tuple of spans of footprints by their Footprint
+    keys and the set of models. The calling process keeps the board data.
+    """
+
+    footprints, models = scan_board(data)
+    return [], (footprints.spans, models)
+
+
+def identify_used_models(footprints, footprint_libs, cache=None, aio=None):
     """
     Scans footprint files and identifies 3D models used there
     """
-    models = set()
 
-    # Group libraries by name
-    libs_by_name = {l.name: l.filename for l in footprint_libs}
+    if aio is None:
+        from async_io import AsyncIO
+        with AsyncIO() as aio:
+            return identify_used_models(footprints, footprint_libs, cache, aio)
 
-    # Process footprints
+    if cache is None:
+        cache = LibraryCache()
+
+    footprint_libs = as_library_table(footprint_libs)
+
+    # Locate footprint files
+    src_files = []
     for footprint in footprints:
 
         # Library used in project but not found.
-        if footprint.lib not in libs_by_name:
+        lib_file = footprint_libs.filename(footprint.lib)
+        if lib_file is None:
             continue
 
-        lib_file = libs_by_name[footprint.lib]
-        src_file = os.path.join(lib_file, footprint.name + ".kicad_mod")
+        src_file = cache.file_index.find(lib_file, footprint.name + ".kicad_mod")
 
         # Footprint not found in the library
-        if not os.path.isfile(src_file):
+        if src_file is None:
             continue
 
-        # Load the footprint
-        with open(src_file, "r") as fp:
-            root = bracket_tree.parse(fp.read())
+        src_files.append(src_file)
 
-        # The root should be "module"
-        assert root.keyword == "module"
-
-        # Look for "model"
-        for node in root.children:
-            if node.keyword != "model":
-                continue
+    # Load footprints
+    cache.load_footprints(src_files, aio)
 
-            model = node.attributes[0]
-            models.add(model)
+    # Look for "model"
+    models = set()
+    for src_file in src_files:
+        for node in bracket_tree.select(cache.footprints[src_file], "model"):
+            models.add(node.attributes[0])
 
     return models
 
 # =============================================================================
 
 
-def substitute_env_vars(string, env_vars):
+class EnvVarSubstituter(object):
     """
-    Substitute values of environmental variables in a string
+    Substitutes environmental variables in strings. Both "${VAR}" and "$(VAR)"
+    forms are recognized. Variables not given explicitly are looked up in the
+    OS environment, unknown ones are left untouched. Variables referring to
+    other variables are resolved once, upon construction.
     """
 
-    # Replace an environmental variable
-    if "${" in string and "}" in string:
+    VAR_RE = re.compile(r"\$\{([^${}()]+)\}|\$\(([^${}()]+)\)")
+
+    # Maximum depth of nested variable references
+    MAX_DEPTH = 8
+
+    def __init__(self, env_vars, use_os_environ=True, cache_size=4096):
 
-        for var, value in env_vars.items():
-            tag = "${" + var + "}"
-            string = string.replace(tag, value)
+        self.env_vars = dict(os.environ) if use_os_environ else {}
+        self.env_vars.update(env_vars)
 
-    return string
+        # Resolve variables which refer to other variables. Iterate until
+        # nothing changes, cyclic references are left unresolved.
+        for i in range(self.MAX_DEPTH):
+            resolved = {k: self._substitute(v) for k, v in self.env_vars.items()}
+            if resolved == self.env_vars:
+                break
+            self.env_vars = resolved
+
+        # Memoize results
+        self.substitute = functools.lru_cache(maxsize=cache_size)(self._substitute)
+
+    def _lookup(self, match):
+        var = match.group(1) or match.group(2)
+        return self.env_vars.get(var, match.group(0))
+
+    def _substitute(self, string):
+        if "$" not in string:
+            return string
+        return self.VAR_RE.sub(self._lookup, string)
+
+
+@functools.lru_cache(maxsize=16)
+def _env_var_substituter(env_items):
+    return EnvVarSubstituter(dict(env_items), use_os_environ=False)
+
+
+def substitute_env_vars(string, env_vars):
+    """
+    Substitute values of environmental variables in a string. One memoizing
+    substituter is kept for each set of variables.
+    """
+    return _env_var_substituter(frozenset(env_vars.items())).substitute(string)
 
 # =============================================================================
 
 
-def grab_symbol(lib_data, name):
+class LibraryTable(object):
     """
-    Given a list of lines of a symbol library file, grabs the intersting symbol
-    definition and returns it. Returns None if the symbol was not found.
+    A lookup of libraries by their names. Library file names are resolved,
+    ie. have environmental variables substituted, on demand and only once.
+    This way only libraries actually referenced by a project are processed
+    no matter how large the library tables are.
     """
 
-    # Add a comment preceeding symbol definition
-    symbol_data = [
-    "#",
-    "# {}".format(name),
-    "#",
-    ]
+    def __init__(self, libs, substituter=None):
+        self.libs = libs
+        self.substituter = substituter
+        self.resolved = {}
 
-    def_data = []
-    in_def = False
+    def __contains__(self, name):
+        return name in self.libs
 
-    # Parse the library data
-    for l in lib_data:
-        l = l.strip()
+    def __iter__(self):
+        return (self.resolve(name) for name in self.libs)
 
-        # Begin symbol definition
-        if not in_def and l.startswith("DEF"):
-            in_def = True
-            def_data = []           
+    def __len__(self):
+        return len(self.libs)
 
-        # Copy lines
-        if in_def:
-            def_data.append(l)
+    def resolve(self, name):
+        """
+        Returns a library with its file name resolved or None if there is no
+        such library.
+        """
 
-        # End symbol definition
-        if in_def and l == "ENDDEF":
-            in_def = False
+        if name not in self.resolved:
+            lib = self.libs.get(name)
+            if lib is not None and self.substituter is not None:
+                lib = lib._replace(filename=self.substituter.substitute(lib.filename))
 
-            # Check if this is the symbol that we are looking for
-            for l in def_data:
-                fields = l.strip().split()
+            self.resolved[name] = lib
 
-                if len(fields) >= 2:
+        return self.resolved[name]
 
-                    # DEF
-                    if fields[0] == "DEF" and fields[1] == name:
-                        symbol_data += def_data
-                        return symbol_data
+    def resolve_all(self, names):
+        """
+        Resolves multiple libraries. Returns a dict of them, unknown ones are
+        None.
+        """
+        return {name: self.resolve(name) for name in names}
 
-                    # ALIAS
-                    if fields[0] == "ALIAS" and fields[1] == name:
-                        symbol_data += def_data
-                        return symbol_data
+    def filename(self, name):
+        """
+        Returns a resolved library file name or None if there is no such
+        library.
+        """
+        lib = self.resolve(name)
+        return lib.filename if lib is not None else None
 
-    # Symbol not found, return None
-    return None
-                
 
-def collect_symbols(symbols, symbol_libs):
+def as_library_table(libs):
     """
-    Collects symbols definitions from multiple symbol librarys.
+    Returns a LibraryTable given either a table or an iterable of Library
+    objects with already resolved file names.
     """
 
-    # Group symbols by libraries
-    symbols_by_lib = defaultdict(lambda: set())
-    for symbol in symbols:
-        symbols_by_lib[symbol.lib].add(symbol.name)
+    if isinstance(libs, LibraryTable):
+        return libs
 
-    # Group libraries by name
-    libs_by_name = {l.name: l.filename for l in symbol_libs}
-
-    # Grab symbol definitions from each library
-    symbol_data = {}
-    for lib, lib_symbols in symbols_by_lib.items():
+    return LibraryTable({l.name: l for l in libs})
 
-        # Library used in project but not found.
-        if lib not in libs_by_name or not os.path.isfile(libs_by_name[lib]):
-            print(" ERROR: Library '{}' for symbols '{}' not found!".format(lib, ",".join(lib_symbols)))
-            continue
+# =============================================================================
 
-        # Load the library content
-        lib_file = libs_by_name[lib]
-        with open(lib_file, "r") as fp:
-            lib_data = fp.readlines()
 
-        # Grab symbols
-        for name in lib_symbols:
+class FileIndex(object):
+    """
+    An in-memory index of files in directories. Each directory is listed
+    only once, upon the first lookup. Further existence checks are dictionary
+    lookups which saves a lot of stat calls on network file systems.
 
-            # Grab
-            data = grab_symbol(lib_data, name)
-            if data is None:
-                print(" ERROR: Symbol '{}' not found in '{}'".format(name, lib))
-                continue
- 
-            # Add to definition
-            key = Symbol(name, lib)
-            symbol_data[key] = data
+    Directory entries are kept, so file sizes come from the listing where
+    the system provides them (Windows) and are read at most once elsewhere.
+    """
 
-    return symbol_data
+    def __init__(self):
+        self.dirs = {}
+
+    def _list(self, path):
+        """
+        Lists a directory, returns dicts of its file entries by name and by
+        lowercase name. A non-existent directory yields empty dicts.
+        """
+
+        if path not in self.dirs:
+            files = {}
+            files_lower = {}
+
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.is_file():
+                            files[entry.name] = entry
+                            files_lower.setdefault(entry.name.lower(), entry)
+            except OSError:
+                pass
+
+            self.dirs[path] = (files, files_lower)
+
+        return self.dirs[path]
+
+    def _entry(self, path, name):
+        files, files_lower = self._list(path)
+
+        if name in files:
+            return files[name]
+
+        return files_lower.get(name.lower(), None)
+
+    def find(self, path, name):
+        """
+        Looks for a file in the given directory. Falls back to a case
+        insensitive match. Returns the file path or None if not found.
+        """
+        entry = self._entry(path, name)
+        return entry.path if entry is not None else None
+
+    def find_file(self, file_name):
+        """
+        Same as find() but accepts a full file path.
+        """
+        path, name = os.path.split(file_name)
+        return self.find(path or os.curdir, name)
+
+    def size(self, file_name):
+        """
+        Returns the size of a file found with find() or None if not found.
+        """
+        path, name = os.path.split(file_name)
+        entry = self._entry(path or os.curdir, name)
+        return entry.stat().st_size if entry is not None else None
+
+
+def dump_footprint(root):
+    """
+    Serializes a footprint tree for a spill store, see load_footprint().
+    """
+    return bracket_tree.dump(root)
 
 
-def process_symbol_defs(symbol_defs, symbol_map):
+def load_footprint(data):
     """
-    Modifies symbol definition according to the symbol map
+    Loads a footprint tree serialized with dump_footprint(). The tree keeps
+    its source so it is written back the same way.
     """
+    data = data.decode("utf-8")
+    return bracket_tree.parse(data, keep_source=True, escapes=uses_escapes(data))
 
-    # Process all definitions
-    new_defs = {}
 
-    for symbol, symbol_data in symbol_defs.items():
-        new_name = symbol_map[symbol].name
-        new_data = []
+def parse_footprint_file(file_name):
+    """
+    Loads and parses a footprint file in a ParsePool worker. Returns a list
+    of the tree and a tuple of the data size and the parse time.
+    """
 
-        # Process the definition
-        for l in symbol_data:
-            fields = l.strip().split()
+    with open(file_name, "r") as fp:
+        data = fp.read()
 
-            if len(fields) >= 2:
+    start = time.perf_counter()
+    root = bracket_tree.parse(data, keep_source=True, escapes=uses_escapes(data))
 
-                # Header comment
-                if fields[0] == "#" and fields[1] == symbol.name:
-                    l = "# {}".format(new_name)
+    # The root should be "module" or "footprint"
+    assert root.keyword in FOOTPRINT_KEYWORDS
 
-                # DEF
-                elif fields[0] == "DEF" and fields[1] == symbol.name:
-                    l = fields[0] + " " + new_name + " " + " ".join(fields[2:])
+    return [root], (len(data), time.perf_counter() - start)
 
-                # ALIAS
-                elif fields[0] == "ALIAS" and fields[1] == symbol.name:
-                    l = fields[0] + " " + new_name + " " + " ".join(fields[2:])
 
-            new_data.append(l)
+class LibraryCache(object):
+    """
+    Caches library content: the file index, parsed footprints and their
+    digests and symbol library indices. May be shared between multiple
+    projects. Cached content must not be modified by users.
 
-        # Store new data
-        new_defs[symbol] = new_data
+    When a spill store is given parsed footprints are kept in it, so they
+    are moved to disk when the memory budget is exceeded. When a parse pool
+    is given footprints are parsed by its worker processes.
+    """
 
-    return new_defs
+    def __init__(self, store=None, pool=None):
+        self.file_index  = FileIndex()
+        self.symbol_libs = {}
+        self.digests     = {}
+        self.pool        = pool
 
-# =============================================================================
+        if store is not None:
+            self.footprints = store.dict(dump_footprint, load_footprint)
+        else:
+            self.footprints = {}
+
+    def footprint_copy(self, src_file):
+        """
+        Returns a copy of a cached footprint which may be modified. Spilled
+        footprints are loaded as new trees, they are not copied again.
+        """
+
+        footprints = self.footprints
+        if not isinstance(footprints, dict) and footprints.is_spilled(src_file):
+            return footprints[src_file]
+
+        return deepcopy(footprints[src_file])
+
+    def refresh_files(self):
+        """
+        Drops the file index, so that files added or removed since it was
+        built are seen.
+        """
+        self.file_index = FileIndex()
+
+    def footprint_digest(self, src_file):
+        """
+        Returns the digest of a cached footprint, see footprint_digest().
+        """
+
+        digest = self.digests.get(src_file)
+        if digest is None:
+            digest = footprint_digest(self.footprints[src_file])
+            self.digests[src_file] = digest
+
+        return digest
+
+    def load_footprints(self, src_files, aio, reporter=None):
+        """
+        Loads and parses footprint files that are not cached yet. Parse
+        times are logged.
+        """
+
+        if reporter is None:
+            reporter = get_reporter()
+
+        missing = [f for f in src_files if f not in self.footprints]
+        if not missing:
+            return
 
+        # Parse in worker processes
+        if self.pool is not None:
+            results = self.pool.map(parse_footprint_file, missing)
+            for src_file, (trees, (size, duration)) in zip(missing, results):
+                self.footprints[src_file] = trees[0]
+                reporter.timing("load", src_file, duration, size)
+            return
 
-def preprocess_pcb_footprints(footprints):
-    """
-    Processes footprints extracted from PCB to make them generic and to be
-    placed in the new library
-    """
+        async def load():
+            async for src_file, data in aio.read_files(missing):
+                start = time.perf_counter()
+                root = bracket_tree.parse(data, keep_source=True, escapes=uses_escapes(data))
 
-    # A helper function for processing element rotations
-    def cancel_rotation(node, rotation):
+                # The root should be "module" or "footprint"
+                assert root.keyword in FOOTPRINT_KEYWORDS
 
-        # Skip those. The "model" element seems to have rotation relative to
-        # the footprint.
-        if node.keyword in ["at", "model"]:
-            return
+                self.footprints[src_file] = root
+                reporter.timing("load", src_file, time.perf_counter() - start, len(data))
 
-        # We have the "at" child
-        at = node.find("at")
-        if at is not None:
+        aio.run(load())
 
-            # Get its rotation
-            coords = at.attributes
-            rot = 0.0 if len(coords) < 3 else float(coords[2])
+    def load_symbol_libs(self, lib_files, aio, reporter=None):
+        """
+        Parses symbol library files that are not cached yet. Symbol records
+        are kept, indexed by names and aliases, see symbol_lib.load(). Parse
+        times are logged.
+        """
 
-            # Cancel it
-            rot -= rotation
-            rot  = "{:.3f}".format(rot)
+        if reporter is None:
+            reporter = get_reporter()
 
-            # Replace the "at" node
-            new_at = bracket_tree.Node(node, "at", [coords[0], coords[1], rot])
-            node.replace(at, new_at)
+        missing = [f for f in lib_files if f not in self.symbol_libs]
+        if not missing:
+            return
 
-        # Recurse
-        for child in node.children:
-            cancel_rotation(child, rotation)
+        def index(lib_file):
+            start = time.perf_counter()
+            return symbol_lib.load(lib_file), time.perf_counter() - start
 
-    # Process footprints
-    for footprint, root in footprints.items():
+        for lib_file, (index, duration) in zip(missing, aio.map(index, missing)):
+            self.symbol_libs[lib_file] = index
+            reporter.timing("load", lib_file, duration, self.file_index.size(lib_file))
 
-        # Remove the "at" node, get the footprint rotation.
-        node = root.find("at")
-        if node is not None:
-            coords = node.attributes
-            rotation = 0.0 if len(coords) < 3 else float(coords[2])
-            root.remove(node)
-        else:
-            rotation = 0.0
+# =============================================================================
 
-        # Cancel rotation of all elements of the footprint
-        for node in root.children:
-            cancel_rotation(node, rotation)
 
-        # Texts
-        for node in root.findall("fp_text"):
+def iter_symbol_records(symbols, symbol_libs, cache=None, aio=None, reporter=None,
+                        fallback=None):
+    """
+    Yields (symbol, record, body) tuples of symbol definitions in the order
+    of the given symbols. Records come from the library cache, see
+    symbol_lib.LibSymbol, bodies are read from library files one at a time.
 
-            if node.attributes[0] == "reference":
-                node.replace(node.attributes[1], "REF**")
+    Symbols that are not found, or whose library is not found, are yielded
+    with no record and the body taken from the fallback dict, if they are
+    there. Otherwise an error is reported.
+    """
 
-            if node.attributes[0] == "value":
-                node.replace(node.attributes[1], footprint.name)
+    if aio is None:
+        from async_io import AsyncIO
+        with AsyncIO() as aio:
+            yield from iter_symbol_records(symbols, symbol_libs, cache, aio, reporter,
+                                           fallback)
+            return
 
-    return footprints
+    if fallback is None:
+        fallback = {}
 
+    if reporter is None:
+        reporter = get_reporter()
 
-def collect_footprints_from_libraries(footprints, footprint_libs):
-    """
-    Collects footprint definition files from multiple libraries.
-    """
+    if cache is None:
+        cache = LibraryCache()
 
-    # Group libraries by name
-    libs_by_name = {l.name: l.filename for l in footprint_libs}
+    symbols = list(symbols)
 
-    # Get footprint definition from each library
-    footprint_defs = {}
-    for footprint in footprints:
+    # Group symbols by libraries
+    symbols_by_lib = defaultdict(lambda: [])
+    for symbol in symbols:
+        symbols_by_lib[symbol.lib].append(symbol)
 
-        # Library used in project but not found.
-        if footprint.lib not in libs_by_name:
-            print(" ERROR: Library '{}' for footprint '{}' not found!".format(footprint.lib, footprint.name))
-            footprint_defs[footprint] = None
-            continue
+    symbol_libs = as_library_table(symbol_libs)
 
-        lib_file = libs_by_name[footprint.lib]
-        src_file = os.path.join(lib_file, footprint.name + ".kicad_mod")
+    # Locate library files
+    lib_files = {}
+    for lib, lib_symbols in symbols_by_lib.items():
+        lib_file = symbol_libs.filename(lib)
+        if lib_file is not None:
+            lib_file = cache.file_index.find_file(lib_file)
 
-        # Footprint not found in the library
-        if not os.path.isfile(src_file):
-            print(" ERROR: Footrpint '{}' not found in '{}'".format(footprint.name, footprint.lib))
-            footprint_defs[footprint] = None
+        # Library used in project but not found.
+        if lib_file is None:
+            names = [s.name for s in lib_symbols if s not in fallback]
+            if names:
+                reporter.error("Library '{}' for symbols '{}' not found!".format(lib, ",".join(names)), lib)
             continue
 
-        # Load the footprint
-        with open(src_file, "r") as fp:
-            root = bracket_tree.parse(fp.read())
+        lib_files[lib] = lib_file
 
-        # The root should be "module"
-        assert root.keyword == "module"
+    # Index the libraries
+    cache.load_symbol_libs(lib_files.values(), aio, reporter)
 
-        # Add
-        footprint_defs[footprint] = root
+    # Grab symbol definitions
+    files = {}
+    try:
+        for symbol in symbols:
 
-    return footprint_defs
+            if symbol.lib not in lib_files:
+                if symbol in fallback:
+                    yield symbol, None, fallback[symbol]
+                continue
 
+            lib_file = lib_files[symbol.lib]
+            record = cache.symbol_libs[lib_file].get(symbol.name)
+            if record is None and symbol in fallback:
+                yield symbol, None, fallback[symbol]
+                continue
 
-def process_footprints(footprint_defs, footprint_map, model_map, path):
-    """
-    Processes footprint definitions. Renames footprints according to the
-    footprint map and renames 3D model file names accordinf to the model
-    map. Writes files to the destination path.
-    """
+            if record is None:
+                reporter.error("Symbol '{}' not found in '{}'".format(symbol.name, symbol.lib),
+                               "{}:{}".format(symbol.lib, symbol.name))
+                continue
 
-    # Create the output directory
-    os.makedirs(path, exist_ok=True)
+            # Read the body
+            if lib_file not in files:
+                files[lib_file] = open(lib_file, "rb")
 
-    written_files = set()
+            yield symbol, record, symbol_lib.read_body(files[lib_file], record)
 
-    # Process footprint data
-    for footprint, root in footprint_defs.items():
+    finally:
+        for fp in files.values():
+            fp.close()
 
-        if root is None:
-            continue
 
-        new_name = footprint_map[footprint].name
-        dst_file = os.path.join(path, new_name + ".kicad_mod")
+def write_symbol_lib(output, file_name, symbol_map, symbol_libs, cache=None, aio=None,
+                     reporter=None):
+    """
+    Writes a new symbol library with symbols from the symbol map renamed.
+    Symbol definitions are streamed from source libraries one at a time and
+    renamed on the fly. Each symbol is reported as an item.
+    """
 
-        # Change the module name
-        root.child[0] = new_name
+    if reporter is None:
+        reporter = get_reporter()
 
-        # Change the 3D model name
-        for node in root.children:
-            if node.keyword != "model":
-                continue
+    def chunks():
+        yield "EESchema-LIBRARY Version 2.4\n#encoding utf-8"
 
-            model = node.attributes[0]
-            new_name = model_map[model]
-            node.child[0] = new_name
+        for symbol, record, body in iter_symbol_records(symbol_map.keys(), symbol_libs,
+                                                        cache, aio, reporter):
+            lines = symbol_lib.format_symbol(record, body, symbol.name,
+                                             symbol_map[symbol].name)
+            data = "\n" + "\n".join(lines)
+            yield data
 
-        # Check for duplicates
-        if dst_file in written_files:
-            print(" ERROR: Duplcate footprint '{}'".format(new_name))
-            continue
+            reporter.item("{}:{}".format(symbol.lib, symbol.name), len(data))
 
-        # Write the footrpint
-        bracket_tree.save(dst_file, root)
-        written_files.add(dst_file)
+        yield "\n#\n#End Library"
 
-# =============================================================================
+    output.write_iter(file_name, chunks())
 
 
-def collect_models(models, path):
+def write_kicad_symbol_lib(output, file_name, symbol_map, symbol_libs, sch_symbols,
+                           cache=None, aio=None, reporter=None):
     """
-    Collect 3D models from libraries and put them in a common folder.
+    Writes a new KiCad 6+ symbol library with symbols from the symbol map
+    renamed. Symbols are extracted by name from KiCad 6+ libraries. Those
+    not found there, derived ones and those from legacy libraries are taken
+    from definitions cached in schematics (see scan_kicad_schematic())
+    which are complete. Each symbol is reported as an item.
     """
 
-    # Create the output directory
-    os.makedirs(path, exist_ok=True)
+    if reporter is None:
+        reporter = get_reporter()
 
-    written_files = set()
+    def chunks():
+        yield "(kicad_symbol_lib (version 20211014) (generator kicad_liberator)\n"
 
-    # Copy model files
-    for model in models:
+        for symbol, record, body in iter_symbol_records(symbol_map.keys(), symbol_libs,
+                                                        cache, aio, reporter, sch_symbols):
 
-        src_file = model
-        dst_file = os.path.join(path, os.path.basename(model))
+            # Only base symbols of KiCad 6+ libraries can be used as they are
+            if record is not None and (not isinstance(record, symbol_lib.SexprSymbol) or
+                                       record.extends is not None):
+                body = sch_symbols.get(symbol)
+                if body is None:
+                    reporter.error("Symbol '{}' from '{}' not found in schematics".format(
+                                   symbol.name, symbol.lib),
+                                   "{}:{}".format(symbol.lib, symbol.name))
+                    continue
+                record = None
 
-        # Model file not found
-        if not os.path.isfile(src_file):
-            print(" ERROR: Model '{}' not found".format(model))
-            continue
+            if record is None:
+                reporter.info(" Extracting '{}' from schematics".format(symbol.name))
 
-        # Check for duplicates
-        if dst_file in written_files:
-            print(" ERROR: Duplcate model '{}'".format(os.path.basename(model)))
-            continue
+            data = symbol_lib.format_sexpr_symbol(body, symbol_map[symbol].name) + "\n"
+            yield data
 
-        # Copy the file
-        copy(src_file, dst_file)
-        written_files.add(dst_file)
+            reporter.item("{}:{}".format(symbol.lib, symbol.name), len(data))
 
+        yield ")\n"
+
+    output.write_iter(file_name, chunks())
 
 # =============================================================================
 
 
-def process_schematics(inp_sch_file, out_sch_file, symbol_map=None, footprint_map=None):
+def preprocess_pcb_footprints(footprints):
     """
-    Remaps library references to symbol names in a schematic file.
+    Processes footprints extracted from PCB to make them generic and to be
+    placed in the new library
     """
 
-    # Load schematic file
-    with open(inp_sch_file, "r") as fp:
-        sch_data = fp.readlines()
+    # A helper function which tells whether an element is inside a "model"
+    # element. Those seem to have rotation relative to the footprint.
+    def in_model(node, root):
+        while node is not root:
+            if node.keyword == "model":
+                return True
+            node = node.parent
+        return False
+
+    # Process footprints
+    for footprint, root in footprints.items():
+
+        # Remove the "at" node, get the footprint rotation.
+        node = root.find("at")
+        if node is not None:
+            coords = node.attributes
+            rotation = 0.0 if len(coords) < 3 else float(coords[2])
+            root.remove(node)
+        else:
+            rotation = 0.0
+
+        # Cancel rotation of all elements of the footprint. The list is
+        # collected first as "at" nodes are replaced.
+        for at in bracket_tree.compile_query("//at").findall(root):
+            if in_model(at.parent, root):
+                continue
+
+            # Get its rotation
+            coords = at.attributes
+            rot = 0.0 if len(coords) < 3 else float(coords[2])
+
+            # Cancel it
+            rot -= rotation
+            rot  = "{:.3f}".format(rot)
+
+            # Replace the "at" node
+            new_at = bracket_tree.Node(at.parent, "at", [coords[0], coords[1], rot])
+            at.parent.replace(at, new_at)
+
+        # Texts
+        for node in bracket_tree.select(root, "fp_text[0=reference]"):
+            node.replace(node.attributes[1], "REF**")
+
+        for node in bracket_tree.select(root, "fp_text[0=value]"):
+            node.replace(node.attributes[1], footprint.name)
+
+    return footprints
+
+
+# Footprint nodes which do not define its content but a placement on a PCB
+# or an edit, ignored by footprint_digest().
+DIGEST_IGNORED_KEYWORDS = {"tedit", "tstamp", "path"}
+
+
+def footprint_digest(root):
+    """
+    Returns a digest which identifies content of a footprint tree. The
+    footprint name, its value text when it is the name and the nodes listed
+    in DIGEST_IGNORED_KEYWORDS are ignored, as well as formatting. So
+    footprints which only differ in those have the same digest.
+    """
+
+    name = root.attributes[0] if root.attributes else None
+    import hashlib
+    digest = hashlib.sha256()
+
+    def update(node, top):
+        digest.update(b"(" + node.keyword.encode("utf-8") + b"\0")
+
+        for i, child in enumerate(node.child):
+
+            # Attributes, except for the name
+            if isinstance(child, str):
+                if top and i == 0:
+                    continue
+                if node.keyword == "fp_text" and i == 1 and node.child[0] == "value" and \
+                   child == name:
+                    child = ""
+                digest.update(b"\1" + child.encode("utf-8") + b"\0")
+
+            # Child nodes
+            elif not top or child.keyword not in DIGEST_IGNORED_KEYWORDS:
+                update(child, False)
+
+        digest.update(b")")
+
+    update(root, True)
+    return digest.hexdigest()
+
+
+def collect_footprints_from_libraries(footprints, footprint_libs, cache=None, aio=None,
+                                      reporter=None):
+    """
+    Collects footprint definition files from multiple libraries.
+    """
+
+    if aio is None:
+        from async_io import AsyncIO
+        with AsyncIO() as aio:
+            return collect_footprints_from_libraries(footprints, footprint_libs,
+                                                     cache, aio, reporter)
+
+    if cache is None:
+        cache = LibraryCache()
+
+    if reporter is None:
+        reporter = get_reporter()
+
+    footprint_libs = as_library_table(footprint_libs)
+
+    # Locate footprint definition in each library
+    footprint_defs = {}
+    src_files = {}
+    for footprint in footprints:
+
+        # Library used in project but not found.
+        lib_file = footprint_libs.filename(footprint.lib)
+        if lib_file is None:
+            reporter.error("Library '{}' for footprint '{}' not found!".format(footprint.lib, footprint.name),
+                           footprint.lib)
+            footprint_defs[footprint] = None
+            continue
+
+        src_file = cache.file_index.find(lib_file, footprint.name + ".kicad_mod")
+
+        # Footprint not found in the library
+        if src_file is None:
+            reporter.error("Footrpint '{}' not found in '{}'".format(footprint.name, footprint.lib),
+                           "{}:{}".format(footprint.lib, footprint.name))
+            footprint_defs[footprint] = None
+            continue
+
+        src_files[footprint] = src_file
+
+    # Load footprints, each file once even if used by multiple footprints
+    cache.load_footprints(dict.fromkeys(src_files.values()), aio, reporter)
+
+    # Add copies as they are going to be modified
+    for footprint, src_file in src_files.items():
+        footprint_defs[footprint] = cache.footprint_copy(src_file)
+
+    return footprint_defs
+
+
+def process_footprints(footprint_defs, footprint_map, model_map, path, aio=None,
+                       output=None, reporter=None):
+    """
+    Processes footprint definitions. Renames footprints according to the
+    footprint map and renames 3D model file names accordinf to the model
+    map. Writes files to the destination path, relative to the output if
+    one is given. Each footprint written is reported as an item.
+    """
+
+    if aio is None:
+        from async_io import AsyncIO
+        with AsyncIO() as aio:
+            return process_footprints(footprint_defs, footprint_map, model_map,
+                                      path, aio, output, reporter)
+
+    if reporter is None:
+        reporter = get_reporter()
+
+    if output is None:
+        from outputs import DirectoryOutput
+        output = DirectoryOutput(os.curdir, aio)
+
+    # Create the output directory
+    output.mkdir(path)
+
+    # Process footprint data, files are written in the background
+    async def process():
+        written_files = set()
+
+        for footprint, root in footprint_defs.items():
+
+            if root is None:
+                continue
+
+            new_name = footprint_map[footprint].name
+            dst_file = os.path.join(path, new_name + ".kicad_mod")
+
+            # Change the module name
+            root.child[0] = new_name
+
+            # Change the 3D model name
+            for node in root.children:
+                if node.keyword != "model":
+                    continue
+
+                model = node.attributes[0]
+                new_name = model_map[model]
+                node.child[0] = new_name
+
+            # Check for duplicates
+            if dst_file in written_files:
+                reporter.error("Duplcate footprint '{}'".format(new_name), dst_file)
+                continue
+
+            # Write the footrpint
+            data = bracket_tree.dump(root)
+            await output.write_async(dst_file, data)
+            written_files.add(dst_file)
+
+            reporter.item(dst_file, len(data))
+
+    aio.run(process())
+
+# =============================================================================
+
+
+def collect_models(models, path, cache=None, aio=None, output=None, reporter=None):
+    """
+    Collect 3D models from libraries and put them in a common folder. Models
+    are given as a dict of source file names and their new base names. The
+    folder is relative to the output if one is given. Each model copied is
+    reported as an item.
+    """
+
+    if aio is None:
+        from async_io import AsyncIO
+        with AsyncIO() as aio:
+            return collect_models(models, path, cache, aio, output, reporter)
+
+    if cache is None:
+        cache = LibraryCache()
+
+    if reporter is None:
+        reporter = get_reporter()
+
+    if output is None:
+        from outputs import DirectoryOutput
+        output = DirectoryOutput(os.curdir, aio)
+
+    # Create the output directory
+    output.mkdir(path)
+
+    # Copy model files in the background
+    async def collect():
+        written_files = set()
+
+        for model, new_name in models.items():
+
+            src_file = cache.file_index.find_file(model)
+            dst_file = os.path.join(path, new_name)
+
+            # Model file not found
+            if src_file is None:
+                reporter.error("Model '{}' not found".format(model), model)
+                continue
+
+            # Check for duplicates
+            if dst_file in written_files:
+                reporter.error("Duplcate model '{}'".format(new_name), dst_file)
+                continue
+
+            # Copy the file
+            await output.copy_async(src_file, dst_file, shared=True)
+            written_files.add(dst_file)
+
+            reporter.item(src_file, cache.file_index.size(src_file))
+
+    aio.run(collect())
+
+
+# =============================================================================
+
+
+def process_schematics(inp_sch_file, out_sch_file, symbol_map=None, footprint_map=None):
+    """
+    Remaps library references to symbol names in a schematic file.
+    """
+
+    # Load schematic file
+    with open(inp_sch_file, "r") as fp:
+        if inp_sch_file.lower().endswith(".kicad_sch"):
+            sch_data = [remap_kicad_schematic(fp.read(), symbol_map, footprint_map)]
+        else:
+            sch_data = remap_schematic(fp.readlines(), symbol_map, footprint_map)
+
+    # Write the modified schematic file
+    with open(out_sch_file, "w") as fp:
+        fp.writelines(sch_data)
+
+
+def remap_schematic(sch_data, symbol_map=None, footprint_map=None):
+    """
+    Remaps library references to symbol names given a list of schematic file
+    lines. Returns a list of modified lines.
+    """
+
+    sch_data = list(sch_data)
 
     # Remap symbol references
     if symbol_map:
@@ -644,9 +1441,67 @@ def process_schematics(inp_sch_file, out_sch_file, symbol_map=None, footprint_ma
                         sch_data[i] = sch_data[i].replace(tag1, tag2)
                         break
 
-    # Write the modified schematic file
-    with open(out_sch_file, "w") as fp:
-        fp.writelines(sch_data)
+    return sch_data
+
+
+def remap_kicad_schematic(sch_data, symbol_map=None, footprint_map=None):
+    """
+    Remaps library references to symbol and footprint names given content
+    of a KiCad 6+ schematic sheet. Symbol definitions cached in the sheet
+    are renamed as well. Returns the modified content. The sheet is
+    streamed, only nodes which are changed are parsed and written, the rest
+    is copied unchanged.
+    """
+
+    symbol_names = {"{}:{}".format(s1.lib, s1.name): "{}:{}".format(s2.lib, s2.name)
+                    for s1, s2 in (symbol_map or {}).items()}
+    footprint_names = {"{}:{}".format(f1.lib, f1.name): "{}:{}".format(f2.lib, f2.name)
+                       for f1, f2 in (footprint_map or {}).items()}
+
+    parts = []
+    pos = 0
+
+    def replace(start, end, text):
+        nonlocal pos
+        parts.append(sch_data[pos:start])
+        parts.append(text)
+        pos = end
+
+    for keyword, start, end in bracket_tree.iter_children(sch_data, escapes=True):
+
+        # Rename cached symbol definitions
+        if keyword == "lib_symbols":
+            for child, child_start, child_end in bracket_tree.iter_children(
+                    sch_data, start, end, escapes=True):
+                if child != "symbol":
+                    continue
+
+                lib_id = bracket_tree.node_head(sch_data, child_start, escapes=True)[1]
+                if lib_id in symbol_names:
+                    child_start, child_end = bracket_tree.line_span(sch_data, child_start, child_end)
+                    body = sch_data[child_start:child_end]
+                    indent = body[:len(body) - len(body.lstrip())]
+                    replace(child_start, child_end,
+                            symbol_lib.format_sexpr_symbol(body, symbol_names[lib_id], indent))
+
+        # Remap symbol and footprint references
+        elif keyword == "symbol":
+            node = bracket_tree.parse_concrete(sch_data[start:end], escapes=True)
+
+            lib_id = node.find("lib_id")
+            if lib_id is not None and lib_id.attributes and \
+               lib_id.attributes[0] in symbol_names:
+                lib_id.child[0] = symbol_names[lib_id.attributes[0]]
+
+            for prop in bracket_tree.select(node, "property[0=Footprint]"):
+                if len(prop.attributes) >= 2 and prop.attributes[1] in footprint_names:
+                    prop.child[1] = footprint_names[prop.attributes[1]]
+
+            if bracket_tree.is_modified(node):
+                replace(start, end, bracket_tree.dump_concrete(node))
+
+    parts.append(sch_data[pos:])
+    return "".join(parts)
 
 
 def process_boards(inp_brd_file, out_brd_file, footprint_map, model_map):
@@ -658,351 +1513,1693 @@ def process_boards(inp_brd_file, out_brd_file, footprint_map, model_map):
     with open(inp_brd_file, "r") as fp:
         brd_data = fp.read()
 
-    # FIXME: Possible symbol vs. footprint name conflict!
-    # This is done in a "brutal" way. Should read the PCB structure, replace
-    # attributes of nodes and write it back.
-    for f1, f2 in footprint_map.items():
-        tag1 = "{}:{}".format(f1.lib, f1.name)
-        tag2 = "{}:{}".format(f2.lib, f2.name)
-
-        brd_data = brd_data.replace(tag1, tag2)
-
-    for m1, m2 in model_map.items():
-        brd_data = brd_data.replace(m1, m2)
+    brd_data = remap_board(brd_data, footprint_map, model_map)
 
     # Write the modified board file
     with open(out_brd_file, "w") as fp:
         fp.write(brd_data)
 
+
+def remap_board(brd_data, footprint_map, model_map):
+    """
+    Remaps library references to footprint names given board file content.
+    Returns the modified content. Only names of modules and their models
+    are changed, the rest of the file is written back unchanged.
+    """
+
+    root = bracket_tree.parse(brd_data, keep_source=True, escapes=uses_escapes(brd_data))
+
+    # The root should be "kicad_pcb"
+    assert root.keyword == "kicad_pcb"
+
+    nodes = [n for keyword in FOOTPRINT_KEYWORDS for n in bracket_tree.select(root, keyword)]
+    for node in nodes:
+
+        # Remap the footprint
+        footprint = node.attributes[0]
+        if ":" in footprint:
+            lib, name = footprint.split(":")
+            footprint = Footprint(name = name, lib = lib)
+
+            if footprint in footprint_map:
+                new_footprint = footprint_map[footprint]
+                node.child[0] = "{}:{}".format(new_footprint.lib, new_footprint.name)
+
+        # Remap its models
+        for item in bracket_tree.select(node, "model"):
+            model = item.attributes[0]
+            if model in model_map:
+                item.child[0] = model_map[model]
+
+    return bracket_tree.dump(root)
+
 # =============================================================================
 
-def main():
+# Global KiCad configuration files
+KICAD_CONFIG_FILES = ["kicad_common", "sym-lib-table", "fp-lib-table"]
 
-    # Parse arguments
-    parser = argparse.ArgumentParser(
-        description=__doc__,
-        formatter_class=argparse.RawDescriptionHelpFormatter
-        )
+# Version of the configuration snapshot format
+CONFIG_SNAPSHOT_VERSION = 1
 
-    parser.add_argument(
-        "-i",
-        required=True,
-        type=str,
-        help="KiCad project path"
-    )
 
-    parser.add_argument(
-        "-o",
-        required=True,
-        type=str,
-        help="Output path for the \"liberated\" project"
-    )
+def config_snapshot_file():
+    """
+    Returns the file name of the global KiCad configuration snapshot, in
+    the user cache directory.
+    """
 
-    args = parser.parse_args()
-    inp_path = args.i
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or \
+                os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "kicad_liberator", "kicad_config.json")
 
-    # .....................................................
 
-    # Load global KiCad configuration
-    print("Loading KiCad configuration...")
+def kicad_config_state(kicad_dir):
+    """
+    Returns modification times and sizes of global KiCad configuration
+    files, None for missing ones. A snapshot is valid as long as they do
+    not change.
+    """
+
+    state = {}
+    for file_name in KICAD_CONFIG_FILES:
+        try:
+            st = os.stat(os.path.join(kicad_dir, file_name))
+            state[file_name] = [st.st_mtime_ns, st.st_size]
+        except OSError:
+            state[file_name] = None
+
+    return state
+
+
+def load_config_snapshot(file_name, kicad_dir, state):
+    """
+    Loads a global KiCad configuration snapshot. Returns None if there is
+    none or if it does not match the configuration directory and the state
+    of its files.
+    """
+
+    try:
+        with open(file_name, "r") as fp:
+            snapshot = json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(snapshot, dict) or \
+       snapshot.get("version") != CONFIG_SNAPSHOT_VERSION or \
+       snapshot.get("kicad_dir") != kicad_dir or \
+       snapshot.get("state") != state:
+        return None
+
+    try:
+        return KiCadConfig(
+            env_vars       = dict(snapshot["env_vars"]),
+            symbol_libs    = {l[0]: Library(*l) for l in snapshot["symbol_libs"]},
+            footprint_libs = {l[0]: Library(*l) for l in snapshot["footprint_libs"]}
+            )
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def save_config_snapshot(file_name, kicad_dir, state, config):
+    """
+    Saves a global KiCad configuration snapshot. The snapshot is only a
+    cache so failures are ignored.
+    """
+
+    snapshot = {
+        "version":        CONFIG_SNAPSHOT_VERSION,
+        "kicad_dir":      kicad_dir,
+        "state":          state,
+        "env_vars":       config.env_vars,
+        "symbol_libs":    [list(l) for l in config.symbol_libs.values()],
+        "footprint_libs": [list(l) for l in config.footprint_libs.values()],
+    }
+
+    # Write to a temporary file first so that concurrent runs never read
+    # a partial snapshot.
+    tmp_file = "{}.{}.tmp".format(file_name, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        with open(tmp_file, "w") as fp:
+            json.dump(snapshot, fp)
+        os.replace(tmp_file, file_name)
+    except OSError:
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+
+
+def load_kicad_config(kicad_dir=None, snapshot=True):
+    """
+    Loads global KiCad configuration: environmental variables and symbol and
+    footprint library tables.
+
+    The resolved configuration is kept in a snapshot (see
+    config_snapshot_file()) which is used instead of parsing the files
+    again until any of them changes. Disabled with snapshot=False.
+    """
 
     # FIXME: How that would work on Windows/MaxOs ??
     # Where there is KiCad configuration stored ?
-    home_dir  = os.path.expanduser("~")
-    kicad_dir = os.path.join(home_dir, os.path.join(".config", "kicad"))
+    if kicad_dir is None:
+        home_dir  = os.path.expanduser("~")
+        kicad_dir = os.path.join(home_dir, os.path.join(".config", "kicad"))
+
+    kicad_dir = os.path.abspath(kicad_dir)
+
+    # Use the snapshot if it is valid. The state is taken before loading so
+    # that a change made meanwhile invalidates the new snapshot.
+    if snapshot:
+        snapshot_file = config_snapshot_file()
+        state = kicad_config_state(kicad_dir)
+
+        config = load_config_snapshot(snapshot_file, kicad_dir, state)
+        if config is not None:
+            return config
+
+    def load(file_name, loader):
+        file_name = os.path.join(kicad_dir, file_name)
+        if os.path.isfile(file_name):
+            return loader(file_name)
+        return {}
+
+    # Load environmental variables and globally available symbol and
+    # footprint libraries
+    config = KiCadConfig(
+        env_vars       = load("kicad_common", load_kicad_env_vars),
+        symbol_libs    = load("sym-lib-table", load_lib_table),
+        footprint_libs = load("fp-lib-table", load_lib_table)
+        )
 
-    # Environmental variables
-    file_name = os.path.join(kicad_dir, "kicad_common")
-    if os.path.isfile(file_name):
-        kicad_env_vars = load_kicad_env_vars(file_name)
-    else:
-        kicad_env_vars = {}
+    if snapshot:
+        save_config_snapshot(snapshot_file, kicad_dir, state, config)
 
-    # Add KIPRJMOD environmental variable which points to the project path
-    kicad_env_vars["KIPRJMOD"] = inp_path
+    return config
 
-    # Load globally available symbol libraries
-    symbol_libs = set()
 
-    file_name = os.path.join(kicad_dir, "sym-lib-table")
-    if os.path.isfile(file_name):
-        symbol_libs |= load_lib_table(file_name)
+class Project(object):
+    """
+    Holds state of a single project being liberated: its files, library
+    tables and symbols, footprints and models identified by scanning it.
+    Project files may be given in memory in the "contents" dict, otherwise
+    they are read from the project path.
 
-    # Load globally available footprint libraries
-    footprint_libs = set()
+    When a spill store is given footprints extracted from boards are kept
+    in it, see LibraryCache.
+    """
 
-    file_name = os.path.join(kicad_dir, "fp-lib-table")
-    if os.path.isfile(file_name):
-        footprint_libs |= load_lib_table(file_name)
+    def __init__(self, path, contents=None, store=None):
+        self.path = path
+        self.contents = contents if contents is not None else {}
+        self.store = store
 
-    # .....................................................
+        # Identify project files
+        if contents is not None:
+            self.files = find_project_files(path, list(contents.keys()))
+        else:
+            self.files = find_project_files(path)
+
+        # Get project name
+        self.name = self.files["pro"].rsplit(".", maxsplit=1)[0]
+
+        self.symbol_libs = None
+        self.footprint_libs = None
+        self.substituter = None
+
+        self.lib_symbols = set()
+        self.lib_footprints = set()
+        self.lib_models = set()
+        self.sch_symbols = {}
+        self.pcb_footprints = {}
+        self.pcb_models = set()
+
+        # Scan results of individual sheets and boards
+        self.sch_scans = {}
+        self.brd_scans = {}
+
+    def merge_scans(self):
+        """
+        Combines scan results of all sheets and boards into the sets of
+        used symbols, footprints and models.
+        """
+
+        self.lib_symbols = set()
+        self.lib_footprints = set()
+        self.sch_symbols = {}
+        for f in self.files["sch"]:
+            syms, fps, cached = self.sch_scans[f]
+            self.lib_symbols    |= syms
+            self.lib_footprints |= fps
+            self.sch_symbols.update(cached)
+
+        # Footprints of later boards take precedence. A view is used so that
+        # spilled footprints are not loaded.
+        self.pcb_footprints = ChainMap(*[self.brd_scans[f][0] for f in reversed(self.files["brd"])])
+        self.pcb_models = set()
+        for f in self.files["brd"]:
+            self.pcb_models |= self.brd_scans[f][1]
+
+    def has(self, name):
+        """
+        Returns True if the project has the given file.
+        """
+        if name in self.contents:
+            return True
+        return os.path.isfile(os.path.join(self.path, name))
+
+    def read(self, name):
+        """
+        Returns content of a project file.
+        """
+        if name in self.contents:
+            return self.contents[name]
+
+        with open(os.path.join(self.path, name), "r") as fp:
+            return fp.read()
+
+
+Plan = namedtuple("Plan", "symbol_lib footprint_lib model_dir symbol_map footprint_map model_map")
+
+
+class Liberator(object):
+    """
+    A liberation session. Holds the global KiCad configuration, the library
+    cache and the I/O pipeline, which are reused for all projects liberated
+    with it. A project is processed in three steps: scan(), plan() and
+    write(). The liberate() method does all of them.
 
-    # Identify project files
-    proj = find_project_files(inp_path)
+    When a model store is given, 3D models of projects written to
+    directories are linked from the store instead of being copied.
 
-    # Get project name
-    proj_name = proj["pro"].rsplit(".", maxsplit=1)[0]
+    Progress is reported through the given reporter, by default through
+    the process-wide one.
 
-    # Dump some info
-    print("")
-    print("Project '{}'".format(proj_name))
-    print("", proj["pro"])
+    With a memory budget (in bytes) parsed footprints are kept in a spill
+    store, which moves them to a temporary file once the process RSS
+    exceeds the budget. They are loaded back only when needed.
 
-    print("Schematics:")
-    for f in proj["sch"]:
-        print("", f)
+    With parse_jobs set, boards and library footprints are parsed by that
+    many worker processes, see ParsePool.
+    """
 
-    print("Boards:")
-    for f in proj["brd"]:
-        print("", f)
+    def __init__(self, config=None, cache=None, aio=None, model_store=None,
+                 link_mode="hardlink", reporter=None, memory_budget=None,
+                 parse_jobs=0):
+        self.reporter = reporter if reporter is not None else get_reporter()
 
-    print("")
+        self.spill_store = None
+        if memory_budget is not None:
+            from spill_store import SpillStore
+            self.spill_store = SpillStore(memory_budget)
 
-    # Load project library tables
-    print("Loading library tables...")
+        self.parse_pool = None
+        if parse_jobs > 0:
+            from parse_pool import ParsePool
+            self.parse_pool = ParsePool(parse_jobs)
 
-    file_name = os.path.join(inp_path, "sym-lib-table")
-    if os.path.isfile(file_name):
-        symbol_libs |= load_lib_table(file_name)
+        self.config = config if config is not None else load_kicad_config()
+        self.cache  = cache if cache is not None else \
+                      LibraryCache(self.spill_store, self.parse_pool)
 
-    file_name = os.path.join(inp_path, "fp-lib-table")
-    if os.path.isfile(file_name):
-        footprint_libs |= load_lib_table(file_name)
+        self.own_aio = aio is None
+        if self.own_aio:
+            from async_io import AsyncIO
+            aio = AsyncIO()
 
-    # Substitute environmental variables in library file names
-    symbol_libs = [Library(l.name, substitute_env_vars(l.filename, kicad_env_vars))
-        for l in symbol_libs]
+        self.aio = aio
 
-    footprint_libs = [Library(l.name, substitute_env_vars(l.filename, kicad_env_vars))
-        for l in footprint_libs]
+        if isinstance(model_store, str):
+            from model_store import ModelStore
+            model_store = ModelStore(model_store)
 
-    # .....................................................
+        self.model_store = model_store
+        self.link_mode   = link_mode
 
-    # Identify used symbols and footprints
-    print("Identifying used schematic symbols and footrpints...")
+    def close(self):
+        """
+        Releases resources held by the session.
+        """
+        if self.model_store is not None:
+            self.model_store.save()
+        if self.own_aio:
+            self.aio.close()
+        if self.parse_pool is not None:
+            self.parse_pool.close()
 
-    lib_symbols = set()
-    lib_footprints = set()
-    lib_models = set()
-    pcb_footprints = {}
-    pcb_models = set()
+        if self.spill_store is not None:
+            store = self.spill_store
+            self.reporter.event("spill", items=store.spilled_items,
+                                bytes=store.spilled_bytes, loaded=store.loaded_items)
+            store.close()
 
-    for f in proj["sch"]:
-        sch_file = os.path.join(inp_path, f)
+    def __enter__(self):
+        return self
 
-        syms, fps = identify_used_symbols_and_footprints(sch_file)
-        lib_symbols    |= syms
-        lib_footprints |= fps
+    def __exit__(self, *args):
+        self.close()
 
-    # Identify used footprints and 3d models
-    print("Identifying used PCB footprints and 3D models...")
+    # .........................................................................
 
-    for f in proj["brd"]:
-        brd_file = os.path.join(inp_path, f)
-        fps, mdls = gather_footprints_and_identify_models(brd_file)
-        pcb_footprints.update(fps)
-        pcb_models |= mdls
+    def scan(self, inp_path, contents=None):
+        """
+        Scans a project, identifies all used symbols, footprints and models.
+        Returns a Project object.
+        """
 
-    # Identify 3D models used by footprint libraries
-    lib_models |= identify_used_models(lib_footprints, footprint_libs)
+        project = Project(inp_path, contents, self.spill_store)
+        reporter = self.reporter
+        reporter.context["project"] = project.name
 
-    # Preprocess PCB footprints
-    pcb_footprints = preprocess_pcb_footprints(pcb_footprints)
-   
-    # .....................................................
+        # Dump some info
+        reporter.info("")
+        reporter.info("Project '{}'".format(project.name))
+        reporter.info(" " + project.files["pro"])
 
-    # Build symbol map
-    symbol_lib = Library(
-        name=proj_name, 
-        filename=proj_name + ".lib"
-        )
+        reporter.info("Schematics:")
+        for f in project.files["sch"]:
+            reporter.info(" " + f)
 
-    symbol_map = {}
-    used_names = set()
+        reporter.info("Boards:")
+        for f in project.files["brd"]:
+            reporter.info(" " + f)
 
-    # FIXME: This will fail if there are two symbols with the same name in
-    # different libraries but one of them has an ALIAS.
-    for symbol in lib_symbols:
-        new_name  = symbol.name
-        suffix_id = 0
+        reporter.info("")
 
-        while new_name in used_names:
-            suffix_id += 1
-            new_name = symbol.name + "_{:02d}".format(suffix_id)
-        
-        symbol_map[symbol] = Symbol(
-            name=new_name,
-            lib=symbol_lib.name
-            )
+        # Add KIPRJMOD environmental variable which points to the project path
+        kicad_env_vars = dict(self.config.env_vars)
+        kicad_env_vars["KIPRJMOD"] = inp_path
 
-        used_names.add(new_name)
+        # Load project library tables. Project libraries override global
+        # ones of the same name, global tables are not copied.
+        reporter.begin("lib-tables", "Loading library tables...")
 
-    # Build footprint map
-    all_footprints = set(lib_footprints | set(pcb_footprints.keys()))
+        symbol_libs = {}
+        if project.has("sym-lib-table"):
+            symbol_libs = parse_lib_table(project.read("sym-lib-table"))
 
-    footprint_lib = Library(
-        name=proj_name,
-        filename="footprints.pretty"
-        )
+        footprint_libs = {}
+        if project.has("fp-lib-table"):
+            footprint_libs = parse_lib_table(project.read("fp-lib-table"))
 
-    footprint_map = {}
-    used_names = set()
+        # Library file names are resolved on demand
+        project.substituter = EnvVarSubstituter(kicad_env_vars)
 
-    for footprint in all_footprints:
-        new_name  = footprint.name
-        suffix_id = 0
+        project.symbol_libs = LibraryTable(
+            ChainMap(symbol_libs, self.config.symbol_libs), project.substituter)
 
-        while new_name in used_names:
-            suffix_id += 1
-            new_name = footprint.name + "_{:02d}".format(suffix_id)
-        
-        footprint_map[footprint] = Footprint(
-            name=new_name,
-            lib=footprint_lib.name
+        project.footprint_libs = LibraryTable(
+            ChainMap(footprint_libs, self.config.footprint_libs), project.substituter)
+
+        # .....................................................
+
+        # Identify used symbols and footprints
+        reporter.begin("scan-schematics", "Identifying used schematic symbols and footrpints...",
+                       len(project.files["sch"]))
+
+        for f in project.files["sch"]:
+            self.scan_file(project, f)
+
+        # Identify used footprints and 3d models
+        reporter.begin("scan-boards", "Identifying used PCB footprints and 3D models...",
+                       len(project.files["brd"]))
+
+        self.scan_files(project, project.files["brd"])
+
+        reporter.begin("scan-libraries")
+        self._scan_libraries(project)
+
+        reporter.end()
+        return project
+
+    def scan_file(self, project, file_name):
+        """
+        Scans a single sheet or board of a project and keeps the result.
+        """
+
+        data = project.read(file_name)
+
+        if file_name in project.files["sch"]:
+            if project.files["legacy"]:
+                project.sch_scans[file_name] = scan_schematic(data.splitlines()) + ({},)
+            else:
+                project.sch_scans[file_name] = scan_kicad_schematic(data)
+        else:
+            fps, mdls = scan_board(data)
+            self._keep_board_scan(project, file_name, fps, mdls)
+
+        self.reporter.item(file_name, len(data))
+
+    def scan_files(self, project, file_names):
+        """
+        Scans sheets and boards of a project, see scan_file(). With a parse
+        pool boards are scanned in parallel by its workers.
+        """
+
+        boards = [f for f in file_names if f not in project.files["sch"]]
+        if self.parse_pool is None or not boards:
+            for f in file_names:
+                self.scan_file(project, f)
+            return
+
+        for f in file_names:
+            if f not in boards:
+                self.scan_file(project, f)
+
+        data = [project.read(f) for f in boards]
+        results = self.parse_pool.map(scan_board_spans, data)
+
+        for f, d, (_, (spans, mdls)) in zip(boards, data, results):
+            self._keep_board_scan(project, f, BoardFootprints(d, spans, uses_escapes(d)), mdls)
+            self.reporter.item(f, len(d))
+
+    def _keep_board_scan(self, project, file_name, fps, mdls):
+        if project.store is not None:
+            fps.keep_in(project.store)
+
+        project.brd_scans[file_name] = (fps, mdls)
+
+    def _scan_libraries(self, project):
+        """
+        Merges scan results, resolves libraries and identifies 3D models
+        used by library footprints.
+        """
+
+        project.merge_scans()
+
+        # Resolve only libraries referenced by the project
+        project.symbol_libs.resolve_all({s.lib for s in project.lib_symbols})
+        project.footprint_libs.resolve_all({f.lib for f in project.lib_footprints} |
+                                           {f.lib for f in project.pcb_footprints})
+
+        # Identify 3D models used by footprint libraries
+        project.lib_models = identify_used_models(project.lib_footprints,
+            project.footprint_libs, self.cache, self.aio)
+
+    def rescan(self, project, file_names):
+        """
+        Scans again the given sheets and boards of a scanned project and
+        updates its used symbols, footprints and models.
+        """
+
+        self.reporter.begin("rescan", total=len(file_names))
+
+        self.scan_files(project, file_names)
+
+        self._scan_libraries(project)
+        self.reporter.end()
+
+    def plan(self, project):
+        """
+        Builds symbol, footprint and model maps for a scanned project.
+        Returns a Plan.
+        """
+
+        # Build symbol map, the library format follows the project one
+        if project.files["legacy"]:
+            symbol_lib = Library(
+                name=project.name,
+                filename=project.name + ".lib",
+                type="Legacy"
+                )
+        else:
+            symbol_lib = Library(
+                name=project.name,
+                filename=project.name + ".kicad_sym",
+                type="KiCad"
+                )
+
+        symbol_map = build_symbol_map(project.lib_symbols, symbol_lib.name)
+
+        # Build footprint map
+        all_footprints = set(project.lib_footprints | set(project.pcb_footprints.keys()))
+
+        footprint_lib = Library(
+            name=project.name,
+            filename="footprints.pretty"
             )
 
-        used_names.add(new_name)
+        footprint_map = build_footprint_map(all_footprints, footprint_lib.name,
+                                            self.footprint_digests(project, all_footprints))
+
+        # Build 3d model map
+        all_models = project.lib_models | project.pcb_models
+        model_dir  = "models"
+        model_lib  = os.path.join("${KIPRJMOD}", model_dir)
+
+        model_map = build_model_map(all_models, model_lib)
+
+        return Plan(symbol_lib, footprint_lib, model_dir,
+                    symbol_map, footprint_map, model_map)
+
+    def footprint_digests(self, project, footprints):
+        """
+        Returns digests of definitions of the given footprints which are to
+        be written, see footprint_digest(). Library definitions loaded while
+        scanning take precedence over PCB ones. Footprints without any are
+        left out.
+        """
+
+        digests = {}
+        for footprint in footprints:
+
+            src_file = None
+            lib_file = project.footprint_libs.filename(footprint.lib)
+            if lib_file is not None:
+                src_file = self.cache.file_index.find(lib_file, footprint.name + ".kicad_mod")
+
+            if src_file is not None and src_file in self.cache.footprints:
+                digests[footprint] = self.cache.footprint_digest(src_file)
+            elif footprint in project.pcb_footprints:
+                digests[footprint] = footprint_digest(project.pcb_footprints[footprint])
+
+        return digests
+
+    def resolve(self, project, plan):
+        """
+        Resolves source files of all symbols, footprints and models of a
+        planned project without collecting or writing anything. Symbols are
+        looked up in indices of their libraries and footprints in their
+        library folders, so missing ones are reported as they would fail
+        in a real run. Returns a JSON serializable dict describing the plan.
+        """
+
+        file_index = self.cache.file_index
+
+        def file_info(file_name):
+            if file_name is None:
+                return None, None
+            return file_name, file_index.size(file_name)
+
+        # Symbols, looked up in indices of their libraries
+        lib_files = {}
+        for symbol in plan.symbol_map:
+            lib_file = project.symbol_libs.filename(symbol.lib)
+            if lib_file is not None:
+                lib_file = file_index.find_file(lib_file)
+            lib_files[symbol.lib] = lib_file
+
+        self.cache.load_symbol_libs(sorted({f for f in lib_files.values() if f is not None}),
+                                    self.aio, self.reporter)
+
+        symbols = []
+
+        for symbol, new_symbol in plan.symbol_map.items():
+            lib_file = lib_files[symbol.lib]
+            found = lib_file is not None and \
+                    self.cache.symbol_libs[lib_file].get(symbol.name) is not None
+
+            source, size = file_info(lib_file if found else None)
+            if found:
+                status = "library"
+            elif symbol in project.sch_symbols:
+                status = "schematic"
+            elif lib_file is not None:
+                status = "missing"
+            else:
+                status = "missing_library"
+
+            symbols.append({
+                "lib": symbol.lib,
+                "name": symbol.name,
+                "new_name": new_symbol.name,
+                "status": status,
+                "source": source,
+                "size": size,
+            })
+
+        # Footprints, taken either from libraries or from PCBs
+        footprints = []
+
+        for footprint, new_footprint in plan.footprint_map.items():
+            src_file = None
+            lib_file = project.footprint_libs.filename(footprint.lib)
+            if lib_file is not None:
+                src_file = file_index.find(lib_file, footprint.name + ".kicad_mod")
+
+            source, size = file_info(src_file)
+            if source is not None:
+                status = "library"
+            elif footprint in project.pcb_footprints:
+                status = "pcb"
+            else:
+                status = "missing"
+
+            footprints.append({
+                "lib": footprint.lib,
+                "name": footprint.name,
+                "new_name": new_footprint.name,
+                "status": status,
+                "source": source,
+                "size": size,
+            })
+
+        # 3D models
+        models = []
+
+        for model, new_model in plan.model_map.items():
+            source, size = file_info(file_index.find_file(
+                project.substituter.substitute(model)))
+
+            models.append({
+                "name": model,
+                "new_name": new_model,
+                "status": "library" if source else "missing",
+                "source": source,
+                "size": size,
+            })
+
+        # Summary
+        items = {"symbols": symbols, "footprints": footprints, "models": models}
+        summary = {}
+
+        for key, entries in items.items():
+            summary[key] = len(entries)
+            summary["unresolved_" + key] = len([e for e in entries
+                if e["status"].startswith("missing")])
+            summary[key + "_size"] = sum({e["source"]: e["size"] for e in entries
+                if e["source"]}.values())
+
+        return dict(
+            project=project.name,
+            path=project.path,
+            symbol_lib=plan.symbol_lib.filename,
+            footprint_lib=plan.footprint_lib.filename,
+            model_dir=plan.model_dir,
+            summary=summary,
+            **items
+            )
 
-    # Build 3d model map
-    all_models = lib_models | pcb_models
-    model_lib  = os.path.join("${KIPRJMOD}", "models")
+    def write(self, project, plan, output):
+        """
+        Collects library content and writes the "liberated" project to the
+        given output.
+        """
 
-    model_map = {}
-    used_names = set()
+        # Initialize "liberated" project
+        pro_file = project.files["pro"]
+        if pro_file in project.contents:
+            output.write(pro_file, project.contents[pro_file])
+        else:
+            output.copy(os.path.join(project.path, pro_file), pro_file)
+
+        self.write_symbols(project, plan, output)
+        self.write_footprints(project, plan, output)
+        self.write_models(project, plan, output)
+        self.write_sheets(project, plan, output)
+        self.write_boards(project, plan, output)
+
+        self.reporter.end()
+
+    def write_symbols(self, project, plan, output):
+        """
+        Collects symbols, remaps their names and writes the new symbol
+        library and its sym-lib-table.
+        """
+
+        # Symbols are written in the symbol map order so that the output is
+        # reproducible.
+        reporter = self.reporter
+        reporter.begin("symbols", "Collecting schematic symbols from libraries...",
+                       len(plan.symbol_map))
+        if plan.symbol_lib.type == "Legacy":
+            write_symbol_lib(output, plan.symbol_lib.filename, plan.symbol_map,
+                             project.symbol_libs, self.cache, self.aio, reporter)
+        else:
+            write_kicad_symbol_lib(output, plan.symbol_lib.filename, plan.symbol_map,
+                                   project.symbol_libs, project.sch_symbols, self.cache,
+                                   self.aio, reporter)
+
+        # Write sym-lib-table
+        root = bracket_tree.Node(None, "sym_lib_table")
+        node = bracket_tree.Node(root, "lib")
+        root.add(node)
+        node.add(bracket_tree.Node(node, "name",    [plan.symbol_lib.name]))
+        node.add(bracket_tree.Node(node, "type",    [plan.symbol_lib.type]))
+        node.add(bracket_tree.Node(node, "uri",     ["${KIPRJMOD}/" + plan.symbol_lib.filename]))
+        node.add(bracket_tree.Node(node, "options", [""]))
+        node.add(bracket_tree.Node(node, "descr",   [""]))
+
+        output.write("sym-lib-table", bracket_tree.dump(root))
+
+    def write_footprints(self, project, plan, output, footprints=None):
+        """
+        Collects footprints, remaps their names and writes them to the new
+        footprint library along with its fp-lib-table. Optionally only the
+        given footprints are written.
+        """
+
+        if footprints is None:
+            footprints = plan.footprint_map.keys()
+
+        lib_footprints = {f for f in footprints if f in project.lib_footprints}
+
+        # Identical footprints share a single library entry, write it once
+        unique = {}
+        for footprint in sorted(lib_footprints, key=sort_key):
+            unique.setdefault(plan.footprint_map[footprint], footprint)
+        lib_footprints = set(unique.values())
+
+        # Collect footprints from footprint libraries
+        reporter = self.reporter
+        reporter.begin("footprints", "Collecting PCB footprints from libraries...",
+                       len(footprints))
+        lib_footprints = collect_footprints_from_libraries(lib_footprints,
+            project.footprint_libs, self.cache, self.aio, reporter)
+
+        # For missing footprints, take their definitions directly from the PCB.
+        # Each lookup parses a new tree so it may be modified.
+        for footprint in lib_footprints:
+
+            if lib_footprints[footprint] is not None:
+                continue
 
-    for model in all_models:
-        name = os.path.basename(model)
-        new_name = name
-        suffix = 0
+            if footprint not in project.pcb_footprints:
+                reporter.error("Footprint '{}' not found in PCB(s)!".format(footprint.name),
+                               "{}:{}".format(footprint.lib, footprint.name))
+                continue
 
-        while new_name in used_names:
-            suffix_id += 1
-            parts = os.path.splitext(name)
-            new_name = parts[0] + "_{:02d}".format(suffix_id) + parts[1]
+            reporter.info(" Extracting '{}' from PCB".format(footprint.name))
+            lib_footprints[footprint] = project.pcb_footprints[footprint]
+
+        # Write footprints to the new library
+        process_footprints(lib_footprints, plan.footprint_map, plan.model_map,
+                           plan.footprint_lib.filename, self.aio, output, reporter)
+
+        # Write fp-lib-table
+        root = bracket_tree.Node(None, "fp_lib_table")
+        node = bracket_tree.Node(root, "lib")
+        root.add(node)
+        node.add(bracket_tree.Node(node, "name",    [plan.footprint_lib.name]))
+        node.add(bracket_tree.Node(node, "type",    ["KiCad"]))
+        node.add(bracket_tree.Node(node, "uri",     [os.path.join("${KIPRJMOD}", plan.footprint_lib.filename)]))
+        node.add(bracket_tree.Node(node, "options", [""]))
+        node.add(bracket_tree.Node(node, "descr",   [""]))
+
+        output.write("fp-lib-table", bracket_tree.dump(root))
+
+    def write_models(self, project, plan, output, models=None):
+        """
+        Collects 3D models. Optionally only the given models are collected.
+        """
+
+        if models is None:
+            models = plan.model_map.keys()
+
+        # Substitute environmental variables in model names
+        all_models = {project.substituter.substitute(m): os.path.basename(plan.model_map[m])
+            for m in models}
+
+        # Collect 3d models
+        self.reporter.begin("models", "Collecting 3D models from libraries...",
+                            len(all_models))
+        collect_models(all_models, plan.model_dir, self.cache, self.aio, output,
+                       self.reporter)
+
+    def write_sheets(self, project, plan, output, files=None):
+        """
+        Processes schematic files, substitutes symbol and footprint
+        references. Optionally only the given files are processed.
+        """
+
+        if files is None:
+            files = project.files["sch"]
+
+        reporter = self.reporter
+        reporter.begin("schematics", "Processing schematic files...", len(files))
+        for sch_file in files:
+            if project.files["legacy"]:
+                sch_data = "".join(remap_schematic(
+                    project.read(sch_file).splitlines(keepends=True),
+                    plan.symbol_map, plan.footprint_map
+                ))
+            else:
+                sch_data = remap_kicad_schematic(
+                    project.read(sch_file),
+                    plan.symbol_map, plan.footprint_map
+                )
+            output.write(sch_file, sch_data)
+            reporter.item(sch_file, len(sch_data), message=" {}".format(sch_file))
+
+    def write_boards(self, project, plan, output, files=None):
+        """
+        Processes board files, substitutes footprint references. Optionally
+        only the given files are processed.
+        """
+
+        if files is None:
+            files = project.files["brd"]
+
+        reporter = self.reporter
+        reporter.begin("boards", "Processing board files...", len(files))
+        for brd_file in files:
+            brd_data = remap_board(
+                project.read(brd_file),
+                plan.footprint_map,
+                plan.model_map
+            )
+            output.write(brd_file, brd_data)
+            reporter.item(brd_file, len(brd_data), message=" {}".format(brd_file))
+
+    def update(self, project, plan, output, file_names):
+        """
+        Incrementally updates a written project after some of its sheets and
+        boards changed. They are scanned again and a new plan is made. Then
+        only the changed files, files affected by renamed library items and
+        newly used library items are written. Items no longer used are
+        removed from the output. Returns the new plan.
+        """
+
+        self.rescan(project, file_names)
+        new_plan = self.plan(project)
+
+        def renamed(old_map, new_map):
+            return any(k in old_map and old_map[k] != v for k, v in new_map.items())
+
+        def changed_keys(old_map, new_map):
+            return [k for k, v in new_map.items() if old_map.get(k) != v]
+
+        def removed_values(old_map, new_map):
+            new_values = set(new_map.values())
+            return [v for v in old_map.values() if v not in new_values]
+
+        # Symbols are all in one library. KiCad 6+ sheets may also change
+        # symbol definitions cached in them.
+        if new_plan.symbol_map != plan.symbol_map or \
+           (not project.files["legacy"] and any(f in project.files["sch"] for f in file_names)):
+            self.write_symbols(project, new_plan, output)
+
+        # Footprints that are new or renamed, those taken from changed boards
+        # and all of them if models were renamed.
+        if renamed(plan.model_map, new_plan.model_map):
+            footprints = list(new_plan.footprint_map.keys())
+        else:
+            footprints = set(changed_keys(plan.footprint_map, new_plan.footprint_map))
+            for f in file_names:
+                if f in project.brd_scans:
+                    footprints |= set(project.brd_scans[f][0]) & set(new_plan.footprint_map)
+            footprints = sorted(footprints, key=sort_key)
+
+        if footprints:
+            self.write_footprints(project, new_plan, output, footprints)
+
+        for footprint in removed_values(plan.footprint_map, new_plan.footprint_map):
+            output.remove(os.path.join(new_plan.footprint_lib.filename,
+                                       footprint.name + ".kicad_mod"))
+
+        # Models that are new or renamed
+        models = changed_keys(plan.model_map, new_plan.model_map)
+        if models:
+            self.write_models(project, new_plan, output, models)
+
+        for model in removed_values(plan.model_map, new_plan.model_map):
+            output.remove(os.path.join(new_plan.model_dir, os.path.basename(model)))
+
+        # Changed sheets and boards, all of them if library items they use
+        # were renamed.
+        if renamed(plan.symbol_map, new_plan.symbol_map) or \
+           renamed(plan.footprint_map, new_plan.footprint_map):
+            sheets = project.files["sch"]
+        else:
+            sheets = [f for f in project.files["sch"] if f in file_names]
 
-        model_map[model] = os.path.join(model_lib, new_name)
-        used_names.add(new_name)
+        if renamed(plan.footprint_map, new_plan.footprint_map) or \
+           renamed(plan.model_map, new_plan.model_map):
+            boards = project.files["brd"]
+        else:
+            boards = [f for f in project.files["brd"] if f in file_names]
+
+        if sheets:
+            self.write_sheets(project, new_plan, output, sheets)
+        if boards:
+            self.write_boards(project, new_plan, output, boards)
+
+        self.reporter.end()
+        return new_plan
+
+    def liberate(self, inp_path, out_path=None, contents=None, output=None):
+        """
+        Liberates a project. The output is either a path or an output
+        object. Paths of zip and tar archives are recognized by their
+        extension. If no output is given the project is kept in memory.
+        Returns the output. The output is closed in any case, a partially
+        written archive is removed on failure.
+        """
+
+        if output is None:
+            from outputs import MemoryOutput, make_output
+            if out_path is not None:
+                output = make_output(out_path, aio=self.aio,
+                                     model_store=self.model_store,
+                                     link_mode=self.link_mode)
+            else:
+                output = MemoryOutput()
+
+        try:
+            project = self.scan(inp_path, contents)
+            plan = self.plan(project)
+            self.write(project, plan, output)
+
+            output.close()
+            self.reporter.info("Done.")
+
+        except BaseException:
+            output.abort()
+            raise
+
+        finally:
+            self.reporter.end()
+            self.reporter.context.pop("project", None)
+
+        return output
+
+
+def liberate_project(inp_path, out_path, config, cache=None, aio=None, fmt=None,
+                     model_store=None, link_mode="hardlink", memory_budget=None,
+                     parse_jobs=0):
+    """
+    Liberates a single project. The global KiCad configuration, library
+    cache and I/O pipeline may be shared between subsequent calls. The
+    project is written to a directory or to an archive of the given format.
+    """
 
-    # .....................................................
+    from outputs import make_output
 
-    out_path = args.o
+    with Liberator(config, cache, aio, model_store, link_mode,
+                   memory_budget=memory_budget, parse_jobs=parse_jobs) as liberator:
+        output = make_output(out_path, fmt, liberator.aio,
+                             liberator.model_store, link_mode)
+        liberator.liberate(inp_path, output=output)
 
-    # Initialize "liberated" project
-    os.makedirs(out_path, exist_ok=True)
-    copy(os.path.join(inp_path, proj["pro"]),
-         os.path.join(out_path, proj["pro"]))
+# =============================================================================
 
-    # .....................................................
 
-    # Collect symbols
-    print("Collecting schematic symbols from libraries...")
-    lib_symbols = collect_symbols(lib_symbols, symbol_libs)
+def snapshot_project(path):
+    """
+    Returns a dict of project files (.pro/.kicad_pro, sheets, boards and library
+    tables) in the given path and their modification times and sizes.
+    """
+
+    snapshot = {}
+    for entry in os.scandir(path):
+        name = entry.name.lower()
+        if name.endswith((".pro", ".sch", ".kicad_pro", ".kicad_sch", ".kicad_pcb")) or \
+           name in ["sym-lib-table", "fp-lib-table"]:
+            st = entry.stat()
+            snapshot[entry.name] = (st.st_mtime_ns, st.st_size)
 
-    # Remap names in symbol defs
-    lib_symbols = process_symbol_defs(lib_symbols, symbol_map)
+    return snapshot
 
-    # Write the new symbol library
-    lib_data = [
-        "EESchema-LIBRARY Version 2.4",
-        "#encoding utf-8",
-    ]
 
-    for symbol_def in lib_symbols.values():
-        lib_data.extend(symbol_def)
+def watch_project(inp_path, out_path, config, interval=0.5, model_store=None,
+                  link_mode="hardlink", memory_budget=None, parse_jobs=0):
+    """
+    Liberates a project to a directory and keeps watching the project for
+    changes until interrupted. Project files are polled for modification.
+    When only sheets or boards change, they are scanned again and the
+    output is updated incrementally (see Liberator.update()). Other
+    changes, eg. of library tables or of the set of files, make the whole
+    project to be liberated again. Library caches are kept all the time,
+    except for the file index which is refreshed for a whole run and after
+    errors, so that library files added meanwhile are found.
+    """
 
-    lib_data.extend([
-    "#",
-    "#End Library",
-    ])
+    from outputs import DirectoryOutput
 
-    lib_file = os.path.join(out_path, symbol_lib.filename)
-    with open(lib_file, "w") as fp:
-        fp.write("\n".join(lib_data))
+    with Liberator(config, model_store=model_store, link_mode=link_mode,
+                   memory_budget=memory_budget, parse_jobs=parse_jobs) as liberator:
+        reporter = liberator.reporter
+        output = DirectoryOutput(out_path, liberator.aio, liberator.model_store, link_mode)
 
+        def liberate():
+            project = liberator.scan(inp_path)
+            plan = liberator.plan(project)
+            liberator.write(project, plan, output)
+            return project, plan
 
-    # Write sym-lib-table
-    root = bracket_tree.Node(None, "sym_lib_table")
-    node = bracket_tree.Node(root, "lib")
-    root.add(node)
-    node.add(bracket_tree.Node(node, "name",    [symbol_lib.name]))
-    node.add(bracket_tree.Node(node, "type",    ["Legacy"]))
-    node.add(bracket_tree.Node(node, "uri",     ["${KIPRJMOD}/" + symbol_lib.filename]))
-    node.add(bracket_tree.Node(node, "options", [""]))
-    node.add(bracket_tree.Node(node, "descr",   [""]))
+        state  = snapshot_project(inp_path)
+        errors = reporter.errors
+        project, plan = liberate()
+        full = reporter.errors != errors
 
-    file_name = os.path.join(out_path, "sym-lib-table")
-    bracket_tree.save(file_name, root)
+        reporter.info("")
+        reporter.info("Watching '{}' for changes, press Ctrl+C to stop...".format(inp_path))
 
-    # .....................................................
+        try:
+            while True:
+                time.sleep(interval)
 
-    # Collect footprints from footprint libraries
-    print("Collecting PCB footprints from libraries...")
-    lib_footprints = collect_footprints_from_libraries(lib_footprints, footprint_libs)
+                new_state = snapshot_project(inp_path)
+                if new_state == state:
+                    continue
 
-    # For missing footprints, take their definitions directly from the PCB
-    for footprint in lib_footprints:
+                # Wait for writes to settle
+                while True:
+                    time.sleep(min(interval, 0.1))
+                    settled = snapshot_project(inp_path)
+                    if settled == new_state:
+                        break
+                    new_state = settled
+
+                # Files added or removed, or other than sheets and boards
+                # changed, need a full run.
+                changed = sorted(f for f in new_state if state.get(f) != new_state[f])
+                scanned = project.files["sch"] + project.files["brd"]
+
+                if set(new_state) != set(state) or \
+                   any(f not in scanned for f in changed):
+                    full = True
+
+                state = new_state
+
+                start  = time.perf_counter()
+                errors = reporter.errors
+                try:
+                    if full:
+                        reporter.info("Project changed, liberating again...")
+                        liberator.cache.refresh_files()
+                        project, plan = liberate()
+                        full = False
+                    else:
+                        reporter.info("Changed: {}".format(", ".join(changed)))
+                        plan = liberator.update(project, plan, output, changed)
 
-        if lib_footprints[footprint] is not None:
-            continue
+                    reporter.info("Updated in {:.3f}s".format(time.perf_counter() - start))
 
-        if footprint not in pcb_footprints:
-            print(" ERROR: Footprint '{}' not found in PCB(s)!".format(footprint.name))
+                    # Something was not found, look for it again next time
+                    if reporter.errors != errors:
+                        full = True
+
+                # A file may be caught in the middle of being saved, start
+                # from scratch on the next change.
+                except (OSError, RuntimeError, AssertionError, ValueError) as ex:
+                    reporter.error("Update failed: {}".format(str(ex) or type(ex).__name__))
+                    full = True
+
+        except KeyboardInterrupt:
+            reporter.info("")
+
+# =============================================================================
+
+
+# Quoted strings, skipped, and "model" node heads with the model file name
+MODEL_RE = re.compile(r"\"[^\"]*\"|\(\s*model\s+(?:\"([^\"]*)\"|([^\s()\"]+))")
+ESCAPED_MODEL_RE = re.compile(r"\"(?:[^\"\\]|\\.)*\"|"
+                              r"\(\s*model\s+(?:\"((?:[^\"\\]|\\.)*)\"|([^\s()\"]+))", re.S)
+
+
+def scan_footprint_models(data, start=0, end=None, escapes=False):
+    """
+    Returns a set of 3D models referenced by a footprint node spanning the
+    given part of the source, by default by a footprint file. Models are
+    looked up with a regular expression, "model" nodes appear only in
+    footprints.
+    """
+
+    if end is None:
+        end = len(data)
+
+    model_re = ESCAPED_MODEL_RE if escapes else MODEL_RE
+
+    models = set()
+    for match in model_re.finditer(data, start, end):
+        if match.group(1) is not None:
+            models.add(match.group(1))
+        elif match.group(2) is not None:
+            models.add(match.group(2))
+
+    return models
+
+
+def scan_board_references(data, escapes=False):
+    """
+    Returns sets of footprints and 3D models referenced by a board given
+    its content. The board is streamed, only footprint nodes are looked
+    into, no tree is built.
+    """
+
+    footprints = set()
+    models = set()
+
+    # The root should be "kicad_pcb"
+    start = data.find("(")
+    assert start >= 0 and bracket_tree.node_head(data, start, escapes)[0] == "kicad_pcb"
+
+    for keyword, start, end in bracket_tree.iter_children(data, escapes=escapes):
+        if keyword not in FOOTPRINT_KEYWORDS:
             continue
 
-        print(" Extracting '{}' from PCB".format(footprint.name))
-        lib_footprints[footprint] = pcb_footprints[footprint]
+        words = bracket_tree.node_head(data, start, escapes)
+        if len(words) > 1:
+            lib, name = split_lib_id(words[1])
+            footprints.add(Footprint(name = name, lib = lib))
 
-    # Write footprints to the new library
-    process_footprints(lib_footprints, footprint_map, model_map,
-                       os.path.join(out_path, footprint_lib.filename))
+        models |= scan_footprint_models(data, start, end, escapes)
+
+    return footprints, models
 
-    # Write fp-lib-table
-    root = bracket_tree.Node(None, "fp_lib_table")
-    node = bracket_tree.Node(root, "lib")
-    root.add(node)
-    node.add(bracket_tree.Node(node, "name",    [footprint_lib.name]))
-    node.add(bracket_tree.Node(node, "type",    ["KiCad"]))
-    node.add(bracket_tree.Node(node, "uri",     [os.path.join("${KIPRJMOD}", footprint_lib.filename)]))
-    node.add(bracket_tree.Node(node, "options", [""]))
-    node.add(bracket_tree.Node(node, "descr",   [""]))
 
-    file_name = os.path.join(out_path, "fp-lib-table")
-    bracket_tree.save(file_name, root)
+def verify_project(path, reporter=None, aio=None):
+    """
+    Checks that a liberated project in the given path is self-contained.
+    Its symbol and footprint libraries and files are indexed once, then
+    all sheets, boards and library footprints are streamed. Each symbol,
+    footprint and 3D model they reference has to resolve to a library or
+    a file of the project. References to libraries or files outside of the
+    project, ie. leftovers of the original libraries, are reported apart
+    from unresolved ones. Returns a list of problems, also reported as
+    errors.
+    """
+
+    if reporter is None:
+        reporter = get_reporter()
+
+    if aio is None:
+        from async_io import AsyncIO
+        with AsyncIO() as aio:
+            return verify_project(path, reporter, aio)
+
+    path  = os.path.abspath(path)
+    files = find_project_files(path)
+
+    substituter = EnvVarSubstituter({"KIPRJMOD": path}, use_os_environ=False)
+
+    problems  = []
+    leftovers = 0
+
+    def problem(file_name, message, item=None, leftover=False):
+        nonlocal leftovers
+        message = "{}: {}".format(file_name, message)
+        problems.append(message)
+        if leftover:
+            leftovers += 1
+        reporter.error(message, item)
+
+    def resolve(file_name):
+        """
+        Returns a normalized absolute file name or None if it is outside of
+        the project or has unknown variables.
+        """
+        file_name = substituter.substitute(file_name)
+        if EnvVarSubstituter.VAR_RE.search(file_name):
+            return None
+
+        file_name = os.path.normcase(os.path.normpath(os.path.join(path, file_name)))
+        root = os.path.normcase(path)
+
+        # Paths on different drives have no common path
+        try:
+            if os.path.commonpath([root, file_name]) != root:
+                return None
+        except ValueError:
+            return None
+
+        return file_name
+
+    reporter.info("")
+    reporter.info("Verifying '{}'".format(path))
 
     # .....................................................
 
-    # Substitute environmental variables in model names
-    all_models = [substitute_env_vars(m, kicad_env_vars) for m in all_models]
-    model_lib = substitute_env_vars(model_lib, {"KIPRJMOD": out_path})
+    # Index libraries of the project
+    reporter.begin("verify-index", "Indexing libraries and files...")
+
+    symbol_libs = {}
+    footprint_libs = {}
+
+    for table, libs in (("sym-lib-table", symbol_libs), ("fp-lib-table", footprint_libs)):
+        if not os.path.isfile(os.path.join(path, table)):
+            continue
+
+        for lib in load_lib_table(os.path.join(path, table)).values():
+            lib_file = resolve(lib.filename)
+            if lib_file is None:
+                problem(table, "Library '{}' refers to '{}' outside of the project".format(
+                        lib.name, lib.filename), lib.name, leftover=True)
+                continue
 
-    # Collect 3d models
-    print("Collecting 3D models from libraries...")
-    collect_models(all_models, model_lib)
+            # Library file names and sets of their symbol or footprint names
+            try:
+                if table == "sym-lib-table":
+                    names = set(symbol_lib.load(lib_file))
+                else:
+                    names = {f[:-len(".kicad_mod")] for f in os.listdir(lib_file)
+                             if f.lower().endswith(".kicad_mod")}
+                libs[lib.name] = (lib_file, names)
+            except OSError as ex:
+                problem(table, "Library '{}' can not be read: {}".format(lib.name, ex), lib.name)
+
+    # All project files, models are looked up there
+    project_files = set()
+    for dir_path, dir_names, file_names in os.walk(path):
+        project_files.update(os.path.normcase(os.path.join(dir_path, f)) for f in file_names)
 
     # .....................................................
 
-    # Process schematic files, substitute symbol and footprint references.
-    print("Processing schematic files...")
-    for sch_file in proj["sch"]:
-        print(" {}".format(sch_file))
-        process_schematics(
-            os.path.join(inp_path, sch_file),
-            os.path.join(out_path, sch_file),
-            symbol_map, footprint_map
-        )
+    def check_lib_item(file_name, kind, item, libs):
+        ref = "{}:{}".format(item.lib, item.name) if item.lib is not None else item.name
+
+        if item.lib is None:
+            problem(file_name, "{} '{}' has no library".format(kind, ref), ref)
+        elif item.lib not in libs:
+            problem(file_name, "{} '{}' refers to library '{}' which is not part of the project".format(
+                    kind, ref, item.lib), ref, leftover=True)
+        elif item.name not in libs[item.lib][1]:
+            problem(file_name, "{} '{}' not found in '{}'".format(
+                    kind, ref, os.path.relpath(libs[item.lib][0], path)), ref)
+
+    def check_model(file_name, model):
+        model_file = resolve(model)
+        if model_file is None:
+            problem(file_name, "Model '{}' refers to a file outside of the project".format(model),
+                    model, leftover=True)
+        elif model_file not in project_files:
+            problem(file_name, "Model '{}' not found".format(model), model)
+
+    # Stream all sheets, boards and library footprints
+    lib_footprints = [os.path.join(lib_file, f + ".kicad_mod")
+                      for lib_file, names in footprint_libs.values() for f in sorted(names)]
+
+    scan_files = [os.path.join(path, f) for f in files["sch"] + files["brd"]] + lib_footprints
+
+    reporter.begin("verify-scan", "Checking references...", len(scan_files))
+
+    async def scan():
+        async for file_name, data in aio.read_files(scan_files):
+            name = os.path.relpath(file_name, path)
+
+            if file_name.lower().endswith(".sch"):
+                symbols, footprints = scan_schematic(data.splitlines())
+                models = set()
+            elif file_name.lower().endswith(".kicad_sch"):
+                symbols, footprints, cached = scan_kicad_schematic(data)
+                symbols |= set(cached)
+                models = set()
+            elif file_name.lower().endswith(".kicad_pcb"):
+                symbols = set()
+                footprints, models = scan_board_references(data, uses_escapes(data))
+            else:
+                symbols, footprints = set(), set()
+                models = scan_footprint_models(data, escapes=uses_escapes(data))
+
+            for symbol in sorted(symbols, key=sort_key):
+                check_lib_item(name, "Symbol", symbol, symbol_libs)
+            for footprint in sorted(footprints, key=sort_key):
+                check_lib_item(name, "Footprint", footprint, footprint_libs)
+            for model in sorted(models):
+                check_model(name, model)
+
+            reporter.item(file_name, len(data))
+
+    aio.run(scan())
+    reporter.end()
+
+    # Summary
+    reporter.info("Checked {} sheet(s), {} board(s) and {} library footprint(s)".format(
+                  len(files["sch"]), len(files["brd"]), len(lib_footprints)))
+
+    if problems:
+        reporter.info("{} unresolved reference(s), {} reference(s) outside of the project".format(
+                      len(problems) - leftovers, leftovers))
+    else:
+        reporter.info("All references resolve.")
+
+    reporter.event("verify", problems=len(problems), leftovers=leftovers)
+    return problems
+
+# =============================================================================
+
+
+def read_manifest(file_name):
+    """
+    Reads a batch manifest file. Each non-empty line lists a project path
+    optionally followed by an output path. Lines starting with "#" are
+    comments. Relative paths are relative to the manifest location.
+    """
+
+    base_dir = os.path.dirname(os.path.abspath(file_name))
+    projects = []
+
+    with open(file_name, "r") as fp:
+        for l in fp:
+            fields = shlex.split(l, comments=True)
+            if not fields:
+                continue
 
-    # Process board files, substitute footprint references.
-    print("Processing board files...")
-    for brd_file in proj["brd"]:
-        print(" {}".format(brd_file))
-        process_boards(
-            os.path.join(inp_path, brd_file),
-            os.path.join(out_path, brd_file),
-            footprint_map,
-            model_map
+            if len(fields) > 2:
+                raise RuntimeError("Invalid manifest line '{}'".format(l.strip()))
+
+            fields = [os.path.join(base_dir, f) for f in fields]
+            projects.append((fields[0], fields[1] if len(fields) > 1 else None))
+
+    return projects
+
+
+# Per-process state of batch workers
+_worker_state = None
+
+
+def _init_worker(config, model_store, link_mode, log, quiet, memory_budget):
+    global _worker_state
+    import multiprocessing.util
+
+    # Workers append to the same log, progress lines would mix so they are
+    # not shown.
+    set_reporter(Reporter(log, quiet, progress=False))
+
+    _worker_state = Liberator(config, model_store=model_store, link_mode=link_mode,
+                              memory_budget=memory_budget)
+
+    # Save the model store index when the worker exits
+    multiprocessing.util.Finalize(_worker_state, _worker_state.close, exitpriority=10)
+
+
+def _liberate_in_worker(paths):
+    return liberate_one(paths, _worker_state)
+
+
+def liberate_one(paths, liberator):
+    """
+    Liberates a single project of a batch. Returns None on success or an
+    error message. Any error fails only this project.
+    """
+
+    inp_path, out_path = paths
+
+    try:
+        liberator.liberate(inp_path, out_path)
+    except Exception as ex:
+        message = str(ex) or type(ex).__name__
+        if not isinstance(ex, (OSError, RuntimeError)):
+            message = "{}: {}".format(type(ex).__name__, message)
+
+        liberator.reporter.error("Project '{}' failed: {}".format(inp_path, message), inp_path)
+        return message
+
+    return None
+
+
+def liberate_projects(projects, config, jobs=1, model_store=None, link_mode="hardlink",
+                      log=None, quiet=False, memory_budget=None, parse_jobs=0):
+    """
+    Liberates multiple projects given as a list of (input path, output path)
+    tuples. Library caches are shared between projects processed by the same
+    process. Returns a dict of failed projects and error messages.
+
+    Parallel workers set up their own reporters appending to the given log
+    file name, if any. The memory budget applies to each worker. Parallel
+    workers can not have parse pools, parse_jobs applies only when projects
+    are processed sequentially.
+    """
+
+    # Process sequentially
+    if jobs <= 1:
+        with Liberator(config, model_store=model_store, link_mode=link_mode,
+                       memory_budget=memory_budget, parse_jobs=parse_jobs) as liberator:
+            results = [liberate_one(p, liberator) for p in projects]
+
+    # Process in parallel, each worker keeps its own cache
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs, _init_worker,
+                                    (config, model_store, link_mode, log, quiet,
+                                     memory_budget))
+        try:
+            results = pool.map(_liberate_in_worker, projects, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    return {p[0]: r for p, r in zip(projects, results) if r is not None}
+
+# =============================================================================
+
+
+def main():
+
+    # Needed to set up the arguments
+    import argparse
+    from outputs import ARCHIVE_FORMATS, archive_format
+    from model_store import LINK_MODES
+    from spill_store import parse_size
+
+    # Parse arguments
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
         )
 
-    print("Done.")        
+    group = parser.add_mutually_exclusive_group(required=True)
+
+    group.add_argument(
+        "-i",
+        type=str,
+        help="KiCad project path"
+    )
+
+    group.add_argument(
+        "--batch",
+        type=str,
+        nargs="+",
+        help="KiCad project paths or glob patterns to liberate in one run"
+    )
+
+    group.add_argument(
+        "--manifest",
+        type=str,
+        help="A file listing KiCad project paths to liberate in one run"
+    )
+
+    group.add_argument(
+        "--verify",
+        type=str,
+        help="Check that all symbols, footprints and 3D models referenced " \
+             "by a liberated project in the given path resolve within it. " \
+             "Exits with status 1 if any do not"
+    )
+
+    parser.add_argument(
+        "-o",
+        type=str,
+        help="Output path for the \"liberated\" project. In batch mode " \
+             "projects are written to subfolders of this path. Paths ending " \
+             "with .zip, .tar, .tar.gz etc. are written as archives, \"-\" " \
+             "writes an archive to stdout"
+    )
+
+    parser.add_argument(
+        "--archive",
+        type=str,
+        choices=list(ARCHIVE_FORMATS.keys()),
+        help="Write the \"liberated\" project as an archive of the given " \
+             "format. In batch mode each project gets its own archive"
+    )
+
+    parser.add_argument(
+        "-j",
+        type=int,
+        default=1,
+        help="Number of projects to process in parallel in batch mode"
+    )
+
+    parser.add_argument(
+        "--model-store",
+        type=str,
+        help="A folder of a content-addressed 3D model store. Models are " \
+             "put there once and linked into liberated projects"
+    )
+
+    parser.add_argument(
+        "--link-models",
+        type=str,
+        choices=LINK_MODES,
+        default="hardlink",
+        help="How models are put from the model store into projects. " \
+             "Hardlinked and symlinked models are the read-only store " \
+             "files, use copy to get writable ones (default: %(default)s)"
+    )
+
+    parser.add_argument(
+        "--plan",
+        type=str,
+        nargs="?",
+        const="-",
+        help="Do not write anything, only resolve all symbols, footprints " \
+             "and models and write the plan as JSON to the given file or " \
+             "to stdout"
+    )
+
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep watching the project and update the \"liberated\" one " \
+             "incrementally when its files change"
+    )
+
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.5,
+        help="Polling interval in seconds for --watch (default: %(default)s)"
+    )
+
+    parser.add_argument(
+        "--memory-budget",
+        type=parse_size,
+        help="Keep parsed footprints in a temporary file once the process " \
+             "memory use (RSS) exceeds the given size, eg. 512M. A zero " \
+             "budget keeps them there all the time"
+    )
+
+    parser.add_argument(
+        "--parse-jobs",
+        type=int,
+        default=0,
+        help="Number of worker processes parsing boards and library " \
+             "footprints. Not used with -j in batch mode (default: none, " \
+             "parse in the main process)"
+    )
+
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="Print only warnings and errors, no progress"
+    )
+
+    parser.add_argument(
+        "--log",
+        type=str,
+        help="Append a structured log of all events, with item durations " \
+             "and sizes, as JSON lines to the given file"
+    )
+
+    args = parser.parse_args()
+
+    # Verify only
+    if args.verify is not None:
+        with Reporter(args.log, args.quiet) as reporter:
+            set_reporter(reporter)
+            problems = verify_project(args.verify)
+
+        if problems:
+            sys.exit(1)
+
+        return
+
+    if args.plan is not None and args.i is None:
+        parser.error("--plan requires -i")
+    if args.plan is None and args.o is None:
+        parser.error("the following arguments are required: -o")
+    if args.watch and (args.i is None or args.plan is not None):
+        parser.error("--watch requires -i and can not be used with --plan")
+    if args.watch and (args.archive is not None or args.o == "-" or
+                       archive_format(args.o) is not None):
+        parser.error("--watch requires a directory output")
+
+    # Plan only
+    if args.plan is not None:
+
+        # Keep progress messages out of the JSON written to stdout
+        log = sys.stderr if args.plan == "-" else sys.stdout
+        import contextlib
+        with contextlib.redirect_stdout(log), Reporter(args.log, args.quiet) as reporter:
+            set_reporter(reporter)
+            reporter.info("Loading KiCad configuration...")
+            with Liberator(memory_budget=args.memory_budget,
+                           parse_jobs=args.parse_jobs) as liberator:
+                project = liberator.scan(args.i)
+                plan = liberator.resolve(project, liberator.plan(project))
+
+        if args.plan == "-":
+            json.dump(plan, sys.stdout, indent=2)
+            print("")
+        else:
+            with open(args.plan, "w") as fp:
+                json.dump(plan, fp, indent=2)
+
+        return
+
+    # .....................................................
+
+    # Keep progress messages out of an archive written to stdout
+    if args.o == "-":
+        if args.i is None:
+            parser.error("writing to stdout requires -i")
+        sys.stdout = sys.stderr
+
+    reporter = Reporter(args.log, args.quiet)
+    set_reporter(reporter)
+
+    # Load global KiCad configuration
+    reporter.begin("config", "Loading KiCad configuration...")
+    config = load_kicad_config()
+    reporter.end()
+
+    # Watch a single project
+    if args.watch:
+        watch_project(args.i, args.o, config, args.interval,
+                      args.model_store, args.link_models, args.memory_budget,
+                      args.parse_jobs)
+        reporter.close()
+        return
+
+    # Single project
+    if args.i is not None:
+        liberate_project(args.i, args.o, config, fmt=args.archive,
+                         model_store=args.model_store, link_mode=args.link_models,
+                         memory_budget=args.memory_budget, parse_jobs=args.parse_jobs)
+        reporter.close()
+        return
+
+    # Batch, paths which are not project folders fail
+    invalid = {}
+    if args.manifest is not None:
+        projects = read_manifest(args.manifest)
+    else:
+        import glob
+        projects = []
+        for pattern in args.batch:
+            paths = sorted(glob.glob(pattern)) or [pattern]
+            for path in paths:
+                if os.path.isdir(path):
+                    projects.append((path, None))
+                    continue
+
+                invalid[path] = "Not a folder" if os.path.exists(path) else "Not found"
+                reporter.error("Project '{}' failed: {}".format(path, invalid[path]), path)
+
+    projects = [(p, o if o is not None else
+                 os.path.join(args.o, os.path.basename(os.path.normpath(p))))
+                for p, o in projects]
+
+    if args.archive is not None:
+        ext = ARCHIVE_FORMATS[args.archive]
+        projects = [(p, o if o.lower().endswith(ext) else o + ext)
+                    for p, o in projects]
+
+    # Check for output path conflicts
+    out_paths = [os.path.normpath(o) for p, o in projects]
+    if len(set(out_paths)) != len(out_paths):
+        raise RuntimeError("Multiple projects would be written to the same output path!")
+
+    failed = dict(invalid)
+    failed.update(liberate_projects(projects, config, args.j,
+                                    args.model_store, args.link_models,
+                                    args.log, args.quiet, args.memory_budget,
+                                    args.parse_jobs))
+
+    total = len(projects) + len(invalid)
+
+    reporter.info("")
+    reporter.info("Liberated {} of {} project(s)".format(total - len(failed), total))
+    for inp_path, error in failed.items():
+        reporter.error("'{}': {}".format(inp_path, error), inp_path)
+
+    reporter.close()
+
+    if failed:
+        sys.exit(1)
 
 # =============================================================================
 
@@ -0,0 +1,181 @@
+"""
+A content-addressed store for 3D model files. Files are kept under their
+SHA-256 hash so that a model used by many projects is stored only once.
+Projects get hardlinks or symlinks to the stored files instead of copies.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+# =============================================================================
+
+LINK_MODES = ["hardlink", "symlink", "copy"]
+
+# =============================================================================
+
+
+def file_hash(file_name, chunk_size=1024 * 1024):
+    """
+    Computes SHA-256 hash of a file content.
+    """
+
+    sha = hashlib.sha256()
+    with open(file_name, "rb") as fp:
+        while True:
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                break
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def lock_file(fp):
+    """
+    Takes an exclusive lock of an open file, released when it is closed.
+    """
+
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        msvcrt.locking(fp.fileno(), msvcrt.LK_LOCK, 1)
+        return
+
+    fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+
+
+class ModelStore(object):
+    """
+    The store. Files are kept in "<root>/<hash[:2]>/<hash><ext>". Hashes of
+    source files are remembered in an index keyed by the source path, its
+    size and modification time so unchanged files are not hashed again.
+    """
+
+    INDEX_FILE = "index.json"
+    LOCK_FILE  = "index.lock"
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+
+        os.makedirs(root, exist_ok=True)
+
+        # Load the index. Entries added by this instance are kept apart so
+        # that they can be merged with ones saved by others meanwhile.
+        self.index_file = os.path.join(root, self.INDEX_FILE)
+        self.index = self._load_index()
+        self.added = {}
+
+    def _load_index(self):
+        """
+        Loads the index file, returns an empty index if there is none.
+        """
+
+        try:
+            with open(self.index_file, "r") as fp:
+                index = json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+        return index if isinstance(index, dict) else {}
+
+    def save(self):
+        """
+        Saves the index. Processes may share the store, so the index file
+        is re-read and merged with added entries under a file lock. The file
+        is replaced atomically.
+        """
+
+        with self.lock:
+            if not self.added:
+                return
+
+            with open(os.path.join(self.root, self.LOCK_FILE), "a") as lock_fp:
+                lock_file(lock_fp)
+
+                index = self._load_index()
+                index.update(self.added)
+
+                fd, tmp_file = tempfile.mkstemp(dir=self.root)
+                with os.fdopen(fd, "w") as fp:
+                    json.dump(index, fp)
+                os.replace(tmp_file, self.index_file)
+
+            self.index.update(index)
+            self.added = {}
+
+    # .........................................................................
+
+    def _hash(self, src_file):
+        """
+        Returns hash of a source file, uses the index if possible.
+        """
+
+        st  = os.stat(src_file)
+        key = os.path.abspath(src_file)
+
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime:
+                return entry[2]
+
+        digest = file_hash(src_file)
+
+        with self.lock:
+            self.index[key] = [st.st_size, st.st_mtime, digest]
+            self.added[key] = self.index[key]
+
+        return digest
+
+    def add(self, src_file):
+        """
+        Adds a file to the store if not already there. Returns path of the
+        stored file.
+        """
+
+        digest = self._hash(src_file)
+        ext = os.path.splitext(src_file)[1].lower()
+
+        stored_file = os.path.join(self.root, digest[:2], digest + ext)
+        if os.path.isfile(stored_file):
+            return stored_file
+
+        # Copy to a temporary file first, then move it in place, so that
+        # concurrent writers never see a partial file.
+        os.makedirs(os.path.dirname(stored_file), exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(stored_file))
+        os.close(fd)
+
+        shutil.copyfile(src_file, tmp_file)
+        os.chmod(tmp_file, 0o444)
+        os.replace(tmp_file, stored_file)
+
+        return stored_file
+
+    def link(self, src_file, dst_file, mode="hardlink"):
+        """
+        Adds a file to the store and links it to the destination. Falls back
+        to copying when a hardlink can not be made, eg. across file systems.
+        """
+
+        stored_file = self.add(src_file)
+
+        if os.path.lexists(dst_file):
+            os.remove(dst_file)
+
+        if mode == "symlink":
+            os.symlink(os.path.abspath(stored_file), dst_file)
+            return
+
+        if mode == "hardlink":
+            try:
+                os.link(stored_file, dst_file)
+                return
+            except OSError:
+                pass
+
+        shutil.copyfile(stored_file, dst_file)
@@ -0,0 +1,319 @@
+"""
+Output backends for the "liberated" project. An output receives files by
+their names relative to the project root, eg. "footprints.pretty/R.kicad_mod",
+and stores them somewhere.
+"""
+import io
+import os
+import sys
+import time
+from shutil import copy
+
+# The zipfile and tarfile modules are imported only when an archive is
+# written as they are slow to import.
+
+# =============================================================================
+
+
+class DirectoryOutput(object):
+    """
+    Writes files to a directory. When given an AsyncIO pipeline, asynchronous
+    writes and copies are done through it. When given a ModelStore, shared
+    files (3D models) are put in the store and linked from there according
+    to the link mode.
+    """
+
+    def __init__(self, path, aio=None, model_store=None, link_mode="hardlink"):
+        self.path = path
+        self.aio  = aio
+        self.dirs = set()
+
+        self.model_store = model_store
+        self.link_mode   = link_mode
+
+    def _prepare(self, name):
+        """
+        Returns the full path of a file, creates its directory if needed.
+        """
+
+        file_name = os.path.join(self.path, name)
+
+        dir_name = os.path.dirname(file_name)
+        if dir_name not in self.dirs:
+            os.makedirs(dir_name or os.curdir, exist_ok=True)
+            self.dirs.add(dir_name)
+
+        return file_name
+
+    def mkdir(self, name):
+        """
+        Creates a directory.
+        """
+        os.makedirs(os.path.join(self.path, name), exist_ok=True)
+
+    def write(self, name, data):
+        """
+        Writes a text file.
+        """
+        with open(self._prepare(name), "w") as fp:
+            fp.write(data)
+
+    def write_iter(self, name, chunks):
+        """
+        Writes a text file given as an iterable of string chunks. The chunks
+        are written as they come.
+        """
+        with open(self._prepare(name), "w") as fp:
+            for chunk in chunks:
+                fp.write(chunk)
+
+    def copy(self, src_file, name, shared=False):
+        """
+        Copies a file. Shared files may be linked from the model store.
+        """
+        if shared and self.model_store is not None:
+            self.model_store.link(src_file, self._prepare(name), self.link_mode)
+        else:
+            copy(src_file, self._prepare(name))
+
+    def remove(self, name):
+        """
+        Removes a file if it exists.
+        """
+        file_name = os.path.join(self.path, name)
+        if os.path.lexists(file_name):
+            os.remove(file_name)
+
+    async def write_async(self, name, data):
+        """
+        Writes a text file, possibly in the background.
+        """
+        if self.aio is None:
+            self.write(name, data)
+        else:
+            await self.aio.write_file(self._prepare(name), data)
+
+    async def copy_async(self, src_file, name, shared=False):
+        """
+        Copies a file, possibly in the background.
+        """
+        if self.aio is None:
+            self.copy(src_file, name, shared)
+        else:
+            self._prepare(name)
+            await self.aio.run_in_background(self.copy, src_file, name, shared)
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class MemoryOutput(object):
+    """
+    Keeps files in memory, in the "files" dict. Text files are stored as
+    strings, copied files as bytes.
+    """
+
+    def __init__(self):
+        self.files = {}
+
+    def mkdir(self, name):
+        pass
+
+    def write(self, name, data):
+        self.files[name] = data
+
+    def write_iter(self, name, chunks):
+        self.write(name, "".join(chunks))
+
+    def copy(self, src_file, name, shared=False):
+        with open(src_file, "rb") as fp:
+            self.files[name] = fp.read()
+
+    def remove(self, name):
+        self.files.pop(name, None)
+
+    async def write_async(self, name, data):
+        self.write(name, data)
+
+    async def copy_async(self, src_file, name, shared=False):
+        self.copy(src_file, name)
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class ZipOutput(object):
+    """
+    Writes files directly into a zip archive. The archive may be a file name
+    or a writable binary stream, which does not need to be seekable.
+    """
+
+    def __init__(self, file):
+        import zipfile
+        self.zip = zipfile.ZipFile(file, "w", compression=zipfile.ZIP_DEFLATED)
+        self.file_name = file if isinstance(file, str) else None
+
+    def mkdir(self, name):
+        self.zip.writestr(name.rstrip("/") + "/", b"")
+
+    def write(self, name, data):
+        self.zip.writestr(name, data.encode("utf-8"))
+
+    def write_iter(self, name, chunks):
+        with self.zip.open(name, "w") as fp:
+            for chunk in chunks:
+                fp.write(chunk.encode("utf-8"))
+
+    def copy(self, src_file, name, shared=False):
+        self.zip.write(src_file, name)
+
+    def remove(self, name):
+        raise RuntimeError("Files can not be removed from a zip archive")
+
+    async def write_async(self, name, data):
+        self.write(name, data)
+
+    async def copy_async(self, src_file, name, shared=False):
+        self.copy(src_file, name)
+
+    def close(self):
+        self.zip.close()
+
+    def abort(self):
+        """
+        Closes the archive after a failure, removes a partially written
+        archive file.
+        """
+        try:
+            self.zip.close()
+        finally:
+            if self.file_name is not None and os.path.exists(self.file_name):
+                os.remove(self.file_name)
+
+
+class TarOutput(object):
+    """
+    Writes files directly into a tar archive, optionally compressed. The
+    archive may be a file name or a writable binary stream. Streams are
+    written sequentially so they do not need to be seekable.
+    """
+
+    def __init__(self, file, compression=""):
+        import tarfile
+        if isinstance(file, str):
+            self.tar = tarfile.open(file, "w:" + compression)
+            self.file_name = file
+        else:
+            self.tar = tarfile.open(fileobj=file, mode="w|" + compression)
+            self.file_name = None
+
+    def mkdir(self, name):
+        import tarfile
+        info = tarfile.TarInfo(name.rstrip("/"))
+        info.type  = tarfile.DIRTYPE
+        info.mode  = 0o755
+        info.mtime = time.time()
+        self.tar.addfile(info)
+
+    def write(self, name, data):
+        import tarfile
+        data = data.encode("utf-8")
+
+        info = tarfile.TarInfo(name)
+        info.size  = len(data)
+        info.mode  = 0o644
+        info.mtime = time.time()
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def write_iter(self, name, chunks):
+        # Tar entries need their size upfront
+        self.write(name, "".join(chunks))
+
+    def copy(self, src_file, name, shared=False):
+        self.tar.add(src_file, arcname=name, recursive=False)
+
+    def remove(self, name):
+        raise RuntimeError("Files can not be removed from a tar archive")
+
+    async def write_async(self, name, data):
+        self.write(name, data)
+
+    async def copy_async(self, src_file, name, shared=False):
+        self.copy(src_file, name)
+
+    def close(self):
+        self.tar.close()
+
+    def abort(self):
+        """
+        Closes the archive after a failure, removes a partially written
+        archive file.
+        """
+        try:
+            self.tar.close()
+        finally:
+            if self.file_name is not None and os.path.exists(self.file_name):
+                os.remove(self.file_name)
+
+# =============================================================================
+
+# Archive formats, their file name extensions and tar compression types
+ARCHIVE_FORMATS = {
+    "zip":      ".zip",
+    "tar":      ".tar",
+    "tar.gz":   ".tar.gz",
+    "tar.bz2":  ".tar.bz2",
+    "tar.xz":   ".tar.xz",
+}
+
+
+def archive_format(file_name):
+    """
+    Guesses archive format from a file name. Returns None if the file name
+    does not look like an archive.
+    """
+
+    for fmt, ext in ARCHIVE_FORMATS.items():
+        if file_name.lower().endswith(ext):
+            return fmt
+
+    if file_name.lower().endswith(".tgz"):
+        return "tar.gz"
+
+    return None
+
+
+def make_output(path, fmt=None, aio=None, model_store=None, link_mode="hardlink"):
+    """
+    Creates an output for the given path. The format is either given
+    explicitly or guessed from the path. Archives can be written to stdout
+    by passing "-" as the path. Without a format the output is a directory.
+    The model store is used only by directory outputs.
+    """
+
+    if fmt is None:
+        fmt = "tar" if path == "-" else archive_format(path)
+
+    if fmt is None:
+        return DirectoryOutput(path, aio, model_store, link_mode)
+
+    if fmt not in ARCHIVE_FORMATS:
+        raise RuntimeError("Unknown output format '{}'".format(fmt))
+
+    # Use the process stdout, sys.stdout may be redirected for messages
+    if path == "-":
+        file = sys.__stdout__.buffer
+    else:
+        file = path
+        os.makedirs(os.path.dirname(path) or os.curdir, exist_ok=True)
+
+    if fmt == "zip":
+        return ZipOutput(file)
+
+    return TarOutput(file, fmt.split(".")[1] if "." in fmt else "")
@@ -0,0 +1,105 @@
+"""
+Parsing in worker processes. Parsed trees are sent back to the calling
+process packed (see bracket_tree.pack()) in shared memory blocks, so only
+block names are pickled and trees are unpacked without parsing them again.
+Where a shared memory block can not outlive the worker which wrote it,
+packed trees are sent as bytes instead.
+"""
+import signal
+from concurrent.futures import ProcessPoolExecutor
+
+import bracket_tree
+
+# =============================================================================
+
+
+def _init_worker():
+
+    # Interrupts are handled by the calling process, it shuts workers down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _call(func, item):
+    trees, value = func(item)
+
+    if bracket_tree.shared_memory_supported():
+        return bracket_tree.pack_shared(trees), value
+
+    return bracket_tree.pack(trees), value
+
+
+def _receive(packed):
+    if isinstance(packed, bytes):
+        return bracket_tree.unpack(packed)
+
+    return bracket_tree.unpack_shared(*packed)
+
+
+def _discard(packed):
+    if isinstance(packed, bytes):
+        return
+
+    from multiprocessing import shared_memory
+
+    block = shared_memory.SharedMemory(name=packed[0])
+    block.close()
+    block.unlink()
+
+# =============================================================================
+
+
+class ParsePool(object):
+    """
+    A pool of worker processes which parse files or data and return trees.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+        # Blocks are created by workers and removed by the calling process.
+        # Starting the resource tracker first makes workers share it so it
+        # sees both.
+        if bracket_tree.shared_memory_supported():
+            from multiprocessing import resource_tracker
+            resource_tracker.ensure_running()
+
+        self.executor = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker)
+
+    def close(self):
+        """
+        Shuts the workers down.
+        """
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def map(self, func, items):
+        """
+        Calls func(item) for each item in worker processes. The function
+        has to be defined at a module level and has to return a list of
+        trees and any picklable value. Yields a tuple of the list of trees
+        and the value for each item, in the order of items.
+        """
+
+        futures = [self.executor.submit(_call, func, item) for item in items]
+
+        try:
+            while futures:
+                packed, value = futures[0].result()
+                futures.pop(0)
+                yield _receive(packed), value
+
+        # Remove blocks of results which were not received
+        finally:
+            for future in futures:
+                if future.cancel():
+                    continue
+                try:
+                    packed, value = future.result()
+                except Exception:
+                    continue
+                _discard(packed)
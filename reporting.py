@@ -0,0 +1,284 @@
+"""
+Progress reporting and structured logging. Messages are printed to the
+terminal and, when a log is given, all events are also written to it as JSON
+lines. Work is split into phases made of items; for each item its duration
+and size are recorded. On a terminal the current phase progress is shown
+with the throughput and the estimated time left.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# =============================================================================
+
+
+class Reporter(object):
+    """
+    Reports messages, phases and items. Each event is logged as a JSON object
+    with the "time", "level", "event" and "pid" fields, the current context
+    (eg. "project") and the current "phase". Item events carry the "item",
+    "duration" and "bytes" fields.
+
+    In quiet mode only warnings and errors are printed, there is no per-item
+    terminal output. The log is written regardless.
+
+    The log is either a file name, opened for appending so that processes
+    may share it, or a file object. Messages are printed to the given stream,
+    by default to the current sys.stdout. The progress line is shown only if
+    the stream is a terminal unless enabled or disabled explicitly.
+    """
+
+    # Minimum interval between progress line updates
+    PROGRESS_INTERVAL = 0.1
+
+    def __init__(self, log=None, quiet=False, progress=None, stream=None):
+        self.quiet    = quiet
+        self.stream   = stream
+        self.progress = progress
+
+        self.own_log = isinstance(log, str)
+        self.log = open(log, "a", buffering=1) if self.own_log else log
+
+        self.lock    = threading.Lock()
+        self.context = {}
+
+        # Number of errors reported
+        self.errors = 0
+
+        self.phase_name  = None
+        self.phase_total = None
+        self.phase_start = None
+        self.items       = 0
+        self.bytes       = 0
+        self.last_item   = None
+
+        self.progress_time  = 0.0
+        self.progress_shown = False
+
+    def close(self):
+        """
+        Closes the log if it was opened by the reporter.
+        """
+        self._clear_progress()
+        if self.own_log and self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # .........................................................................
+
+    def _stream(self):
+        return self.stream if self.stream is not None else sys.stdout
+
+    def _print(self, message):
+        self._clear_progress()
+        print(message, file=self._stream())
+
+    def event(self, event, level="info", **fields):
+        """
+        Writes an event to the log. Fields set to None are omitted.
+        """
+
+        if self.log is None:
+            return
+
+        record = {
+            "time":  round(time.time(), 6),
+            "level": level,
+            "event": event,
+            "pid":   os.getpid(),
+        }
+        record.update(self.context)
+        if self.phase_name is not None:
+            record["phase"] = self.phase_name
+        record.update((k, v) for k, v in fields.items() if v is not None)
+
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.log.write(line)
+
+    def info(self, message):
+        """
+        Prints an informative message, unless in quiet mode.
+        """
+        if not self.quiet:
+            self._print(message)
+        self.event("message", "info", message=message)
+
+    def warning(self, message, item=None):
+        """
+        Prints a warning.
+        """
+        self._print("WARNING: " + message)
+        self.event("message", "warning", item=item, message=message)
+
+    def error(self, message, item=None):
+        """
+        Prints an error.
+        """
+        self.errors += 1
+        self._print(" ERROR: " + message)
+        self.event("message", "error", item=item, message=message)
+
+    # .........................................................................
+
+    def begin(self, name, message=None, total=None):
+        """
+        Begins a phase. The message is printed as its banner, the total
+        number of items, if known, is used for the time estimate.
+        """
+
+        self.end()
+
+        if message is not None:
+            self.info(message)
+
+        self.phase_name  = name
+        self.phase_total = total
+        self.phase_start = time.perf_counter()
+        self.last_item   = self.phase_start
+        self.items       = 0
+        self.bytes       = 0
+
+        self.event("begin", total=total)
+
+    def end(self):
+        """
+        Ends the current phase, if any. Logs its duration, number of items
+        and bytes and the throughput.
+        """
+
+        if self.phase_name is None:
+            return
+
+        self._clear_progress()
+
+        duration = time.perf_counter() - self.phase_start
+        self.event("end",
+            duration = round(duration, 6),
+            items    = self.items,
+            bytes    = self.bytes,
+            rate     = round(self.items / duration, 3) if duration > 0 else None
+            )
+
+        self.phase_name = None
+
+    @contextmanager
+    def phase(self, name, message=None, total=None):
+        """
+        A context manager for a phase.
+        """
+        self.begin(name, message, total)
+        try:
+            yield self
+        finally:
+            self.end()
+
+    def item(self, item, nbytes=0, duration=None, message=None):
+        """
+        Reports a processed item of the current phase. If not given, the
+        duration is the time since the previous item or the phase begin.
+        The message, if any, is printed unless in quiet mode.
+        """
+
+        now = time.perf_counter()
+        if duration is None and self.last_item is not None:
+            duration = now - self.last_item
+        self.last_item = now
+
+        self.items += 1
+        self.bytes += nbytes
+
+        self.event("item",
+            item     = item,
+            duration = round(duration, 6) if duration is not None else None,
+            bytes    = nbytes
+            )
+
+        if message is not None and not self.quiet:
+            self._print(message)
+
+        self._show_progress(now)
+
+    def timing(self, event, item, duration, nbytes=None):
+        """
+        Logs a timed operation which is not an item of the current phase,
+        eg. loading of a library file.
+        """
+        self.event(event, item=item, duration=round(duration, 6), bytes=nbytes)
+
+    # .........................................................................
+
+    def _progress_enabled(self):
+        if self.quiet or self.phase_name is None:
+            return False
+        if self.progress is not None:
+            return self.progress
+
+        isatty = getattr(self._stream(), "isatty", None)
+        return isatty is not None and isatty()
+
+    def _show_progress(self, now):
+        if now - self.progress_time < self.PROGRESS_INTERVAL:
+            return
+        if not self._progress_enabled():
+            return
+
+        self.progress_time = now
+
+        elapsed = now - self.phase_start
+        rate = self.items / elapsed if elapsed > 0 else 0.0
+
+        line = " {}: {}".format(self.phase_name, self.items)
+        if self.phase_total:
+            line += "/{}".format(self.phase_total)
+        line += ", {:.1f} items/s".format(rate)
+        if self.phase_total and rate > 0:
+            eta = max(self.phase_total - self.items, 0) / rate
+            line += ", ETA {:.1f}s".format(eta)
+
+        stream = self._stream()
+        stream.write("\r" + line + "\033[K")
+        stream.flush()
+        self.progress_shown = True
+
+    def _clear_progress(self):
+        if self.progress_shown:
+            stream = self._stream()
+            stream.write("\r\033[K")
+            stream.flush()
+            self.progress_shown = False
+
+# =============================================================================
+
+# The process-wide reporter
+_reporter = None
+
+
+def get_reporter():
+    """
+    Returns the process-wide reporter. A default one, which prints messages
+    and does not log, is created on first use.
+    """
+    global _reporter
+    if _reporter is None:
+        _reporter = Reporter()
+    return _reporter
+
+
+def set_reporter(reporter):
+    """
+    Sets the process-wide reporter. Returns the previous one.
+    """
+    global _reporter
+    previous  = _reporter
+    _reporter = reporter
+    return previous
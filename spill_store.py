@@ -0,0 +1,287 @@
+"""
+A temporary on-disk store for objects which do not need to be kept in
+memory all the time. Objects are held in dicts backed by a SQLite database.
+They stay in memory until the process resident set size (RSS) exceeds a
+budget, then they are serialized to the database and loaded back only when
+accessed.
+"""
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import weakref
+from collections.abc import MutableMapping
+
+# =============================================================================
+
+SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(string):
+    """
+    Parses a size in bytes with an optional K, M, G or T suffix, eg. "512M".
+    """
+
+    match = re.fullmatch(r"\s*(\d+(?:\.\d*)?)\s*([KMGT]?)i?B?\s*", string, re.I)
+    if match is None:
+        raise ValueError("Invalid size '{}'".format(string))
+
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def current_rss():
+    """
+    Returns the current resident set size of the process in bytes. Where
+    it is not available the peak one is returned, or None if neither is.
+    """
+
+    # Linux
+    try:
+        with open("/proc/self/statm", "r") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    # Kilobytes, except for macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+# =============================================================================
+
+
+class SpillStore(object):
+    """
+    The store, a SQLite database in a temporary file which is removed when
+    the store is closed, or right away where open files can be removed. It
+    holds any number of SpillDict objects created with dict(). When the RSS
+    exceeds the budget all of them are spilled. A budget of zero spills
+    everything right away.
+    """
+
+    # Minimum interval between RSS checks
+    CHECK_INTERVAL = 0.05
+
+    def __init__(self, budget, path=None):
+        import sqlite3
+
+        self.budget = budget
+
+        # Reentrant as dicts may be garbage collected while it is held
+        self.lock = threading.RLock()
+
+        fd, self.file_name = tempfile.mkstemp(prefix="kicad_liberator_", suffix=".sqlite",
+                                              dir=path)
+        os.close(fd)
+
+        self.db = sqlite3.connect(self.file_name, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE spill (ns INTEGER, key TEXT, value BLOB, "
+                        "PRIMARY KEY (ns, key))")
+
+        # Where possible remove the file right away so that it does not stay
+        # behind if the process is killed. There is no journal.
+        if os.name == "posix":
+            os.remove(self.file_name)
+            self.file_name = None
+
+        self.dicts   = []
+        self.next_ns = 0
+
+        self.check_time = 0.0
+        self.over       = False
+
+        # Statistics
+        self.spilled_items = 0
+        self.spilled_bytes = 0
+        self.loaded_items  = 0
+
+    def close(self):
+        """
+        Closes the database and removes its file.
+        """
+        with self.lock:
+            if self.db is None:
+                return
+            self.db.close()
+            self.db = None
+
+        if self.file_name is not None:
+            os.remove(self.file_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # .........................................................................
+
+    def dict(self, dumps=None, loads=None):
+        """
+        Creates a new SpillDict. Values are serialized with the given
+        functions, dumps() returns bytes or a string. By default they are
+        pickled.
+        """
+
+        if dumps is None or loads is None:
+            import pickle
+            dumps, loads = pickle.dumps, pickle.loads
+
+        with self.lock:
+            ns = self.next_ns
+            self.next_ns += 1
+
+        spill_dict = SpillDict(self, ns, dumps, loads)
+        self.dicts.append(weakref.ref(spill_dict))
+        return spill_dict
+
+    def over_budget(self):
+        """
+        Returns True if the RSS exceeds the budget. The RSS is checked at
+        most every CHECK_INTERVAL. Once exceeded, all dicts are spilled.
+        """
+
+        now = time.perf_counter()
+        if now - self.check_time < self.CHECK_INTERVAL:
+            return self.over
+
+        self.check_time = now
+
+        if self.budget <= 0:
+            over = True
+        else:
+            rss = current_rss()
+            over = rss is not None and rss > self.budget
+
+        if over and not self.over:
+            self.spill_all()
+
+        self.over = over
+        return over
+
+    def spill_all(self):
+        """
+        Spills in-memory values of all dicts.
+        """
+
+        dicts = [d() for d in self.dicts]
+        self.dicts = [weakref.ref(d) for d in dicts if d is not None]
+
+        for spill_dict in dicts:
+            if spill_dict is not None:
+                spill_dict.spill()
+
+    # .........................................................................
+
+    def _put(self, ns, key, value):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO spill VALUES (?, ?, ?)",
+                            (ns, key, value))
+            self.spilled_items += 1
+            self.spilled_bytes += len(value)
+
+    def _get(self, ns, key):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM spill WHERE ns = ? AND key = ?",
+                                  (ns, key)).fetchone()
+            self.loaded_items += 1
+
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def _delete(self, ns, key=None):
+        with self.lock:
+            if self.db is None:
+                return
+            if key is None:
+                self.db.execute("DELETE FROM spill WHERE ns = ?", (ns,))
+            else:
+                self.db.execute("DELETE FROM spill WHERE ns = ? AND key = ?", (ns, key))
+
+
+class SpillDict(MutableMapping):
+    """
+    A dict whose values are moved to a SpillStore when the memory budget is
+    exceeded. Keys are always kept in memory, in the insertion order, and
+    are stored by their repr(). Each access to a spilled value loads a new
+    copy of it, modifying it does not change the stored one.
+    """
+
+    def __init__(self, store, ns, dumps, loads):
+        self.store = store
+        self.ns    = ns
+        self.dumps = dumps
+        self.loads = loads
+
+        self.keys_  = {}
+        self.memory = {}
+
+    def __del__(self):
+        self.store._delete(self.ns)
+
+    def spill(self):
+        """
+        Moves all in-memory values to the store.
+        """
+
+        for key, value in self.memory.items():
+            self.store._put(self.ns, repr(key), self._dump(value))
+
+        self.memory = {}
+
+    def is_spilled(self, key):
+        """
+        Returns True if the value is in the store, ie. each access to it
+        loads a new copy.
+        """
+        return key in self.keys_ and key not in self.memory
+
+    def _dump(self, value):
+        data = self.dumps(value)
+        return data.encode("utf-8") if isinstance(data, str) else data
+
+    # .........................................................................
+
+    def __setitem__(self, key, value):
+        if key in self.keys_ and key not in self.memory:
+            self.store._delete(self.ns, repr(key))
+
+        self.keys_[key] = None
+
+        if self.store.over_budget():
+            self.memory.pop(key, None)
+            self.store._put(self.ns, repr(key), self._dump(value))
+        else:
+            self.memory[key] = value
+
+    def __getitem__(self, key):
+        if key in self.memory:
+            return self.memory[key]
+        if key not in self.keys_:
+            raise KeyError(key)
+
+        return self.loads(self.store._get(self.ns, repr(key)))
+
+    def __delitem__(self, key):
+        del self.keys_[key]
+        if self.memory.pop(key, self) is self:
+            self.store._delete(self.ns, repr(key))
+
+    def __contains__(self, key):
+        return key in self.keys_
+
+    def __iter__(self):
+        return iter(self.keys_)
+
+    def __len__(self):
+        return len(self.keys_)
@@ -0,0 +1,250 @@
+"""
+Reader and writer for legacy EESchema symbol library (.lib) files. A library
+is parsed into compact symbol records which hold the symbol name, aliases,
+the rest of the DEF line and fields. The rest of the definition (footprint
+filters and the drawing) is not parsed, it is referenced by its span in the
+library file and copied as is. Records are plain tuples so they can be
+pickled, cached and sent between processes.
+
+KiCad 6+ symbol libraries (.kicad_sym) are only indexed: each symbol is
+referenced by its span and extracted by name when needed.
+"""
+from collections import namedtuple
+
+import bracket_tree
+
+# =============================================================================
+
+LibSymbol = namedtuple("LibSymbol", "name aliases def_fields fields alias_lines body")
+LibSymbol.__doc__ = """
+A symbol definition record:
+
+  name          - the symbol name from the DEF line
+  aliases       - a tuple of all alias names
+  def_fields    - a tuple of the DEF line fields following the name
+  fields        - a tuple of field lines ("F0 ...", "F1 ..."), as they are
+  alias_lines   - a tuple of tuples of names of each ALIAS line preceding
+                  the body
+  body          - a (start, end) byte span of the body in the library file,
+                  ie. all lines from the first one which is neither a field
+                  nor an ALIAS line up to and including ENDDEF
+"""
+
+SexprSymbol = namedtuple("SexprSymbol", "name extends body")
+SexprSymbol.__doc__ = """
+A symbol of a KiCad 6+ symbol library:
+
+  name          - the symbol name
+  extends       - the name of the parent symbol of a derived one, or None
+  body          - a (start, end) byte span of the whole "symbol" node in the
+                  library file, starting with the indentation of its line
+"""
+
+# =============================================================================
+
+
+def parse(fp):
+    """
+    Parses a symbol library given as a binary file object or an iterable of
+    byte lines. Returns a list of LibSymbol records in the file order.
+    """
+
+    symbols = []
+    symbol  = None
+
+    pos = 0
+    for l in fp:
+        line_start = pos
+        pos += len(l)
+        l = l.strip()
+
+        # Begin symbol definition
+        if symbol is None:
+            if l.startswith(b"DEF"):
+                fields = l.decode("utf-8").split()
+                symbol = {
+                    "name":         fields[1],
+                    "def_fields":   tuple(fields[2:]),
+                    "fields":       [],
+                    "aliases":      [],
+                    "alias_lines":  [],
+                    "body":         None,
+                }
+            continue
+
+        # Fields and aliases preceding the body
+        if symbol["body"] is None:
+
+            if l[:1] == b"F" and l[1:2].isdigit():
+                symbol["fields"].append(l.decode("utf-8"))
+                continue
+
+            if l.startswith(b"ALIAS"):
+                names = tuple(l.decode("utf-8").split()[1:])
+                symbol["aliases"].extend(names)
+                symbol["alias_lines"].append(names)
+                continue
+
+            symbol["body"] = line_start
+
+        # Aliases inside the body are left there
+        elif l.startswith(b"ALIAS"):
+            symbol["aliases"].extend(l.decode("utf-8").split()[1:])
+
+        # End symbol definition
+        if l == b"ENDDEF":
+            symbols.append(LibSymbol(
+                name        = symbol["name"],
+                aliases     = tuple(symbol["aliases"]),
+                def_fields  = symbol["def_fields"],
+                fields      = tuple(symbol["fields"]),
+                alias_lines = tuple(symbol["alias_lines"]),
+                body        = (symbol["body"], pos)
+                ))
+            symbol = None
+
+    return symbols
+
+
+def parse_sexpr(data):
+    """
+    Indexes a KiCad 6+ symbol library given as bytes. Returns a list of
+    SexprSymbol records in the file order. Only symbol names and parents
+    are read, the rest of the file is skipped.
+    """
+
+    # Decoding as latin-1 maps bytes to characters one to one so spans are
+    # byte offsets. UTF-8 sequences never contain brackets or quotes.
+    text = data.decode("latin-1")
+
+    def word(start):
+        words = bracket_tree.node_head(text, start, escapes=True)
+        return words[1].encode("latin-1").decode("utf-8") if len(words) > 1 else None
+
+    symbols = []
+    for keyword, start, end in bracket_tree.iter_children(text, escapes=True):
+        if keyword != "symbol":
+            continue
+
+        # Look for the parent
+        extends = None
+        for child, child_start, _ in bracket_tree.iter_children(text, start, end, escapes=True):
+            if child == "extends":
+                extends = word(child_start)
+                break
+
+        symbols.append(SexprSymbol(
+            name    = word(start),
+            extends = extends,
+            body    = bracket_tree.line_span(text, start, end)
+            ))
+
+    return symbols
+
+
+def load(file_name):
+    """
+    Loads a symbol library, either a legacy or a KiCad 6+ one, depending on
+    the file extension. Returns a dict of symbol names and aliases and their
+    LibSymbol or SexprSymbol records. The first definition of a name wins.
+    """
+
+    with open(file_name, "rb") as fp:
+        if file_name.lower().endswith(".kicad_sym"):
+            symbols = parse_sexpr(fp.read())
+        else:
+            symbols = parse(fp)
+
+    index = {}
+    for symbol in symbols:
+        aliases = symbol.aliases if isinstance(symbol, LibSymbol) else ()
+        for name in (symbol.name,) + aliases:
+            index.setdefault(name, symbol)
+
+    return index
+
+
+def read_body(fp, symbol):
+    """
+    Reads the body of a symbol from the library given as a binary file
+    object. Returns it as a string.
+    """
+    fp.seek(symbol.body[0])
+    return fp.read(symbol.body[1] - symbol.body[0]).decode("utf-8")
+
+# =============================================================================
+
+
+def _rename(names, name, new_name):
+    names = tuple(names)
+    if names and names[0] == name:
+        return (new_name,) + names[1:]
+    return names
+
+
+def format_symbol(symbol, body, name, new_name=None):
+    """
+    Formats a symbol definition as a list of lines, preceded by a comment.
+    The definition is the one referenced by the given name, either the
+    symbol name or one of its aliases. That name is replaced with the new
+    one in the comment, the DEF line and ALIAS lines, if given.
+    """
+
+    if new_name is None:
+        new_name = name
+
+    lines = [
+    "#",
+    "# {}".format(new_name),
+    "#",
+    ]
+
+    # DEF and fields
+    def_name = new_name if symbol.name == name else symbol.name
+    lines.append(" ".join(("DEF", def_name) + symbol.def_fields))
+    lines.extend(symbol.fields)
+
+    # Aliases
+    for names in symbol.alias_lines:
+        lines.append(" ".join(("ALIAS",) + _rename(names, name, new_name)))
+
+    # Body
+    for l in body.splitlines():
+        l = l.strip()
+        if l.startswith("ALIAS"):
+            l = " ".join(("ALIAS",) + _rename(l.split()[1:], name, new_name))
+        lines.append(l)
+
+    return lines
+
+
+def format_sexpr_symbol(body, new_name=None, indent="  "):
+    """
+    Formats a KiCad 6+ symbol definition given its text, either read from
+    a library or cached in a schematic, see SexprSymbol. The symbol and its
+    units are renamed, if a new name is given. A library name prefix of the
+    new name, if any, is not used for units. The definition is indented
+    with the given indentation, its formatting is kept otherwise.
+    """
+
+    text = body
+    if new_name is not None:
+        root = bracket_tree.parse_concrete(body, escapes=True)
+
+        # Units are named after the symbol, without the library name
+        name = root.attributes[0]
+        unit_prefix = name.rpartition(":")[2] + "_"
+        new_unit_prefix = new_name.rpartition(":")[2] + "_"
+
+        root.child[0] = new_name
+        for node in root.findall("symbol"):
+            unit = node.attributes[0]
+            if unit.startswith(unit_prefix):
+                node.child[0] = new_unit_prefix + unit[len(unit_prefix):]
+
+        text = bracket_tree.dump_concrete(root)
+
+    # Re-indent
+    stripped = text.lstrip()
+    leading  = text[:len(text) - len(stripped)]
+    return indent + stripped.replace("\n" + leading, "\n" + indent)